@@ -0,0 +1,455 @@
+""" Single-file tile archives, read through a memory map.
+
+An archive holds every tile of one layer in a single immutable file, which is
+quick to read, easy to copy and can be served as-is from any static host that
+understands byte ranges. An archive is a fixed-size header, a directory of
+tiles and then the tile contents themselves, one after another:
+
+  header
+    The magic string "TSARCHIV", a format version, the number of entries in
+    each leaf directory (zero if there are none), the tile file extension
+    such as "png", the position and number of entries in the root directory,
+    the position of the tile contents and the number of tiles. All numbers
+    are little-endian.
+
+  root directory
+    Sorted (tile_id, offset, length) entries, 20 bytes each. In an archive
+    of up to 4096 tiles these point to tile contents. In a bigger archive
+    they point to leaf directories instead, with the first tile_id of each
+    leaf, its offset, and its number of entries as the length.
+
+  leaf directories
+    Sorted (tile_id, offset, length) entries pointing to tile contents.
+
+  tile contents
+    Identical tiles are stored only once, with several entries pointing to
+    the same offset.
+
+A tile_id numbers tiles by zoom level, then row, then column, so tiles at zoom
+zero come first, then the four at zoom one, and so on; see tile_id(). A tile
+is found with a binary search of the root directory and then, in a big
+archive, of one leaf directory, and its contents are returned as a buffer
+into the memory map without any copying.
+
+Use an archive with the "archive" provider:
+
+  {
+    "cache": { ... }.
+    "layers":
+    {
+      "roads":
+      {
+        "provider":
+        {
+          "name": "archive",
+          "archive": "roads.archive"
+        }
+      }
+    }
+  }
+
+Archive provider parameters:
+
+  archive:
+    Required local file path to the archive.
+
+Or use the Cache class below as a layer's cache, with a "filename" and a
+"format", the tile file extension. Its read() methods are served from the
+archive, and tiles saved to it are kept in a staging directory next to the
+archive until finish() writes a new archive with them. Each process stages
+tiles in files of its own, so tilestache-seed.py can write an archive with
+several workers through its --to-archive option.
+
+A running server keeps reading the archive it mapped when it started, even
+after a new one replaces it, so restart it to serve the new tiles.
+"""
+import os
+
+from threading import Lock
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from hashlib import md5
+from glob import glob
+from shutil import rmtree
+from tempfile import mkstemp
+from urlparse import urlparse, urljoin
+from os.path import exists, dirname, abspath, join as pathjoin
+
+from .Core import KnownUnknown
+
+_magic, _version = 'TSARCHIV', 1
+
+_header = Struct('<8sII8sQQQQ')
+_entry = Struct('<QQI')
+
+# largest root directory before tiles go into leaf directories.
+_root_entries = 4096
+
+# staged length of a removed tile, see Cache.remove().
+_removed = 0xFFFFFFFF
+
+_types = {'png': ('image/png', 'PNG'), 'jpg': ('image/jpeg', 'JPEG'),
+          'json': ('application/json', 'JSON'), 'geojson': ('application/json', 'GeoJSON'),
+          'topojson': ('application/json', 'TopoJSON'),
+          'mvt': ('application/vnd.mapbox-vector-tile', 'MVT')}
+
+def tile_id(coord):
+    """ Return a number for a tile coordinate, in zoom, row, column order.
+    """
+    zoom, row, column = int(coord.zoom), int(coord.row), int(coord.column)
+    return ((4**zoom - 1) // 3) + (row << zoom) + column
+
+def in_grid(coord):
+    """ Return true if a tile coordinate is inside its zoom level's grid.
+
+        Other coordinates would get the tile_id() of some other tile.
+    """
+    zoom, row, column = int(coord.zoom), int(coord.row), int(coord.column)
+    return zoom >= 0 and 0 <= row < 2**zoom and 0 <= column < 2**zoom
+
+class Reader:
+    """ Read-only view of an archive file, through a memory map.
+    """
+    def __init__(self, filename):
+        file = open(filename, 'rb')
+
+        try:
+            self.map = mmap(file.fileno(), 0, access=ACCESS_READ)
+        finally:
+            file.close()
+
+        magic, version, self.leaf_size, format, self.root_offset, self.root_count, \
+            self.data_offset, self.count = _header.unpack_from(self.map, 0)
+
+        if (magic, version) != (_magic, _version):
+            raise KnownUnknown('"%s" is not a version %d TileStache archive.' % (filename, _version))
+
+        self.format = format.rstrip('\0')
+
+    def _search(self, offset, count, tile_id):
+        """ Return the last (tile_id, offset, length) entry at or before tile_id.
+
+            Searches count entries starting at offset, returns None if
+            every entry comes after tile_id.
+        """
+        low, high = 0, count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if _entry.unpack_from(self.map, offset + middle * _entry.size)[0] <= tile_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == 0:
+            return None
+
+        return _entry.unpack_from(self.map, offset + (low - 1) * _entry.size)
+
+    def get(self, coord):
+        """ Return the contents of a tile as a buffer, or None if it's missing.
+        """
+        if not in_grid(coord):
+            return None
+
+        id = tile_id(coord)
+        entry = self._search(self.root_offset, self.root_count, id)
+
+        if entry is not None and self.leaf_size:
+            leaf_id, leaf_offset, leaf_count = entry
+            entry = self._search(leaf_offset, leaf_count, id)
+
+        if entry is None or entry[0] != id:
+            return None
+
+        id, offset, length = entry
+        return buffer(self.map, offset, length)
+
+    def entries(self):
+        """ Generate every (tile_id, offset, length) entry for tiles in order.
+        """
+        if not self.leaf_size:
+            leaves = [(0, self.root_offset, self.root_count)]
+        else:
+            leaves = [_entry.unpack_from(self.map, self.root_offset + i * _entry.size)
+                      for i in range(self.root_count)]
+
+        for (leaf_id, leaf_offset, leaf_count) in leaves:
+            for i in range(leaf_count):
+                yield _entry.unpack_from(self.map, leaf_offset + i * _entry.size)
+
+    def close(self):
+        """ Unmap the archive, after which tiles from get() must not be used.
+        """
+        self.map.close()
+
+def write_archive(filename, format, tiles, umask=0022):
+    """ Write a new archive from a list of (tile_id, content) pairs.
+
+        Tiles must be sorted by tile_id. The archive is written to a
+        temporary file and then moved into place.
+    """
+    count = len(tiles)
+
+    if count > _root_entries:
+        leaf_size = max(_root_entries, -(-count // _root_entries))
+        leaves = [(i, min(leaf_size, count - i)) for i in range(0, count, leaf_size)]
+    else:
+        leaf_size, leaves = 0, []
+
+    root_offset = _header.size
+    root_count = leaves and len(leaves) or count
+    leaf_offset = root_offset + root_count * _entry.size
+    data_offset = leaf_offset + (leaves and count * _entry.size or 0)
+
+    handle, tmp_path = mkstemp(dir=dirname(abspath(filename)), suffix='.archive')
+    file = os.fdopen(handle, 'wb')
+
+    try:
+        file.seek(data_offset)
+        entries, offsets, offset = [], {}, data_offset
+
+        for (id, content) in tiles:
+            hash = md5(content).digest()
+
+            if hash not in offsets:
+                file.write(content)
+                offsets[hash] = offset
+                offset += len(content)
+
+            entries.append(_entry.pack(id, offsets[hash], len(content)))
+
+        file.seek(0)
+        file.write(_header.pack(_magic, _version, leaf_size, format, root_offset, root_count, data_offset, count))
+
+        if leaves:
+            for (start, leaf_count) in leaves:
+                id = _entry.unpack(entries[start])[0]
+                file.write(_entry.pack(id, leaf_offset + start * _entry.size, leaf_count))
+
+        file.write(''.join(entries))
+
+    finally:
+        file.close()
+
+    os.chmod(tmp_path, 0666&~umask)
+    os.rename(tmp_path, filename)
+
+def _stagingpath(filename):
+    return filename + '.staging'
+
+def finish(filename, format, umask=0022):
+    """ Write a new archive with tiles from an old one and any staged tiles.
+
+        Staged tiles replace old tiles, and the staging directory is removed
+        afterwards. Call this once, after every process saving tiles to the
+        archive's Cache is done.
+    """
+    sources, tiles = [], {}
+
+    if exists(filename):
+        reader = Reader(filename)
+        sources.append(reader.map)
+
+        for (id, offset, length) in reader.entries():
+            tiles[id] = 0, offset, length
+
+    indexes = glob(pathjoin(_stagingpath(filename), '*.index'))
+    indexes.sort(key=lambda path: os.stat(path).st_mtime)
+
+    for index in indexes:
+        with open(index, 'rb') as file:
+            records = file.read()
+
+        data = open(index[:-len('.index')] + '.data', 'rb')
+
+        if os.fstat(data.fileno()).st_size:
+            sources.append(mmap(data.fileno(), 0, access=ACCESS_READ))
+
+        data.close()
+
+        for position in range(0, len(records) - _entry.size + 1, _entry.size):
+            id, offset, length = _entry.unpack_from(records, position)
+
+            if length == _removed:
+                tiles.pop(id, None)
+            else:
+                tiles[id] = len(sources) - 1, offset, length
+
+    contents = [(id, buffer(sources[source], offset, length))
+                for (id, (source, offset, length)) in sorted(tiles.items())]
+
+    write_archive(filename, format, contents, umask)
+
+    for source in sources:
+        source.close()
+
+    if exists(_stagingpath(filename)):
+        rmtree(_stagingpath(filename))
+
+def _write(fd, data):
+    """ Write all of data to a file descriptor.
+    """
+    while data:
+        data = data[os.write(fd, data):]
+
+class Provider:
+    """ Archive provider.
+
+        See module documentation for explanation of constructor arguments.
+    """
+    def __init__(self, layer, archive):
+        """
+        """
+        archiveref = urljoin(layer.config.dirpath, archive)
+        scheme, h, path, q, p, f = urlparse(archiveref)
+
+        if scheme not in ('file', ''):
+            raise Exception('Bad scheme in archive provider, must be local file: "%s"' % scheme)
+
+        self.reader = Reader(path)
+        self.layer = layer
+
+    @staticmethod
+    def prepareKeywordArgs(config_dict):
+        """ Convert configured parameters to keyword args for __init__().
+        """
+        return {'archive': config_dict['archive']}
+
+    def renderTile(self, width, height, srs, coord):
+        """ Retrieve a single tile, return a TileResponse instance.
+        """
+        return TileResponse(self.reader.get(coord))
+
+    def getTypeByExtension(self, extension):
+        """ Get mime-type and format by file extension.
+
+            This only accepts the extension of the archive's tiles.
+        """
+        if extension.lower() != self.reader.format or extension.lower() not in _types:
+            raise KnownUnknown('Archive only has .%s tiles, not "%s"' % (self.reader.format, extension))
+
+        return _types[extension.lower()]
+
+class TileResponse:
+    """ Wrapper class for tile response that makes it behave like a PIL.Image object.
+
+        TileStache.getTile() expects to be able to save one of these to a buffer.
+    """
+    def __init__(self, content):
+        self.content = content
+
+    def save(self, out, format):
+        if self.content is not None:
+            out.write(self.content)
+
+class Cache:
+    """ Cache provider that reads from an archive and stages tiles for a new one.
+
+        See module documentation for explanation of constructor arguments.
+    """
+    def __init__(self, filename, format, umask=0022):
+        """
+        """
+        self.filename = filename
+        self.format = format.lower()
+        self.umask = int(umask)
+        self._reader, self._pid = None, None
+        self._lock = Lock()
+
+    def _staging(self):
+        """ Return this process's data and index files in the staging directory.
+
+            Both are opened for appending, and written without buffering.
+        """
+        if self._pid != os.getpid():
+            # first use, or we're in a freshly-forked child process.
+            path = _stagingpath(self.filename)
+
+            try:
+                os.makedirs(path, 0777&~self.umask)
+            except OSError, e:
+                if e.errno != 17:
+                    raise
+
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+            data = os.open(pathjoin(path, '%d.data' % os.getpid()), flags, 0666&~self.umask)
+            index = os.open(pathjoin(path, '%d.index' % os.getpid()), flags, 0666&~self.umask)
+
+            self._data, self._index, self._pid = data, index, os.getpid()
+
+        return self._data, self._index
+
+    def _stage(self, coords, bodies, lengths):
+        """ Append tile bodies to the staging files, then their index records.
+
+            Tiles outside the grid are left out.
+        """
+        tiles = [(c, b, l) for (c, b, l) in zip(coords, bodies, lengths) if in_grid(c)]
+
+        with self._lock:
+            data, index = self._staging()
+            offset = os.fstat(data).st_size
+            records = []
+
+            for (coord, body, length) in tiles:
+                records.append(_entry.pack(tile_id(coord), offset, length))
+                offset += len(body)
+
+            _write(data, ''.join([body for (c, body, l) in tiles]))
+            _write(index, ''.join(records))
+
+    def _read(self, coord):
+        if self._reader is None:
+            if not exists(self.filename):
+                return None
+            self._reader = Reader(self.filename)
+
+        return self._reader.get(coord)
+
+    def lock(self, layer, coord, format):
+        return
+
+    def unlock(self, layer, coord, format):
+        return
+
+    def remove(self, layer, coord, format):
+        """ Stage the removal of a tile from the next archive.
+        """
+        self._stage([coord], [''], [_removed])
+
+    def read(self, layer, coord, format):
+        """ Return raw tile content from the archive.
+        """
+        return self._read(coord)
+
+    def read_many(self, layer, coords, format):
+        """ Return raw content for a list of tiles from the archive.
+        """
+        return [self._read(coord) for coord in coords]
+
+    def save(self, body, layer, coord, format):
+        """ Stage raw tile content for the next archive.
+        """
+        self._stage([coord], [body], [len(body)])
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Stage raw content for a list of tiles for the next archive.
+        """
+        self._stage(coords, bodies, map(len, bodies))
+
+    def finish(self):
+        """ Write a new archive with the staged tiles, see finish() above.
+        """
+        with self._lock:
+            # not closed, in case tiles read from it are still in use.
+            self._reader = None
+
+            if self._pid == os.getpid():
+                # the staging files are about to be removed.
+                os.close(self._data)
+                os.close(self._index)
+                self._pid = None
+
+            finish(self.filename, self.format, self.umask)
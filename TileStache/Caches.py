@@ -11,6 +11,9 @@ Built-in providers:
 - memcache
 - s3
 
+Any cache can be wrapped in a WriteBehind queue by adding a "write behind"
+key to its configuration, see WriteBehind below.
+
 Example built-in cache, for JSON configuration file:
 
     "cache": {
@@ -44,6 +47,37 @@ The save() method accepts an additional argument before the others:
 
 - body: raw content to save to the cache.
 
+A cache may also provide read_many() and save_many() methods to handle all
+the tiles of a metatile in a single round-trip. Both accept a list of
+coordinates instead of a single one:
+
+- read_many(layer, coords, format) returns a list of bodies in the same
+  order as coords, with None for each tile that isn't cached.
+- save_many(bodies, layer, coords, format) saves a list of bodies, one for
+  each of coords.
+
+Caches without these methods are handled one tile at a time with read() and
+save() instead.
+
+A cache that knows when tiles were saved may also provide read_stale(layer,
+coord, format), returning a (body, age) tuple for a cached tile regardless of
+the layer's cache lifespan, or None. Layers with a "stale while revalidate"
+window use it to serve expired tiles while they are rendered again.
+
+A cache that keeps tiles with some metadata may also provide read_info(layer,
+coord, format), returning an (etag, last_modified) tuple for a cached tile
+without reading the tile itself, or None if the tile isn't cached. The etag is
+a quoted ETag header value made from the MD5 hash of the tile, or None if the
+cache doesn't know it, and last_modified is a Unix timestamp. WSGITileServer
+uses it to answer conditional requests with 304 Not Modified.
+
+A cache that keeps tiles in plain files may also provide read_file(layer,
+coord, format), returning an open file with the uncompressed tile contents or
+None if the tile isn't cached. WSGITileServer uses it to send tiles without
+reading them into memory first. Such a cache's read_info() etag, if it has
+one, should be a weak ETag made from the file's os.stat() by Core._fileETag(),
+the same one sent with the file.
+
 TODO: add stale_lock_timeout and cache_lifespan to cache API in v2.
 """
 
@@ -51,11 +85,21 @@ import os
 import sys
 import time
 import gzip
+import atexit
+import logging
 
 from tempfile import mkstemp
+from hashlib import md5
+from thread import get_ident
+from collections import OrderedDict
+from threading import Condition, Thread
+from multiprocessing.util import Finalize
+from weakref import WeakSet
 from os.path import isdir, exists, dirname, basename, join as pathjoin
 
-from .Core import KnownUnknown
+from .Core import KnownUnknown, _readMany, _saveMany, _tileETag, _fileETag
+from . import Locks
+from . import Metrics
 from . import Memcache
 from . import Redis
 from . import S3
@@ -153,6 +197,17 @@ class Test:
         
         if self.logfunc:
             self.logfunc('Test cache save: %d bytes to %s' % (len(body), name))
+    
+    def read_many(self, layer, coords, format):
+        """ Pretend to read a list of cached tiles.
+        """
+        return [self.read(layer, coord, format) for coord in coords]
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Pretend to save a list of cached tiles.
+        """
+        for (body, coord) in zip(bodies, coords):
+            self.save(body, layer, coord, format)
 
 class Disk:
     """ Caches files to disk.
@@ -178,16 +233,29 @@ class Disk:
         - gzip: optional list of file formats that should be stored in a
           compressed form. Defaults to "txt", "text", "json", and "xml".
           Provide an empty list in the configuration for no compression.
+        - dedupe: optional boolean. If true, each distinct tile body is
+          stored just once in a ".dedupe" directory named for its MD5 hash,
+          and hard-linked into place for every tile with that body. Defaults
+          to false. Needs a filesystem with hard links.
+        
+        With dedupe, linked tiles share the stored file's modification time,
+        so a tile can look up to a minute older than it is: older stored
+        bodies are written again for new tiles, as are bodies with as many
+        links as the filesystem allows. Removed tiles leave their
+        stored bodies behind for later reuse, so call remove_unreferenced()
+        now and then, as tilestache-clean.py does.
 
         If your configuration file is loaded from a remote location, e.g.
         "http://example.com/tilestache.cfg", the path *must* be an unambiguous
         filesystem path, e.g. "file:///tmp/cache"
     """
-    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split()):
+    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split(), dedupe=False):
         self.cachepath = path
         self.umask = int(umask)
         self.dirs = dirs
         self.gzip = [format.lower() for format in gzip]
+        self.dedupe = bool(dedupe)
+        self._lockfiles = {}
 
     def _is_compressed(self, format):
         return format.lower() in self.gzip
@@ -244,6 +312,15 @@ class Disk:
 
         return fullpath
 
+    def _storepath(self, body, format):
+        """ Return the full path of a tile body in the dedupe store.
+        """
+        hash = md5(body).hexdigest()
+        suffix = '.' + format.lower()
+        suffix += self._is_compressed(format) and '.gz' or ''
+        
+        return pathjoin(self.cachepath, '.dedupe', hash[:2], hash[2:4], hash + suffix)
+
     def _lockpath(self, layer, coord, format):
         """
         """
@@ -253,40 +330,90 @@ class Disk:
         """ Acquire a cache lock for this tile.
         
             Returns nothing, but blocks until the lock has been acquired.
-            Lock is implemented as an empty directory next to the tile file.
+            Lock is implemented as an flock() on a file next to the tile file,
+            or an empty directory where file locks aren't available.
         """
         lockpath = self._lockpath(layer, coord, format)
         due = time.time() + layer.stale_lock_timeout
         
+        if Locks.flock is None:
+            return self._lockdir(lockpath, due)
+        
+        self._makedirs(dirname(lockpath))
+        
         while True:
-            # try to acquire a directory lock, repeating if necessary.
             try:
-                umask_old = os.umask(self.umask)
-                
-                if time.time() > due:
-                    # someone left the door locked.
-                    try:
-                        os.rmdir(lockpath)
-                    except OSError:
-                        # Oh - no they didn't.
-                        pass
-                
+                fd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0666&~self.umask)
+            except OSError, e:
+                if e.errno != 21:
+                    raise
+                # a directory lock left over from an older TileStache.
+                self._unlockdir(lockpath)
+                continue
+            
+            if not Locks.wait_for_flock(fd, due - time.time()):
+                # someone left the door locked.
+                self._unlockfile(lockpath, fd)
+                due = time.time() + layer.stale_lock_timeout
+                continue
+            
+            try:
+                if os.fstat(fd).st_ino == os.stat(lockpath).st_ino:
+                    self._lockfiles[lockpath] = fd
+                    return
+            except OSError, e:
+                if e.errno != 2:
+                    raise
+            
+            # The holder removed the file we locked, try the new one.
+            os.close(fd)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+        """
+        lockpath = self._lockpath(layer, coord, format)
+        fd = self._lockfiles.pop(lockpath, None)
+        
+        if fd is None:
+            self._unlockdir(lockpath)
+        else:
+            self._unlockfile(lockpath, fd)
+    
+    def _unlockfile(self, lockpath, fd):
+        """ Release a file lock, removing the file first so no one waits on it.
+        """
+        try:
+            if os.fstat(fd).st_ino == os.stat(lockpath).st_ino:
+                os.unlink(lockpath)
+        except OSError:
+            # Ok, someone else deleted it already
+            pass
+        
+        os.close(fd)
+    
+    def _lockdir(self, lockpath, due):
+        """ Acquire a cache lock implemented as an empty directory.
+        """
+        def attempt():
+            umask_old = os.umask(self.umask)
+            try:
                 os.makedirs(lockpath, 0777&~self.umask)
-                break
+                return True
             except OSError, e:
                 if e.errno != 17:
                     raise
-                time.sleep(.2)
+                return False
             finally:
                 os.umask(umask_old)
+        
+        if not Locks.wait_for(attempt, due - time.time()):
+            # someone left the door locked.
+            self._unlockdir(lockpath)
+            attempt()
     
-    def unlock(self, layer, coord, format):
-        """ Release a cache lock for this tile.
-
-            Lock is implemented as an empty directory next to the tile file.
+    def _unlockdir(self, lockpath):
+        """ Release a cache lock implemented as an empty directory.
         """
-        lockpath = self._lockpath(layer, coord, format)
-
         try:
             os.rmdir(lockpath)
         except OSError:
@@ -325,20 +452,112 @@ class Disk:
             body = open(fullpath, 'rb').read()
             return body
     
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles.
+        """
+        return [self.read(layer, coord, format) for coord in coords]
+    
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        """
+        fullpath = self._fullpath(layer, coord, format)
+        
+        if not exists(fullpath):
+            return None
+
+        age = time.time() - os.stat(fullpath).st_mtime
+        
+        if self._is_compressed(format):
+            return gzip.open(fullpath, 'r').read(), age
+
+        else:
+            return open(fullpath, 'rb').read(), age
+    
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+        
+            Files have no room for a hash, so the etag is a weak one made
+            from the file's inode, size and modification time.
+        """
+        fullpath = self._fullpath(layer, coord, format)
+        
+        try:
+            stat = os.stat(fullpath)
+        except OSError:
+            return None
+        
+        if layer.cache_lifespan and time.time() - stat.st_mtime > layer.cache_lifespan:
+            return None
+        
+        return _fileETag(stat), stat.st_mtime
+    
+    def read_file(self, layer, coord, format):
+        """ Open a cached tile file for reading.
+        
+            Returns None for gzipped formats, which have to be read().
+        """
+        if self._is_compressed(format):
+            return None
+        
+        fullpath = self._fullpath(layer, coord, format)
+        
+        try:
+            file = open(fullpath, 'rb')
+        except IOError:
+            return None
+
+        age = time.time() - os.fstat(file.fileno()).st_mtime
+        
+        if layer.cache_lifespan and age > layer.cache_lifespan:
+            file.close()
+            return None
+        
+        return file
+    
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
         fullpath = self._fullpath(layer, coord, format)
         
+        self._makedirs(dirname(fullpath))
+        
+        if self.dedupe:
+            self._writeLinked(body, fullpath, format, layer)
+        else:
+            self._write(body, fullpath, format)
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles.
+        
+            Neighboring tiles mostly share directories, so each directory
+            is only created once.
+        """
+        fullpaths = [self._fullpath(layer, coord, format) for coord in coords]
+        
+        for dirpath in set(map(dirname, fullpaths)):
+            self._makedirs(dirpath)
+        
+        for (body, fullpath) in zip(bodies, fullpaths):
+            if self.dedupe:
+                self._writeLinked(body, fullpath, format, layer)
+            else:
+                self._write(body, fullpath, format)
+    
+    def _makedirs(self, dirpath):
+        """ Create a directory and its parents if they don't already exist.
+        """
         try:
             umask_old = os.umask(self.umask)
-            os.makedirs(dirname(fullpath), 0777&~self.umask)
+            os.makedirs(dirpath, 0777&~self.umask)
         except OSError, e:
             if e.errno != 17:
                 raise
         finally:
             os.umask(umask_old)
-
+    
+    def _write(self, body, fullpath, format):
+        """ Atomically write a tile body to a full path in an existing directory.
+        """
         suffix = '.' + format.lower()
         suffix += self._is_compressed(format) and '.gz' or ''
 
@@ -360,6 +579,105 @@ class Disk:
             os.rename(tmp_path, fullpath)
 
         os.chmod(fullpath, 0666&~self.umask)
+    
+    def _writeLinked(self, body, fullpath, format, layer):
+        """ Hard-link a tile body from the dedupe store, writing it there if needed.
+        
+            A stored body older than a minute, or half the layer's cache
+            lifespan, is written again as a new file, and so is one with as
+            many links as the filesystem allows. Tiles linked to the old file
+            keep it, along with its modification time.
+        """
+        storepath = self._storepath(body, format)
+        refresh, full = 60, False
+        
+        if layer.cache_lifespan:
+            refresh = min(refresh, layer.cache_lifespan / 2.)
+        
+        while True:
+            try:
+                age = time.time() - os.stat(storepath).st_mtime
+            except OSError, e:
+                if e.errno != 2:
+                    raise
+                self._makedirs(dirname(storepath))
+                age = None
+            
+            if full or age is None or age > refresh:
+                self._write(body, storepath, format)
+            
+            try:
+                if _link(storepath, fullpath):
+                    return
+            except OSError, e:
+                # errno=31 means the stored body can't have any more links
+                if e.errno != 31:
+                    raise
+                full = True
+            else:
+                full = False
+    
+    def remove_unreferenced(self, min_age=3600):
+        """ Remove stored tile bodies no longer linked to any tile, return a count.
+        
+            Bodies written or linked in the past min_age seconds are kept, so
+            that a save in progress doesn't lose its body before linking it.
+            Linking changes a file's ctime, which is what's checked here.
+        """
+        storepath, count = pathjoin(self.cachepath, '.dedupe'), 0
+        
+        for (dirpath, dirnames, filenames) in os.walk(storepath):
+            for filename in filenames:
+                fullpath = pathjoin(dirpath, filename)
+                
+                try:
+                    stat = os.stat(fullpath)
+                    
+                    if stat.st_nlink == 1 and time.time() - stat.st_ctime > min_age:
+                        os.remove(fullpath)
+                        count += 1
+                
+                except OSError, e:
+                    # errno=2 means someone else removed it first, which is fine
+                    if e.errno != 2:
+                        raise
+        
+        return count
+
+def _link(source, destination):
+    """ Hard-link source to destination, atomically replacing any old file.
+    
+        Returns false if source has disappeared.
+    """
+    try:
+        src, dest = os.stat(source), os.stat(destination)
+    except OSError, e:
+        if e.errno != 2:
+            raise
+    else:
+        if (src.st_ino, src.st_dev) == (dest.st_ino, dest.st_dev):
+            # already linked, and rename() would leave tmp_path behind.
+            return True
+    
+    tmp_path = '%s.%d-%d.link' % (destination, os.getpid(), get_ident())
+    
+    try:
+        os.link(source, tmp_path)
+    except OSError, e:
+        if e.errno != 2:
+            raise
+        return False
+    
+    os.rename(tmp_path, destination)
+    
+    try:
+        # still here if destination was linked to source in the meantime.
+        os.unlink(tmp_path)
+    except OSError, e:
+        if e.errno != 2:
+            raise
+    
+    return True
 
 class Multi:
     """ Caches tiles to multiple, ordered caches.
@@ -425,6 +743,7 @@ class Multi:
         """
         for (index, cache) in enumerate(self.tiers):
             body = cache.read(layer, coord, format)
+            _countTierReads(index, cache, hits=int(bool(body)), misses=int(not body))
             
             if body:
                 # save the body in earlier tiers for speedier access
@@ -435,6 +754,41 @@ class Multi:
         
         return None
     
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        
+            Tiers are tried in order, and found tiles are not copied forward.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'read_stale'):
+                stale = cache.read_stale(layer, coord, format)
+                
+                if stale is not None:
+                    return stale
+        
+        return None
+    
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+        
+            Only the first tier is asked, because a tile missing from it
+            will be copied there with a new modification time.
+        """
+        if hasattr(self.tiers[0], 'read_info'):
+            return self.tiers[0].read_info(layer, coord, format)
+        
+        return None
+    
+    def read_file(self, layer, coord, format):
+        """ Open a cached tile file from the first tier, if it has files.
+        
+            Later tiers are left to read(), which copies tiles forward.
+        """
+        if hasattr(self.tiers[0], 'read_file'):
+            return self.tiers[0].read_file(layer, coord, format)
+        
+        return None
+    
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         
@@ -442,3 +796,363 @@ class Multi:
         """
         for (index, cache) in enumerate(self.tiers):
             cache.save(body, layer, coord, format)
+        
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles.
+        
+            Like read(), but each tier is asked only for the tiles that
+            were not found in earlier tiers, and found tiles are saved back
+            to the earlier tiers in one batch.
+        """
+        bodies = [None] * len(coords)
+        missing = range(len(coords))
+        
+        for (index, cache) in enumerate(self.tiers):
+            if not missing:
+                break
+            
+            found = _readMany(cache, layer, [coords[i] for i in missing], format)
+            found = [(i, body) for (i, body) in zip(missing, found) if body]
+            _countTierReads(index, cache, hits=len(found), misses=len(missing) - len(found))
+            
+            if found:
+                # save the bodies in earlier tiers for speedier access
+                for cache in self.tiers[:index]:
+                    _saveMany(cache, [body for (i, body) in found], layer, [coords[i] for (i, body) in found], format)
+            
+            for (i, body) in found:
+                bodies[i] = body
+            
+            missing = [i for i in missing if bodies[i] is None]
+        
+        return bodies
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles.
+        
+            Every tier gets a saved copy.
+        """
+        for (index, cache) in enumerate(self.tiers):
+            _saveMany(cache, bodies, layer, coords, format)
+
+def _cacheName(cache):
+    """ Return a short name for a kind of cache, for metrics labels.
+    """
+    name = cache.__class__.__name__
+    
+    if name == 'Cache':
+        # e.g. S3.Cache or Memcache.Cache
+        name = cache.__class__.__module__.split('.')[-1]
+    
+    return name
+
+def _countTierReads(index, cache, hits, misses):
+    """ Count hits and misses for one tier of a Multi cache in Metrics.
+    """
+    name = _cacheName(cache)
+    
+    if hits:
+        Metrics.inc('tilestache_cache_reads_total', hits, tier=str(index), cache=name, result='hit')
+    
+    if misses:
+        Metrics.inc('tilestache_cache_reads_total', misses, tier=str(index), cache=name, result='miss')
+
+class WriteBehind:
+    """ Saves tiles to a slow cache in background threads.
+    
+        Writes to a remote cache like S3 can take much longer than rendering
+        the tile did. WriteBehind queues saved tiles in memory and returns
+        right away, while a few worker threads write them to the wrapped
+        cache. Tiles waiting in the queue are still found by read(), so a
+        tile is never missing between being saved and being written.
+        
+        The queue is limited to a number of bytes, and tiles saved while it's
+        full are dropped instead of written: they will simply be rendered
+        again on a later request. Remaining tiles are written when the
+        process exits.
+        
+        Local caches like Disk or Memcache are quick enough to save tiles
+        directly, so write behind is best used for the slow tiers of a Multi
+        cache. Add a "write behind" key to any cache configuration:
+        
+            "cache": {
+              "name": "Multi",
+              "tiers": [
+                  {
+                     "name": "Disk",
+                     "path": "/tmp/stache"
+                  },
+                  {
+                     "name": "S3",
+                     "bucket": "<bucket name>",
+                     "write behind": {"max bytes": 67108864, "workers": 2}
+                  }
+              ]
+            }
+        
+        Write behind parameters:
+        
+          max bytes
+            Optional limit on the total size of queued tiles, 64MB by default.
+        
+          workers
+            Optional number of threads writing queued tiles, two by default.
+        
+        Use "write behind": true for the default parameters.
+        
+        Queue depth and counts of written, failed and dropped tiles for this
+        process are available from stats().
+    """
+    def __init__(self, cache, max_bytes=0x4000000, workers=2):
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.workers = workers
+        
+        self._lock = Condition()
+        self._pid = None
+        
+        atexit.register(self.flush)
+        _write_behinds.add(self)
+    
+    def _start(self):
+        """ Start worker threads if this process doesn't have any yet.
+        
+            Call with self._lock held. A forked process gets its own empty
+            queue and workers, leaving its parent's queue to the parent.
+        """
+        if self._pid == os.getpid():
+            return
+        
+        self._pid = os.getpid()
+        self._pending = OrderedDict()
+        self._writing = {}
+        self._bytes = 0
+        self._counts = dict(written=0, failed=0, dropped=0)
+        
+        for i in range(max(1, self.workers)):
+            worker = Thread(target=self._work, args=(self._pid, ))
+            worker.daemon = True
+            worker.start()
+        
+        # multiprocessing workers exit without running atexit functions.
+        Finalize(self, self.flush, exitpriority=10)
+    
+    def _key(self, layer, coord, format):
+        return layer, coord.zoom, coord.column, coord.row, format
+    
+    def _find(self, layer, coord, format):
+        """ Return a tile body that's waiting to be written, or None.
+        """
+        key = self._key(layer, coord, format)
+        
+        with self._lock:
+            if self._pid != os.getpid():
+                return None
+            
+            if key in self._pending:
+                return self._pending[key][1]
+            
+            if key in self._writing:
+                return self._writing[key][1]
+        
+        return None
+    
+    def _work(self, pid):
+        """ Write batches of queued tiles from one layer and format at a time.
+        """
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+                
+                if self._pid != pid:
+                    # this thread is running in a forked child.
+                    return
+                
+                (layer, z, x, y, format) = self._pending.keys()[0]
+                batch = [key for key in self._pending
+                         if key[0] is layer and key[4] == format][:64]
+                
+                for key in batch:
+                    self._writing[key] = self._pending.pop(key)
+                    self._bytes -= len(self._writing[key][1])
+            
+            coords = [self._writing[key][0] for key in batch]
+            bodies = [self._writing[key][1] for key in batch]
+            
+            try:
+                _saveMany(self.cache, bodies, layer, coords, format)
+            except:
+                logging.exception('WriteBehind failed to save %d tiles of %s', len(batch), layer.name())
+                failed = True
+            else:
+                failed = False
+            
+            with self._lock:
+                for key in batch:
+                    del self._writing[key]
+                
+                self._counts['failed' if failed else 'written'] += len(batch)
+                self._lock.notify_all()
+    
+    def flush(self, timeout=None):
+        """ Wait for queued tiles to be written, up to timeout seconds.
+        
+            Returns true if the queue is empty.
+        """
+        due = timeout and (time.time() + timeout)
+        
+        with self._lock:
+            if self._pid != os.getpid():
+                return True
+            
+            while self._pending or self._writing:
+                if due and time.time() > due:
+                    break
+                
+                self._lock.wait(due and max(0, due - time.time()))
+            
+            return not (self._pending or self._writing)
+    
+    def stats(self):
+        """ Return a dictionary of queue depth and write counts for this process.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                return dict(written=0, failed=0, dropped=0, depth=0, bytes=0, max_bytes=self.max_bytes)
+            
+            return dict(self._counts, depth=len(self._pending) + len(self._writing),
+                        bytes=self._bytes, max_bytes=self.max_bytes)
+    
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile in the wrapped cache.
+        """
+        return self.cache.lock(layer, coord, format)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile in the wrapped cache.
+        """
+        return self.cache.unlock(layer, coord, format)
+    
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile from the queue and the wrapped cache.
+        """
+        key = self._key(layer, coord, format)
+        
+        with self._lock:
+            self._start()
+            
+            if key in self._pending:
+                self._bytes -= len(self._pending.pop(key)[1])
+        
+        return self.cache.remove(layer, coord, format)
+    
+    def read(self, layer, coord, format):
+        """ Read a cached tile from the queue or the wrapped cache.
+        """
+        body = self._find(layer, coord, format)
+        
+        if body is None:
+            body = self.cache.read(layer, coord, format)
+        
+        return body
+    
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles from the queue or the wrapped cache.
+        """
+        bodies = [self._find(layer, coord, format) for coord in coords]
+        missing = [i for (i, body) in enumerate(bodies) if body is None]
+        
+        if missing:
+            found = _readMany(self.cache, layer, [coords[i] for i in missing], format)
+            
+            for (i, body) in zip(missing, found):
+                bodies[i] = body
+        
+        return bodies
+    
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        """
+        body = self._find(layer, coord, format)
+        
+        if body is not None:
+            return body, 0
+        
+        if hasattr(self.cache, 'read_stale'):
+            return self.cache.read_stale(layer, coord, format)
+        
+        return None
+    
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+        """
+        body = self._find(layer, coord, format)
+        
+        if body is not None:
+            return _tileETag(body), time.time()
+        
+        if hasattr(self.cache, 'read_info'):
+            return self.cache.read_info(layer, coord, format)
+        
+        return None
+    
+    def read_file(self, layer, coord, format):
+        """ Open a cached tile file from the wrapped cache, if it has files.
+        
+            Tiles waiting to be written have no file yet, and return None.
+        """
+        if hasattr(self.cache, 'read_file') and self._find(layer, coord, format) is None:
+            return self.cache.read_file(layer, coord, format)
+        
+        return None
+    
+    def save(self, body, layer, coord, format):
+        """ Queue a tile to be saved to the wrapped cache.
+        """
+        self.save_many([body], layer, [coord], format)
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Queue a list of tiles to be saved to the wrapped cache.
+        
+            Tiles that don't fit in the queue are dropped.
+        """
+        with self._lock:
+            self._start()
+            
+            for (body, coord) in zip(bodies, coords):
+                key = self._key(layer, coord, format)
+                
+                if key in self._pending:
+                    self._bytes -= len(self._pending.pop(key)[1])
+                
+                if self._bytes + len(body) > self.max_bytes:
+                    self._counts['dropped'] += 1
+                    continue
+                
+                self._pending[key] = coord, body
+                self._bytes += len(body)
+            
+            self._lock.notify_all()
+
+# every WriteBehind instance, for metrics.
+_write_behinds = WeakSet()
+
+Metrics.declare('tilestache_write_behind_depth', 'gauge', 'Tiles waiting to be written.')
+Metrics.declare('tilestache_write_behind_bytes', 'gauge', 'Size of tiles waiting to be written.')
+Metrics.declare('tilestache_write_behind_tiles_total', 'counter', 'Tiles written, failed or dropped.')
+
+@Metrics.collector
+def _writeBehindMetrics():
+    """ Return write-behind queue gauges for Metrics.
+    """
+    gauges = []
+    
+    for cache in list(_write_behinds):
+        stats, name = cache.stats(), _cacheName(cache.cache)
+        gauges += [('tilestache_write_behind_depth', dict(cache=name), stats['depth']),
+                   ('tilestache_write_behind_bytes', dict(cache=name), stats['bytes'])]
+        gauges += [('tilestache_write_behind_tiles_total', dict(cache=name, result=result), stats[result])
+                   for result in ('written', 'failed', 'dropped')]
+    
+    return gauges
@@ -54,6 +54,12 @@ Configuration also supports these additional settings:
   by mimetypes.guess_type. A simple text greeting is displayed if no index
   is provided.
 
+- "metrics": path of a page with server metrics in Prometheus text format,
+  described in greater detail in the TileStache.Metrics module documentation.
+
+- "tracing": timing breakdowns of slow tile requests, described in greater
+  detail in the TileStache.Tracing module documentation.
+
 In-depth explanations of the layer components can be found in the module
 documentation for TileStache.Providers, TileStache.Core, and TileStache.Geography.
 """
@@ -79,6 +85,8 @@ import Core
 import Caches
 import Providers
 import Geography
+import Metrics
+import Tracing
 
 class Configuration:
     """ A complete site configuration, with a collection of Layer objects.
@@ -114,10 +122,14 @@ class Configuration:
             Local filesystem path for this configuration,
             useful for expanding relative paths.
           
-        Optional attribute:
+        Optional attributes:
         
           index:
             Mimetype, content tuple for default index response.
+        
+          metrics_path:
+            URL path where WSGITileServer publishes metrics, see
+            TileStache.Metrics.
     """
     def __init__(self, cache, dirpath):
         self.cache = cache
@@ -229,6 +241,37 @@ def buildConfiguration(config_dict, dirpath='.'):
         
         config.index = index_type[0], index_body
     
+    if 'metrics' in config_dict:
+        metrics_dict = config_dict['metrics']
+        config.metrics_path = '/' + metrics_dict['path'].lstrip('/')
+        
+        if 'directory' in metrics_dict:
+            directory = enforcedLocalPath(metrics_dict['directory'], dirpath, 'Metrics directory')
+            Metrics.configure(directory, float(metrics_dict.get('interval', 1)))
+    
+    if 'tracing' in config_dict:
+        tracing_dict = config_dict['tracing']
+        
+        if 'exporter' in tracing_dict:
+            _class = loadClassPath(tracing_dict['exporter']['class'])
+            kwargs = tracing_dict['exporter'].get('kwargs', {})
+            exporter = _class(**dict( [(str(k), v) for (k, v) in kwargs.items()] ))
+        
+        elif 'path' in tracing_dict:
+            path = enforcedLocalPath(tracing_dict['path'], dirpath, 'Tracing path')
+            exporter = Tracing.JSONLinesExporter(path)
+        
+        else:
+            exporter = Tracing.JSONLinesExporter()
+        
+        profile_dir = None
+        
+        if 'profile directory' in tracing_dict:
+            profile_dir = enforcedLocalPath(tracing_dict['profile directory'], dirpath, 'Profile directory')
+        
+        Tracing.configure(float(tracing_dict.get('slow', 1)), exporter,
+                          float(tracing_dict.get('profile', 0)), profile_dir)
+    
     if 'logging' in config_dict:
         level = config_dict['logging'].upper()
     
@@ -295,7 +338,7 @@ def _parseConfigfileCache(cache_dict, dirpath):
             if 'umask' in cache_dict:
                 kwargs['umask'] = int(cache_dict['umask'], 8)
             
-            add_kwargs('dirs', 'gzip')
+            add_kwargs('dirs', 'gzip', 'dedupe')
         
         elif _class is Caches.Multi:
             kwargs['tiers'] = [_parseConfigfileCache(tier_dict, dirpath)
@@ -305,12 +348,25 @@ def _parseConfigfileCache(cache_dict, dirpath):
             if 'key prefix' in cache_dict:
                 kwargs['key_prefix'] = cache_dict['key prefix']
         
+            if 'socket timeout' in cache_dict:
+                kwargs['socket_timeout'] = float(cache_dict['socket timeout'])
+        
+            if 'dead retry' in cache_dict:
+                kwargs['dead_retry'] = int(cache_dict['dead retry'])
+        
             add_kwargs('servers', 'lifespan', 'revision')
 
         elif _class is Caches.Redis.Cache:
             if 'key prefix' in cache_dict:
                 kwargs['key_prefix'] = cache_dict['key prefix']
 
+            if 'max connections' in cache_dict:
+                kwargs['max_connections'] = int(cache_dict['max connections'])
+
+            for key in ('socket timeout', 'connect timeout', 'pool timeout'):
+                if key in cache_dict:
+                    kwargs[key.replace(' ', '_')] = float(cache_dict[key])
+
             add_kwargs('host', 'port', 'db')
     
         elif _class is Caches.S3.Cache:
@@ -328,6 +384,19 @@ def _parseConfigfileCache(cache_dict, dirpath):
         raise Exception('Missing required cache name or class: %s' % json_dumps(cache_dict))
 
     cache = _class(**kwargs)
+    
+    if cache_dict.get('write behind', False):
+        write_behind = cache_dict['write behind']
+        kwargs = {}
+        
+        if type(write_behind) is dict:
+            if 'max bytes' in write_behind:
+                kwargs['max_bytes'] = int(write_behind['max bytes'])
+            
+            if 'workers' in write_behind:
+                kwargs['workers'] = int(write_behind['workers'])
+        
+        cache = Caches.WriteBehind(cache, **kwargs)
 
     return cache
 
@@ -361,6 +430,9 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     if 'cache lifespan' in layer_dict:
         layer_kwargs['cache_lifespan'] = int(layer_dict['cache lifespan'])
     
+    if 'stale while revalidate' in layer_dict:
+        layer_kwargs['stale_while_revalidate'] = int(layer_dict['stale while revalidate'])
+    
     if 'stale lock timeout' in layer_dict:
         layer_kwargs['stale_lock_timeout'] = int(layer_dict['stale lock timeout'])
     
@@ -379,6 +451,16 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     if 'tile height' in layer_dict:
         layer_kwargs['tile_height'] = int(layer_dict['tile height'])
     
+    if 'recent tiles' in layer_dict:
+        recent_dict = layer_dict['recent tiles']
+        recent_kwargs = {}
+        
+        for (key, func) in zip(('size', 'lifespan'), (int, float)):
+            if key in recent_dict:
+                recent_kwargs[key] = func(recent_dict[key])
+        
+        layer_kwargs['recent_tiles'] = Core.RecentTiles(**recent_kwargs)
+    
     if 'preview' in layer_dict:
         preview_dict = layer_dict['preview']
         
@@ -19,6 +19,7 @@ configuration file as a dictionary:
           "projection": ...,
           "stale lock timeout": ...,
           "cache lifespan": ...,
+          "stale while revalidate": ...,
           "write cache": ...,
           "bounds": { ... },
           "allowed origin": ...,
@@ -26,7 +27,8 @@ configuration file as a dictionary:
           "redirects": ...,
           "tile height": ...,
           "jpeg options": ...,
-          "png options": ...
+          "png options": ...,
+          "recent tiles": { ... }
         }
       }
     }
@@ -47,6 +49,10 @@ configuration file as a dictionary:
 - "cache lifespan" is an optional number of seconds that cached tiles should
   be stored. This is defined on a per-layer basis. Defaults to forever if None,
   0 or omitted.
+- "stale while revalidate" is an optional number of seconds past the cache
+  lifespan during which an expired tile is still returned, with Age and
+  Warning headers, while a background thread renders it again. Needs a cache
+  with a read_stale() method, see TileStache.Caches. Defaults to none.
 - "write cache" is an optional boolean value to allow skipping cache write
   altogether. This is defined on a per-layer basis. Defaults to true if omitted.
 - "bounds" is an optional dictionary of six tile boundaries to limit the
@@ -73,6 +79,10 @@ configuration file as a dictionary:
   through to PIL: http://effbot.org/imagingbook/format-jpeg.htm.
 - "png options" is an optional dictionary of PNG creation options, passed
   through to PIL: http://effbot.org/imagingbook/format-png.htm.
+- "recent tiles" is an optional dictionary with "size" in bytes and "lifespan"
+  in seconds for an in-memory store of this layer's recently-used tiles, which
+  also holds the rest of each rendered metatile. Without it, layers share one
+  store of 32MB with a five-minute lifespan. Set "size" to 0 to turn it off.
 
 The public-facing URL of a single tile for this layer might look like this:
 
@@ -93,6 +103,13 @@ Sample PNG creation options:
       "palette": "filename.act"
     }
 
+Sample recent tiles:
+
+    {
+      "size": 67108864,
+      "lifespan": 60
+    }
+
 Sample bounds:
 
     {
@@ -138,8 +155,17 @@ from wsgiref.headers import Headers
 from StringIO import StringIO
 from urlparse import urljoin
 from time import time
+from threading import Lock, Event, Thread
+from Queue import Queue
+from os import getpid
+from collections import OrderedDict
+from weakref import WeakSet
+from hashlib import md5
+from email.utils import formatdate
 
 from Pixels import load_palette, apply_palette, apply_palette256
+import Metrics
+import Tracing
 
 try:
     from PIL import Image
@@ -148,59 +174,286 @@ except ImportError:
 
 from ModestMaps.Core import Coordinate
 
-_recent_tiles = dict(hash={}, list=[])
+class RecentTiles:
+    """ Thread-safe, size-limited store of recently-used tile bodies.
+    
+        Tiles are forgotten after lifespan seconds, or sooner when the
+        total size of all bodies exceeds size bytes, least-recently
+        used first. Counts of hits, misses, and evictions are kept
+        in stats().
+    """
+    def __init__(self, size=0x2000000, lifespan=300):
+        self.size = int(size)
+        self.lifespan = lifespan
+        
+        self._tiles = OrderedDict()
+        self._lock = Lock()
+        self._bytes = 0
+        
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+        
+        _recent_tiles_stores.add(self)
+    
+    def get(self, key):
+        """ Return the body of a recent tile, or None if it's not there.
+        """
+        with self._lock:
+            body, use_by = self._tiles.pop(key, (None, 0))
+            
+            if body is None:
+                self.misses += 1
+                return None
+            
+            if time() >= use_by:
+                # too old
+                self._bytes -= len(body)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            
+            # move to the most-recently-used end
+            self._tiles[key] = body, use_by
+            self.hits += 1
+            return body
+    
+    def put(self, key, body, age=None):
+        """ Add the body of a tile with a timeout, default self.lifespan.
+        """
+        if body is None or self.size <= 0 or len(body) > self.size:
+            return
+        
+        due = time() + (self.lifespan if age is None else age)
+        
+        with self._lock:
+            old_body, old_due = self._tiles.pop(key, (None, 0))
+            
+            if old_body is not None:
+                self._bytes -= len(old_body)
+            
+            self._tiles[key] = body, due
+            self._bytes += len(body)
+            
+            # expired tiles are dropped on the way to the oldest one that fits.
+            while self._bytes > self.size or self._expiredFirst():
+                old_key, (old_body, old_due) = self._tiles.popitem(last=False)
+                self._bytes -= len(old_body)
+                
+                if time() >= old_due:
+                    self.expirations += 1
+                else:
+                    self.evictions += 1
+    
+    def discard(self, key):
+        """ Forget a tile, if it's there.
+        """
+        with self._lock:
+            body, use_by = self._tiles.pop(key, (None, 0))
+            
+            if body is not None:
+                self._bytes -= len(body)
+    
+    def _expiredFirst(self):
+        """ True if the least-recently used tile is too old, call with lock held.
+        """
+        for (body, due) in self._tiles.itervalues():
+            return time() >= due
+        
+        return False
+    
+    def stats(self):
+        """ Return a dictionary of counts and sizes.
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        expirations=self.expirations, tiles=len(self._tiles),
+                        bytes=self._bytes, size=self.size)
+
+# every RecentTiles instance, for metrics.
+_recent_tiles_stores = WeakSet()
+
+# shared by all layers without their own "recent tiles" configuration.
+_recent_tiles = RecentTiles()
 
-def _addRecentTile(layer, coord, format, body, age=300):
-    """ Add the body of a tile to _recent_tiles with a timeout.
+Metrics.declare('tilestache_recent_tiles', 'gauge', 'Tiles in recent tiles.')
+Metrics.declare('tilestache_recent_tiles_bytes', 'gauge', 'Size of tiles in recent tiles.')
+Metrics.declare('tilestache_recent_tiles_reads_total', 'counter', 'Reads from recent tiles.')
+Metrics.declare('tilestache_recent_tiles_removed_total', 'counter', 'Tiles removed from recent tiles.')
+
+@Metrics.collector
+def _recentTilesMetrics():
+    """ Return recent tiles gauges for Metrics, added up over every store.
     """
-    key = (layer, coord, format)
-    due = time() + age
+    gauges = []
+    
+    for store in list(_recent_tiles_stores):
+        stats = store.stats()
+        gauges += [('tilestache_recent_tiles', {}, stats['tiles']),
+                   ('tilestache_recent_tiles_bytes', {}, stats['bytes']),
+                   ('tilestache_recent_tiles_reads_total', dict(result='hit'), stats['hits']),
+                   ('tilestache_recent_tiles_reads_total', dict(result='miss'), stats['misses']),
+                   ('tilestache_recent_tiles_removed_total', dict(reason='evicted'), stats['evictions']),
+                   ('tilestache_recent_tiles_removed_total', dict(reason='expired'), stats['expirations'])]
     
-    _recent_tiles['hash'][key] = body, due
-    _recent_tiles['list'].append((key, due))
+    return gauges
+
+def _addRecentTile(layer, coord, format, body, age=None):
+    """ Add the body of a tile to the layer's recent tiles with a timeout.
+    """
+    key = (layer, coord, format)
+    layer.recent_tiles.put(key, body, age)
     
     logging.debug('TileStache.Core._addRecentTile() added tile to recent tiles: %s', key)
+
+def _getRecentTile(layer, coord, format):
+    """ Return the body of a recent tile, or None if it's not there.
+    """
+    key = (layer, coord, format)
+    body = layer.recent_tiles.get(key)
+    
+    if body is not None:
+        logging.debug('TileStache.Core._getRecentTile() found tile in recent tiles: %s', key)
+    
+    return body
+
+class _Flight:
+    """ One render of a metatile in progress, for other threads to wait on.
+    
+        Properties:
+        - done: Event set when the render is finished, successfully or not.
+        - bodies: dictionary of tile bodies by coordinate from the render.
+    """
+    def __init__(self):
+        self.done = Event()
+        self.bodies = {}
+
+# renders in progress, keyed on (layer, first coordinate, format).
+_flights = {}
+_flights_lock = Lock()
+
+def _startFlight(key):
+    """ Return a flight for a key, and True if the caller should lead it.
+    
+        Followers should wait for flight.done and then look in flight.bodies.
+    """
+    with _flights_lock:
+        if key in _flights:
+            return _flights[key], False
+        
+        flight = _flights[key] = _Flight()
+        return flight, True
+
+def _endFlight(key, flight):
+    """ Finish a flight and wake up its followers.
+    """
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
     
-    # now look at the oldest keys and remove them if needed
-    for (key, due_by) in _recent_tiles['list']:
-        # new enough?
-        if time() < due_by:
-            break
+    flight.done.set()
+
+def _addFlightTiles(layer, coords, format, bodies):
+    """ Make rendered tile bodies available to threads waiting for the metatile.
+    """
+    flight = _flights.get((layer, layer.metatile.firstCoord(coords[0]), format))
+    
+    if flight is not None:
+        flight.bodies.update(zip(coords, bodies))
+
+# metatiles waiting to be rendered again, keyed on (layer, first coordinate, extension).
+_revalidations = dict(pid=None, queue=None, keys=set())
+_revalidations_lock = Lock()
+
+def _revalidateTile(layer, coord, extension):
+    """ Render a stale tile again in the background, once per metatile.
+    """
+    key = (layer, layer.metatile.firstCoord(coord), extension)
+    
+    with _revalidations_lock:
+        if _revalidations['pid'] != getpid():
+            # a single worker thread for each process.
+            _revalidations.update(pid=getpid(), queue=Queue(), keys=set())
+            worker = Thread(target=_revalidationWorker, args=(_revalidations['queue'], _revalidations['keys']))
+            worker.daemon = True
+            worker.start()
         
-        logging.debug('TileStache.Core._addRecentTile() removed tile from recent tiles: %s', key)
+        if key in _revalidations['keys']:
+            return
         
-        try:
-            _recent_tiles['list'].remove((key, due_by))
-        except ValueError:
-            pass
+        _revalidations['keys'].add(key)
+        _revalidations['queue'].put((key, coord))
+
+def _revalidationWorker(queue, keys):
+    """ Render tiles from a queue of (key, coord) tuples, see _revalidateTile().
+    """
+    while True:
+        key, coord = queue.get()
+        layer, extension = key[0], key[2]
         
         try:
-            del _recent_tiles['hash'][key]
-        except KeyError:
-            pass
+            mimetype, format = layer.getTypeByExtension(extension)
+            
+            # don't let an older copy of the metatile stand in for a new render.
+            for other in layer.metatile.allCoords(coord):
+                layer.recent_tiles.discard((layer, other, format))
+            
+            layer.getTileResponse(coord, extension, ignore_cached=True)
+        
+        except:
+            logging.exception('TileStache.Core._revalidationWorker() failed to render %s/%d/%d/%d.%s', layer.name(), coord.zoom, coord.column, coord.row, extension)
+        
+        finally:
+            with _revalidations_lock:
+                keys.discard(key)
 
-def _getRecentTile(layer, coord, format):
-    """ Return the body of a recent tile, or None if it's not there.
+def _readMany(cache, layer, coords, format):
+    """ Read a list of tiles from a cache, return a list of bodies.
+    
+        Uses the optional cache.read_many() method where there is one and
+        falls back to one cache.read() per tile. Missing tiles are None.
     """
-    key = (layer, coord, format)
-    body, use_by = _recent_tiles['hash'].get(key, (None, 0))
+    if hasattr(cache, 'read_many'):
+        return cache.read_many(layer, coords, format)
     
-    # non-existent?
-    if body is None:
-        return None
+    return [cache.read(layer, coord, format) for coord in coords]
+
+def _saveMany(cache, bodies, layer, coords, format):
+    """ Save a list of tile bodies to a cache.
+    
+        Uses the optional cache.save_many() method where there is one and
+        falls back to one cache.save() per tile.
+    """
+    if hasattr(cache, 'save_many'):
+        return cache.save_many(bodies, layer, coords, format)
+    
+    for (body, coord) in zip(bodies, coords):
+        cache.save(body, layer, coord, format)
+
+def _tileETag(body):
+    """ Return a strong ETag header value for a tile body, from its MD5 hash.
     
-    # new enough?
-    if time() < use_by:
-        logging.debug('TileStache.Core._addRecentTile() found tile in recent tiles: %s', key)
-        return body
+        S3 uses the same hash for its own ETags.
+    """
+    return '"%s"' % md5(body).hexdigest()
+
+def _fileETag(stat):
+    """ Return a weak ETag header value for a tile file, from its os.stat().
+    
+        A replaced tile file has a new inode, size or modification time, so
+        there's no need to read the file and hash it.
+    """
+    return 'W/"%x-%x-%x"' % (stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000))
+
+def _cacheETag(cache, layer, coord, format):
+    """ Return the ETag of a tile in a cache that keeps tiles in files, or None.
     
-    # too old
-    try:
-        del _recent_tiles['hash'][key]
-    except KeyError:
-        pass
+        WSGITileServer sends such tiles straight from their files with the
+        ETag from the cache's read_info(), so responses made here use it too.
+    """
+    if not hasattr(cache, 'read_file') or not hasattr(cache, 'read_info'):
+        return None
     
-    return None
+    info = cache.read_info(layer, coord, format)
+    return info and info[0]
 
 class Metatile:
     """ Some basic characteristics of a metatile.
@@ -278,6 +531,10 @@ class Layer:
           cache_lifespan:
             Number of seconds that cached tiles should be stored, default 15.
 
+          stale_while_revalidate:
+            Number of seconds after cache_lifespan that expired tiles may
+            be returned while being rendered again in the background.
+
           write_cache:
             Allow skipping cache write altogether, default true.
 
@@ -309,8 +566,12 @@ class Layer:
             Height of tile in pixels, as a single integer. Tiles are generally
             assumed to be square, and Layer.render() will respond with an error
             if the rendered image is not this height.
+
+          recent_tiles:
+            Instance of RecentTiles for tiles recently rendered or read,
+            default shared with other layers.
     """
-    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256):
+    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256, recent_tiles=None, stale_while_revalidate=None):
         self.provider = None
         self.config = config
         self.projection = projection
@@ -318,6 +579,7 @@ class Layer:
         
         self.stale_lock_timeout = stale_lock_timeout
         self.cache_lifespan = cache_lifespan
+        self.stale_while_revalidate = stale_while_revalidate
         self.write_cache = write_cache
         self.allowed_origin = allowed_origin
         self.max_cache_age = max_cache_age
@@ -330,6 +592,7 @@ class Layer:
         
         self.bounds = bounds
         self.dim = tile_height
+        self.recent_tiles = _recent_tiles if recent_tiles is None else recent_tiles
         
         self.bitmap_palette = None
         self.jpeg_options = {}
@@ -358,6 +621,16 @@ class Layer:
         
             This is the main entry point, after site configuration has been loaded
             and individual tiles need to be rendered.
+            
+            Each phase of the response is timed with TileStache.Tracing.
+        """
+        tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
+        
+        with Tracing.trace('getTileResponse', layer=self.name(), tile=tile, extension=extension):
+            return self._getTileResponse(coord, extension, ignore_cached, suppress_cache_write)
+    
+    def _getTileResponse(self, coord, extension, ignore_cached, suppress_cache_write):
+        """ Get status code, headers, and a tile binary, see getTileResponse().
         """
         start_time = time()
         
@@ -369,11 +642,14 @@ class Layer:
         body = None
 
         cache = self.config.cache
+        in_cache = False
 
         if not ignore_cached:
             # Start by checking for a tile in the cache.
             try:
-                body = cache.read(self, coord, format)
+                with Tracing.span('cache.read'):
+                    body = cache.read(self, coord, format)
+                    in_cache = body is not None
             except TheTileLeftANote, e:
                 headers = e.headers
                 status_code = e.status_code
@@ -389,6 +665,34 @@ class Layer:
             body = _getRecentTile(self, coord, format)
             tile_from = 'recent tiles'
         
+        stale = False
+        
+        if body is None and not ignore_cached and self.cache_lifespan and self.stale_while_revalidate:
+            # An expired tile may do while a fresh one is rendered.
+            with Tracing.span('cache.read_stale'):
+                found = hasattr(cache, 'read_stale') and cache.read_stale(self, coord, format)
+            
+            if found and found[1] <= self.cache_lifespan + self.stale_while_revalidate:
+                body, age = found
+                headers['Age'] = '%d' % age
+                headers['Warning'] = '110 - "Response is Stale"'
+                headers['Last-Modified'] = formatdate(time() - age, usegmt=True)
+                tile_from, stale = 'stale cache', True
+                _revalidateTile(self, coord, extension)
+        
+        flight = None
+
+        if body is None and not ignore_cached:
+            # Another thread here might be rendering this metatile already.
+            flight_key = (self, self.metatile.firstCoord(coord), format)
+            flight, leading = _startFlight(flight_key)
+            
+            if not leading:
+                with Tracing.span('another thread'):
+                    flight.done.wait(self.stale_lock_timeout)
+                body, flight = flight.bodies.get(coord), None
+                tile_from = 'another thread'
+        
         # If no tile was found, dig deeper
         if body is None:
             try:
@@ -399,24 +703,34 @@ class Layer:
                     lockCoord = self.metatile.firstCoord(coord)
                     
                     # We may need to write a new tile, so acquire a lock.
-                    cache.lock(self, lockCoord, format)
+                    with Tracing.span('cache.lock'):
+                        cache.lock(self, lockCoord, format)
                 
                 if not ignore_cached:
                     # There's a chance that some other process has
                     # written the tile while the lock was being acquired.
-                    body = cache.read(self, coord, format)
+                    with Tracing.span('cache.read'):
+                        body = cache.read(self, coord, format)
+                        in_cache = body is not None
                     tile_from = 'cache after all'
         
                 if body is None:
                     # No one else wrote the tile, do it here.
                     buff = StringIO()
 
+                    render_start = time()
+                    Metrics.add('tilestache_renders_in_progress', 1, layer=Metrics.layer_label(self.name()))
+                    
                     try:
-                        tile = self.render(coord, format)
+                        with Tracing.span('render'):
+                            tile = self.render(coord, format)
                         save = True
                     except NoTileLeftBehind, e:
                         tile = e.tile
                         save = False
+                    finally:
+                        Metrics.add('tilestache_renders_in_progress', -1, layer=Metrics.layer_label(self.name()))
+                        Metrics.observe('tilestache_render_seconds', time() - render_start, layer=Metrics.layer_label(self.name()), zoom=str(coord.zoom))
 
                     if suppress_cache_write or (not self.write_cache):
                         save = False
@@ -428,13 +742,20 @@ class Layer:
                     else:
                         save_kwargs = {}
                     
-                    tile.save(buff, format, **save_kwargs)
-                    body = buff.getvalue()
+                    with Tracing.span('tile.save'):
+                        tile.save(buff, format, **save_kwargs)
+                        body = buff.getvalue()
                     
                     if save:
-                        cache.save(body, self, coord, format)
+                        with Tracing.span('cache.save'):
+                            cache.save(body, self, coord, format)
+                            in_cache = True
 
+                    headers['Last-Modified'] = formatdate(time(), usegmt=True)
                     tile_from = 'layer.render()'
+                
+                if flight is not None:
+                    flight.bodies[coord] = body
 
             except TheTileLeftANote, e:
                 headers = e.headers
@@ -447,10 +768,23 @@ class Layer:
             finally:
                 if lockCoord:
                     # Always clean up a lock when it's no longer being used.
-                    cache.unlock(self, lockCoord, format)
+                    with Tracing.span('cache.unlock'):
+                        cache.unlock(self, lockCoord, format)
+                
+                if flight is not None:
+                    # Let any waiting threads have the tiles.
+                    _endFlight(flight_key, flight)
+        
+        if not stale:
+            _addRecentTile(self, coord, format, body)
+        
+        if status_code == 200 and body is not None:
+            # lets clients and caches ask for the tile only if it's changed.
+            etag = in_cache and _cacheETag(cache, self, coord, format)
+            headers.setdefault('ETag', etag or _tileETag(body))
         
-        _addRecentTile(self, coord, format, body)
         logging.info('TileStache.Core.Layer.getTileResponse() %s/%d/%d/%d.%s via %s in %.3f', self.name(), coord.zoom, coord.column, coord.row, extension, tile_from, time() - start_time)
+        Metrics.observe('tilestache_tile_seconds', time() - start_time, layer=Metrics.layer_label(self.name()), zoom=str(coord.zoom), source=tile_from)
         
         return status_code, headers, body
 
@@ -493,12 +827,15 @@ class Layer:
         
         if self.doMetatile() or hasattr(provider, 'renderArea'):
             # draw an area, defined in projected coordinates
-            tile = provider.renderArea(width, height, srs, xmin, ymin, xmax, ymax, coord.zoom)
+            with Tracing.span('provider.renderArea'):
+                tile = provider.renderArea(width, height, srs, xmin, ymin, xmax, ymax, coord.zoom)
         
         elif hasattr(provider, 'renderTile'):
             # draw a single tile
             width, height = self.dim, self.dim
-            tile = provider.renderTile(width, height, srs, coord)
+            
+            with Tracing.span('provider.renderTile'):
+                tile = provider.renderTile(width, height, srs, coord)
 
         else:
             raise KnownUnknown('Your provider lacks renderTile and renderArea methods.')
@@ -517,11 +854,14 @@ class Layer:
 
             if format.lower() == 'png':
                 t_index = self.png_options.get('transparency', None)
-                tile = apply_palette(tile, self.bitmap_palette, t_index)
+                
+                with Tracing.span('apply_palette'):
+                    tile = apply_palette(tile, self.bitmap_palette, t_index)
         
         if self.doMetatile():
             # tile will be set again later
             tile, surtile = None, tile
+            others, bodies = [], []
             
             for (other, x, y) in subtiles:
                 buff = StringIO()
@@ -529,19 +869,28 @@ class Layer:
                 subtile = surtile.crop(bbox)
                 if self.palette256:
                     # this is where we have PIL optimally palette our image
-                    subtile = apply_palette256(subtile)
+                    with Tracing.span('apply_palette256'):
+                        subtile = apply_palette256(subtile)
                 
-                subtile.save(buff, format)
-                body = buff.getvalue()
+                with Tracing.span('subtile.save'):
+                    subtile.save(buff, format)
+                    body = buff.getvalue()
 
-                if self.write_cache:
-                    self.config.cache.save(body, self, other, format)
+                others.append(other)
+                bodies.append(body)
                 
                 if other == coord:
                     # the one that actually gets returned
                     tile = subtile
                 
                 _addRecentTile(self, other, format, body)
+            
+            _addFlightTiles(self, others, format, bodies)
+            
+            if self.write_cache:
+                # one round-trip for the whole metatile, where possible.
+                with Tracing.span('cache.save_many'):
+                    _saveMany(self.config.cache, bodies, self, others, format)
         
         return tile
     
@@ -0,0 +1,382 @@
+""" Cache that packs square blocks of tiles into single bundle files.
+
+A deep seed into the Disk cache makes one file per tile, and hundreds of
+millions of small files run filesystems out of inodes and make copying or
+removing a cache very slow. This cache keeps size x size neighboring tiles of
+one zoom level in a single bundle file instead, so a 16x16 bundle holds up to
+256 tiles.
+
+Example TileStache cache configuration, with 16x16 bundles:
+
+"cache":
+{
+    "class": "TileStache.Goodies.Caches.Bundle:Cache",
+    "kwargs": {
+        "path": "/tmp/bundle-cache",
+        "size": 16
+    }
+}
+
+Bundle cache parameters:
+
+  path
+    Required local directory path where bundles should be stored.
+
+  size
+    Optional number of tile rows and columns in each bundle, 16 by default.
+    Don't change it for an existing cache.
+
+  umask
+    Optional permission mask for stored files, as in the Disk cache.
+
+  dirs
+    Optional directory layout for bundles, "safe", "portable" or "quadtile"
+    as in the Disk cache, applied to the row and column of each bundle.
+
+Each bundle file starts with a fixed-size header: the magic string
+"TSBUNDLE", a format version and the bundle size, followed by an index with
+one 16-byte entry per tile, in row-major order. An entry holds the offset and
+length of the tile body in the file and the time it was saved, all
+little-endian, with a zero offset for a missing tile. Tile bodies follow the
+index in the order they were saved.
+
+A new bundle is written with its header and empty index to a temporary file
+and then linked into place, so it never exists without them. Saving appends
+tile bodies to the end of the bundle and then updates their index entries,
+holding an exclusive flock() on the bundle file so that one writer at a time
+changes it. A replaced or removed tile leaves its old body
+behind, and a bundle is compacted into a new file once more than half of it
+is unused. Reading takes no lock: each read opens the bundle with its own
+descriptor, so readers never share a file offset, and a reader sees either
+the old or the new index entry of a tile being saved.
+
+Render locks are taken per tile, with lock files next to each bundle, just
+like the Disk cache.
+"""
+
+import os
+import time
+
+from struct import Struct
+from tempfile import mkstemp
+from os.path import dirname
+
+from ModestMaps.Core import Coordinate
+
+from TileStache.Caches import Disk
+from TileStache.Core import KnownUnknown
+
+try:
+    from fcntl import flock, LOCK_EX
+except ImportError:
+    # no file locks on this platform.
+    flock = None
+
+_magic, _version = 'TSBUNDLE', 1
+
+_header = Struct('<8sII')
+_entry = Struct('<QII')
+
+class Cache(Disk):
+
+    def __init__(self, path, size=16, umask=0022, dirs='safe'):
+        Disk.__init__(self, path, umask, dirs, gzip=[])
+        self.size = int(size)
+        self.index_length = _header.size + _entry.size * self.size * self.size
+
+        if flock is None:
+            raise KnownUnknown('Bundle cache needs file locks, which this platform lacks.')
+
+    def _bundlepath(self, layer, coord, format):
+        """ Return the full path of the bundle for a tile.
+        """
+        bundle = Coordinate(int(coord.row) // self.size, int(coord.column) // self.size, coord.zoom)
+        return self._fullpath(layer, bundle, format) + '.bundle'
+
+    def _position(self, coord):
+        """ Return the file position of a tile's index entry.
+        """
+        row, column = int(coord.row) % self.size, int(coord.column) % self.size
+        return _header.size + _entry.size * (row * self.size + column)
+
+    def _lockpath(self, layer, coord, format):
+        """ Return the path of a tile's render lock file, next to its bundle.
+        """
+        return '%s.%d-%d.lock' % (self._bundlepath(layer, coord, format), coord.column, coord.row)
+
+    def _groups(self, layer, coords, format):
+        """ Return a dictionary of bundle paths and lists of indexes into coords.
+        """
+        groups = {}
+
+        for (index, coord) in enumerate(coords):
+            bundlepath = self._bundlepath(layer, coord, format)
+            groups.setdefault(bundlepath, []).append(index)
+
+        return groups
+
+    def _open(self, bundlepath):
+        """ Open a bundle for reading, or return None if it doesn't exist.
+        """
+        try:
+            fd = os.open(bundlepath, os.O_RDONLY)
+        except OSError, e:
+            # errno=2 means that the bundle does not exist, which is fine
+            if e.errno != 2:
+                raise
+            return None
+
+        header = _read(fd, 0, _header.size)
+
+        if len(header) < _header.size:
+            # a bundle left empty by an interrupted writer has no tiles yet.
+            os.close(fd)
+            return None
+
+        magic, version, size = _header.unpack(header)
+
+        if (magic, version, size) != (_magic, _version, self.size):
+            os.close(fd)
+            raise KnownUnknown('"%s" is not a version %d bundle of size %d.' % (bundlepath, _version, self.size))
+
+        return fd
+
+    def _openlocked(self, bundlepath):
+        """ Open a bundle for writing, creating it if needed, with an exclusive lock.
+        """
+        while True:
+            try:
+                fd = os.open(bundlepath, os.O_RDWR)
+            except OSError, e:
+                if e.errno != 2:
+                    raise
+                self._create(bundlepath)
+                continue
+
+            flock(fd, LOCK_EX)
+
+            try:
+                if os.fstat(fd).st_ino == os.stat(bundlepath).st_ino:
+                    break
+            except OSError, e:
+                if e.errno != 2:
+                    raise
+
+            # another writer compacted the bundle into a new file, try that one.
+            os.close(fd)
+
+        if os.fstat(fd).st_size < self.index_length:
+            # left empty or short by an interrupted writer of an older version.
+            _write(fd, 0, self._emptyindex())
+
+        return fd
+
+    def _create(self, bundlepath):
+        """ Put a new bundle with an empty index in place, unless one already exists.
+
+            The bundle is written to a temporary file first and then linked
+            into place, so readers never see a bundle without its header.
+        """
+        handle, tmp_path = mkstemp(dir=dirname(bundlepath), suffix='.bundle')
+
+        try:
+            _write(handle, 0, self._emptyindex())
+        finally:
+            os.close(handle)
+
+        try:
+            os.chmod(tmp_path, 0666&~self.umask)
+            os.link(tmp_path, bundlepath)
+        except OSError, e:
+            # errno=17 means that another writer created the bundle first, which is fine
+            if e.errno != 17:
+                raise
+        finally:
+            os.unlink(tmp_path)
+
+    def _emptyindex(self):
+        """ Return the header and index of a bundle with no tiles.
+        """
+        return _header.pack(_magic, _version, self.size) + '\0' * (self.index_length - _header.size)
+
+    def _readentries(self, fd, coords):
+        """ Return a list of (offset, length, saved) index entries for coords.
+        """
+        entries = [_read(fd, self._position(coord), _entry.size) for coord in coords]
+
+        # a short index has no entries past its end, so those tiles are missing.
+        return [len(entry) == _entry.size and _entry.unpack(entry) or (0, 0, 0) for entry in entries]
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        bundlepath = self._bundlepath(layer, coord, format)
+
+        if not os.path.exists(bundlepath):
+            return
+
+        fd = self._openlocked(bundlepath)
+
+        try:
+            _write(fd, self._position(coord), _entry.pack(0, 0, 0))
+        finally:
+            os.close(fd)
+
+    def _readbodies(self, layer, coords, format, lifespan):
+        """ Return a list of (body, age) tuples for coords, or None for each missing tile.
+
+            Each bundle is opened just once.
+        """
+        results = [None] * len(coords)
+
+        for (bundlepath, indexes) in self._groups(layer, coords, format).items():
+            fd = self._open(bundlepath)
+
+            if fd is None:
+                continue
+
+            try:
+                entries = self._readentries(fd, [coords[i] for i in indexes])
+
+                for (i, (offset, length, saved)) in zip(indexes, entries):
+                    age = time.time() - saved
+
+                    if offset == 0 or (lifespan and age > lifespan):
+                        continue
+
+                    results[i] = _read(fd, offset, length), age
+            finally:
+                os.close(fd)
+
+        return results
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        return self.read_many(layer, [coord], format)[0]
+
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles.
+        """
+        results = self._readbodies(layer, coords, format, layer.cache_lifespan)
+        return [result and result[0] for result in results]
+
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        """
+        return self._readbodies(layer, [coord], format, None)[0]
+
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+
+            Bundles have no room for a hash, so the etag is always None.
+        """
+        fd = self._open(self._bundlepath(layer, coord, format))
+
+        if fd is None:
+            return None
+
+        try:
+            offset, length, saved = self._readentries(fd, [coord])[0]
+        finally:
+            os.close(fd)
+
+        if offset == 0:
+            return None
+
+        if layer.cache_lifespan and time.time() - saved > layer.cache_lifespan:
+            return None
+
+        return None, saved
+
+    def read_file(self, layer, coord, format):
+        """ Tiles are not files of their own, so they always have to be read().
+        """
+        return None
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        self.save_many([body], layer, [coord], format)
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles.
+
+            Tiles in the same bundle are appended together under one lock.
+        """
+        for (bundlepath, indexes) in self._groups(layer, coords, format).items():
+            self._makedirs(dirname(bundlepath))
+            fd = self._openlocked(bundlepath)
+
+            try:
+                self._append(fd, bundlepath, [bodies[i] for i in indexes], [coords[i] for i in indexes])
+            finally:
+                os.close(fd)
+
+    def _append(self, fd, bundlepath, bodies, coords):
+        """ Append tile bodies to a locked bundle, then point the index at them.
+        """
+        offset, saved = os.fstat(fd).st_size, int(time.time())
+        _write(fd, offset, ''.join(bodies))
+
+        for (body, coord) in zip(bodies, coords):
+            _write(fd, self._position(coord), _entry.pack(offset, len(body), saved))
+            offset += len(body)
+
+        index = _read(fd, 0, self.index_length)
+        entries = [_entry.unpack_from(index, position) for position in range(_header.size, self.index_length, _entry.size)]
+        used = sum([length for (o, length, s) in entries if o])
+
+        if offset - self.index_length > used * 2:
+            self._compact(fd, bundlepath, index, entries)
+
+    def _compact(self, fd, bundlepath, index, entries):
+        """ Replace a locked bundle with a new file holding only its current tiles.
+        """
+        handle, tmp_path = mkstemp(dir=dirname(bundlepath), suffix='.bundle')
+
+        try:
+            new_entries, offset = [], self.index_length
+
+            for (position, (old_offset, length, saved)) in zip(range(_header.size, self.index_length, _entry.size), entries):
+                if old_offset == 0:
+                    continue
+
+                _write(handle, offset, _read(fd, old_offset, length))
+                new_entries.append((position, _entry.pack(offset, length, saved)))
+                offset += length
+
+            _write(handle, 0, self._emptyindex())
+
+            for (position, entry) in new_entries:
+                _write(handle, position, entry)
+        finally:
+            os.close(handle)
+
+        os.chmod(tmp_path, 0666&~self.umask)
+        os.rename(tmp_path, bundlepath)
+
+def _read(fd, offset, length):
+    """ Read length bytes at offset, like pread() which Python 2 lacks.
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+    chunks = []
+
+    while length > 0:
+        chunk = os.read(fd, length)
+
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        length -= len(chunk)
+
+    return ''.join(chunks)
+
+def _write(fd, offset, data):
+    """ Write all of data at offset, like pwrite() which Python 2 lacks.
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+
+    while data:
+        data = data[os.write(fd, data):]
@@ -27,9 +27,12 @@ cache parameters:
     Required secret access key for your GS account.
 
 """
-from time import time
+from time import time, strptime
+from calendar import timegm
 from mimetypes import guess_type
 
+from TileStache import Locks
+
 
 # URI scheme for Google Cloud Storage.
 GOOGLE_STORAGE = 'gs'
@@ -72,13 +75,9 @@ class Cache:
             Returns nothing, but blocks until the lock has been acquired.
         """
         key_name = tile_key(layer, coord, format)
-        due = time() + layer.stale_lock_timeout
         
-        while time() < due:
-            if not self.bucket.get_key(key_name+'-lock'):
-                break
-            
-            _sleep(.2)
+        # Forced or not, the lock gets taken when the wait is over.
+        Locks.wait_for(lambda: not self.bucket.get_key(key_name+'-lock'), layer.stale_lock_timeout, .05, 1)
         
         key = self.bucket.new_key(key_name+'-lock')
         key.set_contents_from_string('locked.', {'Content-Type': 'text/plain'})
@@ -115,6 +114,40 @@ class Cache:
         
         return key.get_contents_as_string()
         
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        
+            Age is in seconds. Returns None if the tile isn't cached.
+        """
+        key_name = tile_key(layer, coord, format)
+        key = self.bucket.get_key(key_name)
+        
+        if key is None:
+            return None
+        
+        t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
+        
+        return key.get_contents_as_string(), time() - t
+        
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+        
+            Asks for the key's metadata without downloading the tile. The
+            ETag of a tile saved in one piece is the MD5 hash of its contents.
+        """
+        key_name = tile_key(layer, coord, format)
+        key = self.bucket.get_key(key_name)
+        
+        if key is None:
+            return None
+        
+        t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
+        
+        if layer.cache_lifespan and (time() - t) > layer.cache_lifespan:
+            return None
+        
+        return key.etag, t
+        
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
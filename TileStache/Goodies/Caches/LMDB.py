@@ -0,0 +1,334 @@
+""" Caches tiles in a local LMDB database.
+
+LMDB (http://symas.com/mdb/) is a B-tree database in a memory-mapped file. A
+tile lookup is a walk down the tree in memory, without the path building,
+stat() and open() calls of the Disk cache, and many processes can read at
+once while one at a time writes.
+
+Requires lmdb (0.84+):
+  http://pypi.python.org/pypi/lmdb
+
+Example configuration:
+
+  "cache": {
+    "class": "TileStache.Goodies.Caches.LMDB:Cache",
+    "kwargs": {
+      "path": "/tmp/stache.lmdb",
+      "limit": 1073741824
+    }
+  }
+
+LMDB cache parameters:
+
+  path
+    Required local directory for the database files.
+
+  limit
+    Optional number of bytes of tiles to keep. When a save goes over the
+    limit, the least recently used tiles are removed until the cache is
+    down to nine tenths of it. No limit by default.
+
+  map_size
+    Optional largest size of the database file in bytes, 4GB by default.
+    It must be above the limit. LMDB refuses to grow past it, and needs
+    free pages to copy even when removing tiles, so tiles are also removed
+    whenever the database pages in use go over a third of it. Tiles that
+    still don't fit are not saved, with a logged warning.
+
+Tiles are kept under keys like "layer/12/656/1582.png", with the time they
+were saved ahead of their contents. Each save is a single write transaction,
+so readers see a tile either whole or not at all. Each process notes when it
+reads tiles and records the times with its next save, so reads rarely wait on
+the writer: only when a few thousand times or a minute's worth have gone
+unrecorded are they written in a transaction of their own.
+"""
+from __future__ import absolute_import
+
+# We enabled absolute_import because case insensitive filesystems
+# cause this file to be loaded twice (the name of this file
+# conflicts with the name of the module we want to import).
+# Forcing absolute imports fixes the issue.
+
+import logging
+
+from os import getpid
+from time import time
+from struct import Struct
+from threading import Lock
+
+from TileStache import Locks
+from TileStache.Core import KnownUnknown
+
+try:
+    import lmdb
+except ImportError:
+    # at least we can build the documentation
+    pass
+
+# time a tile was saved ahead of its contents, or last used, or a lock goes stale.
+_time = Struct('<d')
+
+# total bytes of tiles.
+_size = Struct('<Q')
+
+# most tile read times to note, and seconds to go, before recording them.
+_max_touched, _touched_interval = 4096, 60
+
+def tile_key(layer, coord, format):
+    """ Return a tile key string.
+    """
+    name = layer.name()
+    tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
+    ext = format.lower()
+
+    return str('%(name)s/%(tile)s.%(ext)s' % locals())
+
+class Cache:
+    """
+    """
+    def __init__(self, path, limit=None, map_size=0x100000000):
+        self.path = path
+        self.limit = limit and int(limit)
+        self.map_size = int(map_size)
+
+        if self.limit and self.limit >= self.map_size:
+            raise KnownUnknown('LMDB cache limit must be below its map_size, %d.' % self.map_size)
+
+        self._env, self._pid = None, None
+        self._touched, self._touched_lock, self._recorded = {}, Lock(), time()
+
+    def _environment(self):
+        """ Return this process's LMDB environment and named databases.
+
+            LMDB environments can't be shared across a fork, so a child
+            process opens its own.
+        """
+        if self._pid != getpid():
+            env = lmdb.open(self.path, map_size=self.map_size, max_dbs=4, metasync=False)
+            dbs = [env.open_db(name) for name in ('tiles', 'used', 'meta', 'locks')]
+
+            self._env, self._dbs, self._pid = env, dbs, getpid()
+            self._touched = {}
+
+        return self._env, self._dbs
+
+    def _touch(self, keys):
+        """ Note that tiles were just read, for the next save to record.
+
+            Without a save for a while, the times are recorded here instead.
+        """
+        now = time()
+
+        with self._touched_lock:
+            for key in keys:
+                self._touched[key] = now
+
+            if len(self._touched) < _max_touched and now - self._recorded < _touched_interval:
+                return
+
+            touched, self._touched, self._recorded = self._touched, {}, now
+
+        env, (tiles, used, meta, locks) = self._environment()
+
+        try:
+            with env.begin(write=True) as txn:
+                self._record(txn, used, touched)
+
+        except lmdb.MapFullError:
+            # the cache can do without these times.
+            logging.warning('TileStache.Goodies.Caches.LMDB.Cache._touch() found %s full, increase its map_size', self.path)
+
+    def _record(self, txn, used, touched):
+        """ Record times when tiles were read in a write transaction.
+
+            Tiles removed since they were read are left out.
+        """
+        for (key, when) in touched.items():
+            if txn.get(key, db=used) is not None:
+                txn.put(key, _time.pack(when), db=used)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+            Lock is implemented as a key in the "locks" database, holding
+            the time when it goes stale.
+        """
+        env, (tiles, used, meta, locks) = self._environment()
+        key = tile_key(layer, coord, format)
+
+        def attempt():
+            with env.begin(write=True, db=locks) as txn:
+                due = txn.get(key)
+
+                if due is not None and _time.unpack(due)[0] > time():
+                    return False
+
+                txn.put(key, _time.pack(time() + layer.stale_lock_timeout))
+                return True
+
+        # Stale locks get overwritten in attempt(), so this always succeeds in the end.
+        while not Locks.wait_for(attempt, layer.stale_lock_timeout):
+            pass
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+        """
+        env, (tiles, used, meta, locks) = self._environment()
+
+        with env.begin(write=True, db=locks) as txn:
+            txn.delete(tile_key(layer, coord, format))
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        env, (tiles, used, meta, locks) = self._environment()
+        key = tile_key(layer, coord, format)
+
+        with env.begin(write=True) as txn:
+            old = txn.get(key, db=tiles)
+
+            if old is not None:
+                txn.delete(key, db=tiles)
+                txn.delete(key, db=used)
+                self._addSize(txn, meta, -len(old))
+
+    def _readValues(self, keys):
+        """ Return a list of (body, saved) tuples for tile keys, or None where missing.
+
+            Bodies are copied out of the memory map, everything else is read in place.
+        """
+        env, (tiles, used, meta, locks) = self._environment()
+        values = []
+
+        with env.begin(db=tiles, buffers=True) as txn:
+            for key in keys:
+                value = txn.get(key)
+
+                if value is None:
+                    values.append(None)
+                else:
+                    values.append((value[_time.size:], _time.unpack_from(value)[0]))
+
+        return values
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        return self.read_many(layer, [coord], format)[0]
+
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles in a single transaction.
+        """
+        keys = [tile_key(layer, coord, format) for coord in coords]
+        values, bodies = self._readValues(keys), []
+
+        for value in values:
+            if value is None or (layer.cache_lifespan and time() - value[1] > layer.cache_lifespan):
+                bodies.append(None)
+            else:
+                bodies.append(value[0])
+
+        self._touch([key for (key, body) in zip(keys, bodies) if body is not None])
+        return bodies
+
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        """
+        key = tile_key(layer, coord, format)
+        value = self._readValues([key])[0]
+
+        if value is None:
+            return None
+
+        self._touch([key])
+        return value[0], time() - value[1]
+
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+
+            Tiles are kept without a hash, so the etag is always None.
+        """
+        env, (tiles, used, meta, locks) = self._environment()
+
+        with env.begin(db=tiles, buffers=True) as txn:
+            value = txn.get(tile_key(layer, coord, format))
+            saved = value is not None and _time.unpack_from(value)[0]
+
+        if value is None or (layer.cache_lifespan and time() - saved > layer.cache_lifespan):
+            return None
+
+        return None, saved
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        self.save_many([body], layer, [coord], format)
+
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles in a single transaction.
+        """
+        env, (tiles, used, meta, locks) = self._environment()
+        now = time()
+
+        with self._touched_lock:
+            touched, self._touched, self._recorded = self._touched, {}, now
+
+        try:
+            with env.begin(write=True) as txn:
+                change = 0
+
+                for (body, coord) in zip(bodies, coords):
+                    key = tile_key(layer, coord, format)
+                    old = txn.get(key, db=tiles)
+                    change += len(body) + _time.size - (old is not None and len(old) or 0)
+
+                    txn.put(key, _time.pack(now) + body, db=tiles)
+                    txn.put(key, _time.pack(now), db=used)
+                    touched.pop(key, None)
+
+                self._record(txn, used, touched)
+
+                size = self._addSize(txn, meta, change)
+                excess = self.limit and size - self.limit * 9 // 10 or 0
+
+                # LMDB can't even delete in a full map, so stay well short of it.
+                pages = [txn.stat(db) for db in (tiles, used)]
+                pages = sum([p['psize'] * (p['branch_pages'] + p['leaf_pages'] + p['overflow_pages']) for p in pages])
+
+                if pages > self.map_size // 3:
+                    excess = max(excess, size - size * (self.map_size * 3 // 10) // pages)
+
+                if self.limit and size > self.limit or pages > self.map_size // 3:
+                    self._evict(txn, tiles, used, meta, excess)
+
+        except lmdb.MapFullError:
+            # the transaction was aborted, and the cache can do without these tiles.
+            logging.warning('TileStache.Goodies.Caches.LMDB.Cache.save_many() found %s full, increase its map_size', self.path)
+
+    def _addSize(self, txn, meta, change):
+        """ Add to the total bytes of tiles in a write transaction, return the total.
+        """
+        size = txn.get('size', db=meta)
+        size = max(0, (size is not None and _size.unpack(size)[0] or 0) + change)
+        txn.put('size', _size.pack(size), db=meta)
+
+        return size
+
+    def _evict(self, txn, tiles, used, meta, excess):
+        """ Remove least recently used tiles in a write transaction until excess bytes are gone.
+        """
+        cursor = txn.cursor(db=used)
+        oldest = sorted([(_time.unpack(when)[0], key) for (key, when) in cursor.iternext()])
+        removed = 0
+
+        for (when, key) in oldest:
+            if removed >= excess:
+                break
+
+            old = txn.get(key, db=tiles)
+            txn.delete(key, db=tiles)
+            txn.delete(key, db=used)
+            removed += old is not None and len(old) or 0
+
+        self._addSize(txn, meta, -removed)
@@ -14,6 +14,13 @@ Example TileStache cache configuration, with a 16MB limit:
         "limit": 16777216
     }
 }
+
+With "dedupe": true in kwargs, each distinct tile body is stored once in a
+".dedupe" directory named for its MD5 hash, and hard-linked into place like
+the Disk cache does. Stored bodies are tracked in a "bodies" table with a
+count of the tiles linked to them. Each body counts toward the limit once,
+until its last tile is removed. A body with as many links as the filesystem
+allows gets another stored copy, tracked and counted on its own.
 """
 
 import os
@@ -21,10 +28,13 @@ import sys
 import time
 
 from math import ceil as _ceil
+from hashlib import md5
 from tempfile import mkstemp
-from os.path import isdir, exists, dirname, basename, join as pathjoin
+from os.path import isdir, exists, dirname, basename, splitext, join as pathjoin
 from sqlite3 import connect, OperationalError, IntegrityError
 
+from TileStache.Caches import _link
+
 _create_tables = """
     CREATE TABLE IF NOT EXISTS locks (
         row     INTEGER,
@@ -42,21 +52,34 @@ _create_tables = """
     )
     """, """
     CREATE INDEX IF NOT EXISTS tiles_used ON tiles (used)
+    """, """
+    CREATE TABLE IF NOT EXISTS bodies (
+        path    TEXT PRIMARY KEY,
+        refs    INTEGER,
+        size    INTEGER
+    )
     """
 
 class Cache:
 
-    def __init__(self, path, limit, umask=0022):
+    def __init__(self, path, limit, umask=0022, dedupe=False):
         self.cachepath = path
         self.dbpath = pathjoin(self.cachepath, 'stache.db')
         self.umask = umask
         self.limit = limit
+        self.dedupe = bool(dedupe)
 
         db = connect(self.dbpath).cursor()
         
         for create_table in _create_tables:
             db.execute(create_table)
 
+        try:
+            # stored body of each tile with dedupe, missing from older databases.
+            db.execute('ALTER TABLE tiles ADD COLUMN body TEXT')
+        except OperationalError:
+            pass
+
         db.connection.close()
 
     def _filepath(self, layer, coord, format):
@@ -158,23 +181,63 @@ class Cache:
 
         return body
 
-    def _write(self, body, path, format):
-        """ Actually write the file to the cache directory, return its size.
+    def _storepath(self, body, format, generation=0):
+        """ Return the path of a tile body in the dedupe store.
         
-            If filesystem block size is known, try to return actual disk space used.
+            Later generations are further copies of a body whose earlier
+            copies have as many links as the filesystem allows.
         """
-        fullpath = pathjoin(self.cachepath, path)
+        hash = md5(body).hexdigest()
+        name = generation and '%s.%d' % (hash, generation) or hash
+        return os.sep.join( ('.dedupe', hash[:2], hash[2:4], name + '.' + format.lower()) )
 
+    def _makedirs(self, dirpath):
+        """
+        """
         try:
             umask_old = os.umask(self.umask)
-            os.makedirs(dirname(fullpath), 0777&~self.umask)
+            os.makedirs(dirpath, 0777&~self.umask)
         except OSError, e:
             if e.errno != 17:
                 raise
         finally:
             os.umask(umask_old)
 
-        fh, tmp_path = mkstemp(dir=self.cachepath, suffix='.' + format.lower())
+    def _write(self, body, path, format):
+        """ Actually write the file to the cache directory.
+        
+            Returns the size of the file and the path of its stored body with
+            dedupe, or None. A linked tile's own size is zero.
+        """
+        fullpath = pathjoin(self.cachepath, path)
+        self._makedirs(dirname(fullpath))
+        
+        if not self.dedupe:
+            return self._writeFile(body, fullpath), None
+        
+        generation = 0
+        
+        while True:
+            storepath = self._storepath(body, format, generation)
+            fullstorepath = pathjoin(self.cachepath, storepath)
+            
+            if not exists(fullstorepath):
+                self._makedirs(dirname(fullstorepath))
+                self._writeFile(body, fullstorepath)
+            
+            try:
+                if _link(fullstorepath, fullpath):
+                    return 0, storepath
+            except OSError, e:
+                # errno=31 means this copy can't have any more links, try the next one
+                if e.errno != 31:
+                    raise
+                generation += 1
+
+    def _writeFile(self, body, fullpath):
+        """ Atomically write a file, return its size.
+        """
+        fh, tmp_path = mkstemp(dir=self.cachepath, suffix=splitext(fullpath)[1])
         os.write(fh, body)
         os.close(fh)
         
@@ -186,14 +249,17 @@ class Cache:
 
         os.chmod(fullpath, 0666&~self.umask)
         
-        stat = os.stat(fullpath)
-        size = stat.st_size
-        
-        if hasattr(stat, 'st_blksize'):
-            blocks = _ceil(size / float(stat.st_blksize))
-            size = int(blocks * stat.st_blksize)
+        return _size(fullpath)
 
-        return size
+    def _link_body(self, db, storepath, fullpath):
+        """ Count one more tile linked to a stored body.
+        """
+        db.execute("""INSERT OR IGNORE INTO bodies
+                      (path, refs, size)
+                      VALUES (?, 0, ?)""",
+                   (storepath, _size(fullpath)))
+        
+        db.execute('UPDATE bodies SET refs=refs+1 WHERE path=?', (storepath, ))
 
     def _remove(self, path):
         """
@@ -201,6 +267,32 @@ class Cache:
         fullpath = pathjoin(self.cachepath, path)
 
         os.unlink(fullpath)
+
+    def _unlink_body(self, db, storepath):
+        """ Count one less tile linked to a stored body, return its freed size.
+        
+            The stored body is removed along with its last tile.
+        """
+        row = db.execute('SELECT refs, size FROM bodies WHERE path=?', (storepath, )).fetchone()
+        
+        if row is None:
+            return 0
+        
+        refs, size = row
+        
+        if refs > 1:
+            db.execute('UPDATE bodies SET refs=refs-1 WHERE path=?', (storepath, ))
+            return 0
+        
+        db.execute('DELETE FROM bodies WHERE path=?', (storepath, ))
+        
+        try:
+            self._remove(storepath)
+        except OSError, e:
+            if e.errno != 2:
+                raise
+        
+        return size
     
     def save(self, body, layer, coord, format):
         """
@@ -208,37 +300,63 @@ class Cache:
         sys.stderr.write('save %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
         
         path = self._filepath(layer, coord, format)
-        size = self._write(body, path, format)
+        size, storepath = self._write(body, path, format)
 
         db = connect(self.dbpath).cursor()
         
-        try:
-            db.execute("""INSERT INTO tiles
-                          (size, used, path)
-                          VALUES (?, ?, ?)""",
-                       (size, int(time.time()), path))
-        except IntegrityError:
+        row = db.execute('SELECT body FROM tiles WHERE path=?', (path, )).fetchone()
+        
+        if storepath:
+            self._link_body(db, storepath, pathjoin(self.cachepath, path))
+        
+        if row and row[0]:
+            self._unlink_body(db, row[0])
+        
+        if row:
             db.execute("""UPDATE tiles
-                          SET size=?, used=?
+                          SET size=?, used=?, body=?
                           WHERE path=?""",
-                       (size, int(time.time()), path))
+                       (size, int(time.time()), storepath, path))
+        else:
+            db.execute("""INSERT INTO tiles
+                          (size, used, path, body)
+                          VALUES (?, ?, ?, ?)""",
+                       (size, int(time.time()), path, storepath))
         
-        row = db.execute('SELECT SUM(size) FROM tiles').fetchone()
+        row = db.execute('SELECT (SELECT IFNULL(SUM(size), 0) FROM tiles) + (SELECT IFNULL(SUM(size), 0) FROM bodies)').fetchone()
         
         if row and (row[0] > self.limit):
             over = row[0] - self.limit
             
             while over > 0:
-                row = db.execute('SELECT path, size FROM tiles ORDER BY used ASC LIMIT 1').fetchone()
+                row = db.execute('SELECT path, size, body FROM tiles ORDER BY used ASC LIMIT 1').fetchone()
                 
                 if row is None:
                     break
 
-                path, size = row
+                path, size, storepath = row
                 db.execute('DELETE FROM tiles WHERE path=?', (path, ))
                 self._remove(path)
                 over -= size
+                
+                if storepath:
+                    over -= self._unlink_body(db, storepath)
+                
                 sys.stderr.write('delete ' + path)
         
         db.connection.commit()
         db.connection.close()
+
+def _size(fullpath):
+    """ Return the size of a file.
+    
+        If filesystem block size is known, try to return actual disk space used.
+    """
+    stat = os.stat(fullpath)
+    size = stat.st_size
+    
+    if hasattr(stat, 'st_blksize'):
+        blocks = _ceil(size / float(stat.st_blksize))
+        size = int(blocks * stat.st_blksize)
+
+    return size
@@ -0,0 +1,144 @@
+""" Shared Postgres connection pools for PostGIS-backed providers.
+
+VecTiles and PostGeoJSON providers borrow read-only connections from a pool
+instead of connecting to the database for every query. There is one pool
+per process for each distinct set of connection parameters, so a forked
+worker never reuses a socket it shares with its parent.
+
+Pool sizes can be adjusted with two extra keys in a VecTiles "dbinfo"
+dictionary, which are not passed on to psycopg2.connect():
+
+    "dbinfo":
+    {
+      "host": "localhost",
+      "user": "gis",
+      "database": "gis",
+      "pool_min": 1,
+      "pool_max": 8
+    }
+
+Connections that are closed or in an unknown state are thrown out when they
+are borrowed from the pool or returned to it. A query that fails with one of
+connection_errors can be retried with a fresh connection if is_stale() says
+that its connection went away. Other errors, like a query canceled by
+statement_timeout, would only fail again and load the database twice.
+"""
+from os import getpid
+from threading import Lock, BoundedSemaphore
+
+try:
+    from psycopg2 import OperationalError, InterfaceError
+    from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+    from psycopg2.pool import ThreadedConnectionPool
+    from psycopg2.extras import RealDictCursor
+
+except ImportError, err:
+    # Still possible to build the documentation without psycopg2
+
+    class OperationalError (Exception): pass
+    class InterfaceError (Exception): pass
+
+    def ThreadedConnectionPool(*args, **kwargs):
+        raise err
+
+pool_min, pool_max = 1, 8
+
+# Errors raised by queries on a connection that may have gone away.
+connection_errors = OperationalError, InterfaceError
+
+# Pools keyed on process ID and connection parameters. Entries from a parent
+# process are left alone after a fork, so their connections aren't closed.
+_pools = {}
+_pools_lock = Lock()
+
+def is_stale(error):
+    ''' Return true if a query error came from a connection that has gone away.
+    '''
+    if isinstance(error, InterfaceError):
+        # e.g. "connection already closed"
+        return True
+
+    cursor = getattr(error, 'cursor', None)
+    return bool(isinstance(error, OperationalError) and cursor is not None and cursor.connection.closed)
+
+class Pool:
+    ''' Thread-safe pool of autocommit, read-only Postgres connections.
+
+        Unlike psycopg2's ThreadedConnectionPool, getconn() blocks until
+        a connection is available instead of raising a PoolError.
+    '''
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, *args, **kwargs)
+        self.slots = BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        ''' Borrow a healthy connection, waiting for one if necessary.
+        '''
+        self.slots.acquire()
+
+        try:
+            while True:
+                conn = self.pool.getconn()
+
+                if conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+                    self.pool.putconn(conn, close=True)
+                    continue
+
+                if not conn.autocommit:
+                    conn.set_session(readonly=True, autocommit=True)
+
+                return conn
+
+        except:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn):
+        ''' Return a connection to the pool, closing it if it's broken.
+        '''
+        try:
+            broken = conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN
+            self.pool.putconn(conn, close=bool(broken))
+        finally:
+            self.slots.release()
+
+def get_pool(dbinfo):
+    ''' Get a connection pool for a DSN string or dictionary of parameters.
+    '''
+    if isinstance(dbinfo, dict):
+        minconn = int(dbinfo.get('pool_min', pool_min))
+        maxconn = int(dbinfo.get('pool_max', pool_max))
+        kwargs = dict([(k, v) for (k, v) in dbinfo.items() if k not in ('pool_min', 'pool_max')])
+        key = getpid(), tuple(sorted(dbinfo.items()))
+        args = ()
+    else:
+        minconn, maxconn, kwargs = pool_min, pool_max, {}
+        key = getpid(), dbinfo
+        args = (dbinfo, )
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = Pool(minconn, max(minconn, maxconn), *args, **kwargs)
+
+        return _pools[key]
+
+class Connection:
+    ''' Context manager for pooled Postgres connections, yields a cursor.
+
+        See http://www.python.org/dev/peps/pep-0343/
+        and http://effbot.org/zone/python-with-statement.htm
+    '''
+    def __init__(self, dbinfo):
+        self.pool = get_pool(dbinfo)
+
+    def __enter__(self):
+        self.db = self.pool.getconn().cursor(cursor_factory=RealDictCursor)
+        return self.db
+
+    def __exit__(self, type, value, traceback):
+        conn = self.db.connection
+
+        if not conn.closed:
+            self.db.close()
+
+        self.pool.putconn(conn)
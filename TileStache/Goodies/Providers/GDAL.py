@@ -17,10 +17,15 @@ The maskband argument is optional. If present and greater than 0, it specifies
 the GDAL dataset band whose mask should be used as an alpha channel. If maskband
 is 0 (the default), do not create an alpha channel.
 
+Source datasets are opened once per thread and process, and reused for
+every rendered area.
+
 With a bit more work, this provider will be ready for fully-supported inclusion
 in TileStache proper. Until then, it will remain here in the Goodies package.
 """
 from urlparse import urlparse, urljoin
+from threading import local
+from os import getpid
 
 try:
     from PIL import Image
@@ -55,16 +60,29 @@ class Provider:
         self.filename = file_path
         self.resample = resamplings[resample]
         self.maskband = maskband
+        self._local = local()
+    
+    def _source(self):
+        """ Return the opened source dataset for this thread and process.
+        
+            GDAL datasets can't be shared between threads, or across a fork.
+        """
+        if getattr(self._local, 'pid', None) != getpid():
+            src_ds = gdal.Open(str(self.filename))
+            
+            if src_ds.GetGCPs():
+                src_ds.SetProjection(src_ds.GetGCPProjection())
+            
+            self._local.src_ds, self._local.pid = src_ds, getpid()
+        
+        return self._local.src_ds
     
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
         """
         """
-        src_ds = gdal.Open(str(self.filename))
+        src_ds = self._source()
         driver = gdal.GetDriverByName('GTiff')
         
-        if src_ds.GetGCPs():
-            src_ds.SetProjection(src_ds.GetGCPProjection())
-        
         grayscale_src = (src_ds.RasterCount == 1)
 
         try:
@@ -133,16 +151,18 @@ class Provider:
                 # what is requested.
                 gdal.ReprojectImage(src_ds, mask_ds, src_ds.GetProjection(), mask_ds.GetProjection(), gdal.GRA_NearestNeighbour)
             
-            channel = grayscale_src and (1, 1, 1) or (1, 2, 3)
-            r, g, b = [area_ds.GetRasterBand(i).ReadRaster(0, 0, width, height) for i in channel]
-
-            if mask_ds is None:
-                data = ''.join([''.join(pixel) for pixel in zip(r, g, b)])
-                area = Image.frombytes('RGB', (width, height), data)
+            if grayscale_src:
+                data = area_ds.GetRasterBand(1).ReadRaster(0, 0, width, height)
+                area = Image.frombuffer('L', (width, height), data, 'raw', 'L', 0, 1).convert('RGB')
             else:
+                # Have GDAL interleave the bands into a single RGB buffer.
+                data = area_ds.ReadRaster(0, 0, width, height, width, height, gdal.GDT_Byte, [1, 2, 3],
+                                          buf_pixel_space=3, buf_line_space=width*3, buf_band_space=1)
+                area = Image.frombuffer('RGB', (width, height), data, 'raw', 'RGB', 0, 1)
+
+            if mask_ds is not None:
                 a = mask_ds.GetRasterBand(self.maskband).GetMaskBand().ReadRaster(0, 0, width, height)
-                data = ''.join([''.join(pixel) for pixel in zip(r, g, b, a)])
-                area = Image.frombytes('RGBA', (width, height), data)
+                area.putalpha(Image.frombuffer('L', (width, height), a, 'raw', 'L', 0, 1))
 
         finally:
             driver.Delete('/vsimem/output')
@@ -29,6 +29,7 @@ Keyword arguments:
   dsn:
     Database connection string suitable for use in psycopg2.connect().
     See http://initd.org/psycopg/docs/module.html#psycopg2.connect for more.
+    Connections are reused from a shared pool, see TileStache.Goodies.Postgres.
   
   query:
     PostGIS query with a "!bbox!" placeholder for the tile bounding box.
@@ -114,8 +115,6 @@ try:
     from shapely.wkb import loads as _loadshape
     from shapely.geometry import Polygon
     from shapely.geos import TopologicalError
-    from psycopg2 import connect as _connect
-    from psycopg2.extras import RealDictCursor
 except ImportError:
     # At least it should be possible to build the documentation.
     pass
@@ -123,6 +122,7 @@ except ImportError:
 
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
+from TileStache.Goodies.Postgres import Connection, connection_errors, is_stale
 
 def row2feature(row, id_field, geometry_field):
     """ Convert a database row dict to a feature dict.
@@ -243,6 +243,13 @@ class Provider:
     
         return 'application/json', 'JSON'
 
+    def _query(self, query):
+        """ Run a query with a pooled connection, return all rows.
+        """
+        with Connection(self.dbdsn) as db:
+            db.execute(query)
+            return db.fetchall()
+
     def renderTile(self, width, height, srs, coord):
         """ Render a single tile, return a SaveableResponse instance.
         """
@@ -255,12 +262,13 @@ class Provider:
         bbox = 'ST_SetSRID(ST_MakeBox2D(ST_MakePoint(%.6f, %.6f), ST_MakePoint(%.6f, %.6f)), 900913)' % (ul.x, ul.y, lr.x, lr.y)
         clip = self.clipping and Polygon([(ul.x, ul.y), (lr.x, ul.y), (lr.x, lr.y), (ul.x, lr.y)]) or None
 
-        db = _connect(self.dbdsn).cursor(cursor_factory=RealDictCursor)
-
-        db.execute(self.query.replace('!bbox!', bbox))
-        rows = db.fetchall()
-        
-        db.close()
+        try:
+            rows = self._query(self.query.replace('!bbox!', bbox))
+        except connection_errors, e:
+            if not is_stale(e):
+                raise
+            # pooled connection has gone away, try again with a fresh one.
+            rows = self._query(self.query.replace('!bbox!', bbox))
         
         response = {'type': 'FeatureCollection', 'features': []}
         
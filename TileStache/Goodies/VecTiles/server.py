@@ -10,31 +10,50 @@ from math import pi
 from urlparse import urljoin, urlparse
 from urllib import urlopen
 from os.path import exists
+from os import getpid
+from time import time
+from threading import local, Lock
+from multiprocessing.pool import ThreadPool
 from shapely.wkb import dumps
 from shapely.wkb import loads
 
 import json
+import logging
 from ... import getTile
 from ...Core import KnownUnknown
 from TileStache.Config import loadClassPath
 
 try:
-    from psycopg2.extras import RealDictCursor
-    from psycopg2 import connect
     from psycopg2.extensions import TransactionRollbackError
 
 except ImportError, err:
     # Still possible to build the documentation without psycopg2
 
-    def connect(*args, **kwargs):
-        raise err
+    class TransactionRollbackError (Exception): pass
 
+from ..Postgres import Connection, connection_errors, is_stale
 from . import mvt, geojson, topojson, oscimap
 from ...Geography import SphericalMercator
 from ModestMaps.Core import Point
 
 tolerances = [6378137 * 2 * pi / (2 ** (zoom + 8)) for zoom in range(22)]
 
+# Thread pools for MultiResponse sublayers, keyed on process ID and size.
+_thread_pools = {}
+_thread_pools_lock = Lock()
+_pool_thread = local()
+
+def thread_pool(size):
+    ''' Get a shared pool of size threads for this process.
+    '''
+    key = getpid(), size
+
+    with _thread_pools_lock:
+        if key not in _thread_pools:
+            _thread_pools[key] = ThreadPool(size)
+
+        return _thread_pools[key]
+
 
 def make_transform_fn(transform_fns):
     if not transform_fns:
@@ -61,6 +80,8 @@ class Provider:
           dbinfo:
             Required dictionary of Postgres connection parameters. Should
             include some combination of 'host', 'user', 'password', and 'database'.
+            Connections come from a shared pool, whose size can be set with
+            optional 'pool_min' and 'pool_max' values; see Goodies.Postgres.
         
           queries:
             Required list of Postgres queries, one for each zoom level. The
@@ -149,7 +170,7 @@ class Provider:
         '''
         self.layer = layer
 
-        keys = 'host', 'user', 'password', 'database', 'port', 'dbname'
+        keys = 'host', 'user', 'password', 'database', 'port', 'dbname', 'pool_min', 'pool_max'
         self.dbinfo = dict([(k, v) for (k, v) in dbinfo.items() if k in keys])
 
         self.clip = bool(clip)
@@ -245,6 +266,11 @@ class MultiProvider:
           True if cache provider should not save intermediate layers
           in cache.
 
+        max_parallelism:
+          Optional number of sublayers to fetch concurrently, each in
+          its own thread and with its own database query. Set to 1 to
+          fetch sublayers one after another. Default 4.
+
         Sample configuration, for a layer with combined data from water
         and land areas, both assumed to be vector-returning layers:
 
@@ -257,20 +283,22 @@ class MultiProvider:
             }
           }
     '''
-    def __init__(self, layer, names, ignore_cached_sublayers=False):
+    def __init__(self, layer, names, ignore_cached_sublayers=False, max_parallelism=4):
         self.layer = layer
         self.names = names
         self.ignore_cached_sublayers = ignore_cached_sublayers
+        self.max_parallelism = int(max_parallelism)
 
-    def __call__(self, layer, names, ignore_cached_sublayers=False):
+    def __call__(self, layer, names, ignore_cached_sublayers=False, max_parallelism=4):
         self.layer = layer
         self.names = names
         self.ignore_cached_sublayers = ignore_cached_sublayers
+        self.max_parallelism = int(max_parallelism)
 
     def renderTile(self, width, height, srs, coord):
         ''' Render a single tile, return a Response instance.
         '''
-        return MultiResponse(self.layer.config, self.names, coord, self.ignore_cached_sublayers)
+        return MultiResponse(self.layer.config, self.names, coord, self.ignore_cached_sublayers, self.max_parallelism)
 
     def getTypeByExtension(self, extension):
         ''' Get mime-type and format by file extension, "json" or "topojson" only.
@@ -290,24 +318,6 @@ class MultiProvider:
         else:
             raise ValueError(extension + " is not a valid extension for responses with multiple layers")
 
-class Connection:
-    ''' Context manager for Postgres connections.
-
-        See http://www.python.org/dev/peps/pep-0343/
-        and http://effbot.org/zone/python-with-statement.htm
-    '''
-    def __init__(self, dbinfo):
-        self.dbinfo = dbinfo
-
-    def __enter__(self):
-        conn = connect(**self.dbinfo)
-        conn.set_session(readonly=True, autocommit=True)
-        self.db = conn.cursor(cursor_factory=RealDictCursor)
-        return self.db
-
-    def __exit__(self, type, value, traceback):
-        self.db.connection.close()
-
 class Response:
     '''
     '''
@@ -384,13 +394,14 @@ class EmptyResponse:
 class MultiResponse:
     '''
     '''
-    def __init__(self, config, names, coord, ignore_cached_sublayers):
+    def __init__(self, config, names, coord, ignore_cached_sublayers, max_parallelism=1):
         ''' Create a new response object with TileStache config and layer names.
         '''
         self.config = config
         self.names = names
         self.coord = coord
         self.ignore_cached_sublayers = ignore_cached_sublayers
+        self.max_parallelism = max_parallelism
 
     def save(self, out, format):
         '''
@@ -402,28 +413,57 @@ class MultiResponse:
             geojson.merge(out, self.names, self.get_tiles(format), self.config, self.coord)
 
         elif format == 'OpenScienceMap':
-            feature_layers = []
             layers = [self.config.layers[name] for name in self.names]
-            for layer in layers:
-                width, height = layer.dim, layer.dim
-                tile = layer.provider.renderTile(width, height, layer.projection.srs, self.coord)
-                if isinstance(tile,EmptyResponse): continue
-                feature_layers.append({'name': layer.name(), 'features': get_features(tile.dbinfo, tile.query["OpenScienceMap"], layer.provider.geometry_types, layer.provider.transform_fn, layer.provider.sort_fn, self.coord.zoom)})
+            feature_layers = filter(None, self.map_layers(self.get_feature_layer, layers, format))
             oscimap.merge(out, feature_layers, self.coord)
         
         elif format == 'MVT':
-            feature_layers = []
             layers = [self.config.layers[name] for name in self.names]
-            for layer in layers:
-                width, height = layer.dim, layer.dim
-                tile = layer.provider.renderTile(width, height, layer.projection.srs, self.coord)
-                if isinstance(tile,EmptyResponse): continue
-                feature_layers.append({'name': layer.name(), 'features': get_features(tile.dbinfo, tile.query["MVT"], layer.provider.geometry_types, layer.provider.transform_fn, layer.provider.sort_fn, self.coord.zoom)})
+            feature_layers = filter(None, self.map_layers(self.get_feature_layer, layers, format))
             mvt.merge(out, feature_layers, self.coord)
 
         else:
             raise ValueError(format + " is not supported for responses with multiple layers")
 
+    def map_layers(self, func, layers, format):
+        ''' Call func(layer, format) for each layer, return results in layer order.
+        
+            Sublayers are handled concurrently by a pool of max_parallelism
+            threads. Inside a pool thread they're handled one at a time, so
+            a nested multi-layer never waits on its own busy pool.
+        '''
+        def timed(layer):
+            start_time = time()
+            result = func(layer, format)
+            logging.info('TileStache.Goodies.VecTiles.server.MultiResponse.save() %s/%d/%d/%d.%s in %.3f', layer.name(), self.coord.zoom, self.coord.column, self.coord.row, format, time() - start_time)
+            return result
+        
+        def pooled(layer):
+            _pool_thread.active = True
+            return timed(layer)
+        
+        if self.max_parallelism <= 1 or len(layers) <= 1 or getattr(_pool_thread, 'active', False):
+            return map(timed, layers)
+        
+        return thread_pool(self.max_parallelism).map(pooled, layers, 1)
+
+    def get_feature_layer(self, layer, format):
+        ''' Get a dictionary with name and features for one sublayer, or None if empty.
+        '''
+        width, height = layer.dim, layer.dim
+        tile = layer.provider.renderTile(width, height, layer.projection.srs, self.coord)
+        
+        if isinstance(tile, EmptyResponse):
+            return None
+        
+        features = get_features(tile.dbinfo, tile.query[format], layer.provider.geometry_types, layer.provider.transform_fn, layer.provider.sort_fn, self.coord.zoom)
+        return {'name': layer.name(), 'features': features}
+
+    def get_sublayer_tile(self, layer, format):
+        ''' Get a (mime-type, body) tuple for one sublayer.
+        '''
+        return getTile(layer, self.coord, format.lower(), self.ignore_cached_sublayers, self.ignore_cached_sublayers)
+
     def get_tiles(self, format):
         unknown_layers = set(self.names) - set(self.config.layers.keys())
     
@@ -431,7 +471,7 @@ class MultiResponse:
             raise KnownUnknown("%s.get_tiles didn't recognize %s when trying to load %s." % (__name__, ', '.join(unknown_layers), ', '.join(self.names)))
         
         layers = [self.config.layers[name] for name in self.names]
-        mimes, bodies = zip(*[getTile(layer, self.coord, format.lower(), self.ignore_cached_sublayers, self.ignore_cached_sublayers) for layer in layers])
+        mimes, bodies = zip(*self.map_layers(self.get_sublayer_tile, layers, format))
         bad_mimes = [(name, mime) for (mime, name) in zip(mimes, self.names) if not mime.endswith('/json')]
         
         if bad_mimes:
@@ -446,56 +486,75 @@ class MultiResponse:
         return tiles
 
 
-def query_columns(dbinfo, srid, subquery, bounds):
+def query_columns(dbinfo, srid, subquery, bounds, n_try=1):
     ''' Get information about the columns returned for a subquery.
     '''
-    with Connection(dbinfo) as db:
-        bbox = 'ST_MakeBox2D(ST_MakePoint(%f, %f), ST_MakePoint(%f, %f))' % bounds
-        bbox = 'ST_SetSRID(%s, %d)' % (bbox, srid)
+    bbox = 'ST_MakeBox2D(ST_MakePoint(%f, %f), ST_MakePoint(%f, %f))' % bounds
+    bbox = 'ST_SetSRID(%s, %d)' % (bbox, srid)
 
-        query = subquery.replace('!bbox!', bbox)
+    query = subquery.replace('!bbox!', bbox)
 
-        # newline is important here, to break out of comments.
-        db.execute(query + '\n LIMIT 0')
-        column_names = set(x.name for x in db.description)
-        return column_names
+    try:
+        with Connection(dbinfo) as db:
+            # newline is important here, to break out of comments.
+            db.execute(query + '\n LIMIT 0')
+            column_names = set(x.name for x in db.description)
+            return column_names
+
+    except connection_errors, e:
+        # pooled connection has gone away, try again with a fresh one.
+        if n_try >= 2 or not is_stale(e):
+            raise
+        return query_columns(dbinfo, srid, subquery, bounds, n_try=n_try + 1)
 
 
 def get_features(dbinfo, query, geometry_types, transform_fn, sort_fn, zoom,
-                 n_try=1):
+                 n_try=1, n_stale=1):
     features = []
 
-    with Connection(dbinfo) as db:
-        try:
+    # Retry serialization failures and stale pooled connections, each
+    # with their own count, after the connection that failed has gone
+    # back to the pool.
+    try:
+        with Connection(dbinfo) as db:
             db.execute(query)
-        except TransactionRollbackError:
-            if n_try >= 5:
-                print 'TransactionRollbackError occurred 5 times'
-                raise
-            else:
-                return get_features(dbinfo, query, geometry_types,
-                                    transform_fn, sort_fn, zoom,
-                                    n_try=n_try + 1)
-        for row in db.fetchall():
-            assert '__geometry__' in row, 'Missing __geometry__ in feature result'
-            assert '__id__' in row, 'Missing __id__ in feature result'
-
-            wkb = bytes(row.pop('__geometry__'))
-            id = row.pop('__id__')
-
-            shape = loads(wkb)
-            if geometry_types is not None:
-                if shape.type not in geometry_types:
-                    #print 'found %s which is not in: %s' % (geom_type, geometry_types)
-                    continue
-
-            props = dict((k, v) for k, v in row.items() if v is not None)
-
-            if transform_fn:
-                shape, props, id = transform_fn(shape, props, id, zoom)
-                wkb = dumps(shape)
-
-            features.append((wkb, props, id))
+            rows = db.fetchall()
+    except TransactionRollbackError:
+        if n_try >= 5:
+            print 'TransactionRollbackError occurred 5 times'
+            raise
+        else:
+            return get_features(dbinfo, query, geometry_types,
+                                transform_fn, sort_fn, zoom,
+                                n_try=n_try + 1, n_stale=n_stale)
+    except connection_errors, e:
+        if n_stale >= 2 or not is_stale(e):
+            raise
+        else:
+            return get_features(dbinfo, query, geometry_types,
+                                transform_fn, sort_fn, zoom,
+                                n_try=n_try, n_stale=n_stale + 1)
+
+    for row in rows:
+        assert '__geometry__' in row, 'Missing __geometry__ in feature result'
+        assert '__id__' in row, 'Missing __id__ in feature result'
+
+        wkb = bytes(row.pop('__geometry__'))
+        id = row.pop('__id__')
+
+        shape = loads(wkb)
+        if geometry_types is not None:
+            if shape.type not in geometry_types:
+                #print 'found %s which is not in: %s' % (geom_type, geometry_types)
+                continue
+
+        props = dict((k, v) for k, v in row.items() if v is not None)
+
+        if transform_fn:
+            shape, props, id = transform_fn(shape, props, id, zoom)
+            wkb = dumps(shape)
+
+        features.append((wkb, props, id))
 
     if sort_fn:
         features = sort_fn(features, zoom)
@@ -0,0 +1,121 @@
+""" Lock waiting for TileStache caches.
+
+Caches lock a metatile while it's being rendered, so that other processes
+wait for it to show up in the cache instead of rendering it again. A lock
+that's still held after the layer's stale lock timeout is assumed to have
+been abandoned, and is forced.
+
+Caches use these functions to wait for locks:
+
+- wait_for() calls a function that tries to take a lock until it succeeds,
+  sleeping between attempts with short exponential backoff and jitter, so
+  waiters notice a released lock quickly without hammering the lock server.
+
+- wait_for_flock() takes an exclusive flock() on a file, retrying without
+  blocking on a faster backoff, since a flock() attempt costs no I/O.
+
+Waiting is measured for every lock, and stats() returns a dictionary of
+counts and times for this process:
+
+- acquired: number of locks taken.
+- contended: number of locks that had to be waited for.
+- forced: number of locks forced after the stale lock timeout.
+- wait_seconds: total time spent waiting for locks.
+- max_wait_seconds: longest single wait.
+
+Waits are also counted in the tilestache_lock_wait_seconds histogram of the
+Metrics module.
+"""
+from time import time, sleep
+from random import uniform
+from threading import Lock
+from errno import EAGAIN, EACCES
+
+from . import Metrics
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_NB
+except ImportError:
+    # no file locks on this platform, see Caches.Disk.
+    flock = None
+
+_stats = dict(acquired=0, contended=0, forced=0, wait_seconds=0., max_wait_seconds=0.)
+_stats_lock = Lock()
+
+def record(started, forced=False):
+    """ Count a lock taken, after waiting for it since started.
+    """
+    wait = time() - started
+
+    with _stats_lock:
+        _stats['acquired'] += 1
+        _stats['wait_seconds'] += wait
+        _stats['max_wait_seconds'] = max(_stats['max_wait_seconds'], wait)
+
+        if wait > 0.001:
+            _stats['contended'] += 1
+
+        if forced:
+            _stats['forced'] += 1
+
+    Metrics.observe('tilestache_lock_wait_seconds', wait)
+
+    if forced:
+        Metrics.inc('tilestache_locks_forced_total')
+
+def stats():
+    """ Return a dictionary of lock counts and wait times for this process.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+def backoff(first=.005, limit=.2):
+    """ Generate delays that double from first up to limit, with jitter.
+    """
+    delay = first
+
+    while True:
+        yield uniform(delay / 2, delay)
+        delay = min(delay * 2, limit)
+
+def wait_for(attempt, timeout, first=.005, limit=.2):
+    """ Call attempt() until it returns true or timeout seconds have passed.
+
+        Returns true if attempt() succeeded, or false if the lock looks
+        stale and the caller should force it.
+    """
+    started = time()
+    due = started + timeout
+
+    for delay in backoff(first, limit):
+        if attempt():
+            record(started)
+            return True
+
+        if time() + delay > due:
+            break
+
+        sleep(delay)
+
+    record(started, True)
+    return False
+
+def wait_for_flock(fd, timeout, first=.001, limit=.02):
+    """ Take an exclusive flock() on a file descriptor within timeout seconds.
+
+        Returns true if the lock was taken, or false if the lock looks stale.
+        A blocking flock() can't be given a timeout, and a thread blocked in
+        one would stay behind until a stale holder lets go, so this retries
+        a non-blocking flock() with wait_for() instead.
+    """
+    def attempt():
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except (IOError, OSError), e:
+            if e.errno not in (EAGAIN, EACCES):
+                raise
+            return False
+        else:
+            return True
+
+    return wait_for(attempt, timeout, first, limit)
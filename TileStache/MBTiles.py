@@ -34,16 +34,47 @@ MBTiles provider parameters:
 
   tileset:
     Required local file path to MBTiles tileset file, a SQLite 3 database file.
+
+Tile reads and writes reuse one SQLite connection per thread and tileset file
+rather than connecting for each tile, so sqlite3's own statement cache keeps
+the tile queries prepared. The "format" metadata of each tileset is looked up
+only once.
+
+Tilesets may also use the deduplicated layout written by MBUtil and others,
+where a "map" table points each tile coordinate at a row in an "images" table
+keyed by the MD5 hash of the tile content, and "tiles" is a view joining the
+two. Byte-identical tiles such as empty ocean are then stored just once, and
+an image is deleted along with the last tile that points to it. The
+layout of each tileset is detected when it's first used, and create_tileset()
+or the Cache class below make new tilesets this way with dedupe=True.
 """
 from urlparse import urlparse, urljoin
 from os.path import exists
+from os import getpid, stat
+from hashlib import md5
+from threading import local, Lock, Timer
+from multiprocessing.util import Finalize
+import atexit
 
 # Heroku is missing standard python's sqlite3 package, so this will ImportError.
 from sqlite3 import connect as _connect
 
 from ModestMaps.Core import Coordinate
 
-def create_tileset(filename, name, type, version, description, format, bounds=None):
+from .Core import KnownUnknown
+
+# per-thread connections to tileset files, see _connection().
+_local = local()
+
+# format metadata for each tileset filename, see _tileset_format().
+_formats = {}
+
+# true for each tileset filename with the deduplicated layout, see _tileset_dedupe().
+_dedupes = {}
+
+_mime_types = {'png': 'image/png', 'jpg': 'image/jpeg', 'json': 'application/json', None: None}
+
+def create_tileset(filename, name, type, version, description, format, bounds=None, dedupe=False):
     """ Create a tileset 1.1 with the given filename and metadata.
     
         From the specification:
@@ -74,15 +105,37 @@ def create_tileset(filename, name, type, version, description, format, bounds=No
             WGS:84 - latitude and longitude values, in the OpenLayers Bounds
             format - left, bottom, right, top. Example of the full earth:
             -180.0,-85,180,85.
+        
+        With dedupe, tiles are stored in "map" and "images" tables behind
+        a "tiles" view, so that identical tile content is stored only once.
     """
     if format not in ('png', 'jpg',' json'):
         raise Exception('Format must be one of "png" or "jpg" or "json", not "%s"' % format)
     
+    # a tileset made earlier under this name may have had another layout.
+    _formats.pop(filename, None)
+    _dedupes.pop(filename, None)
+    
+    if getattr(_local, 'pid', None) == getpid() and filename in _local.connections:
+        _local.connections.pop(filename).close()
+    
     db = _connect(filename)
     
     db.execute('CREATE TABLE metadata (name TEXT, value TEXT, PRIMARY KEY (name))')
-    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
-    db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
+    
+    if dedupe:
+        db.execute('CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)')
+        db.execute('CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row)')
+        db.execute('CREATE INDEX map_tile_id ON map (tile_id)')
+        db.execute('CREATE TABLE images (tile_data BLOB, tile_id TEXT)')
+        db.execute('CREATE UNIQUE INDEX images_id ON images (tile_id)')
+        db.execute("""CREATE VIEW tiles AS
+                      SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                             map.tile_row AS tile_row, images.tile_data AS tile_data
+                      FROM map JOIN images ON images.tile_id = map.tile_id""")
+    else:
+        db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        db.execute('CREATE UNIQUE INDEX coord ON tiles (zoom_level, tile_column, tile_row)')
     
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('name', name))
     db.execute('INSERT INTO metadata VALUES (?, ?)', ('type', type))
@@ -139,54 +192,165 @@ def list_tiles(filename):
     db = _connect(filename)
     db.text_factory = bytes
     
-    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM tiles')
+    table = _tileset_dedupe(db, filename) and 'map' or 'tiles'
+    tiles = db.execute('SELECT tile_row, tile_column, zoom_level FROM %s' % table)
     tiles = (((2**z - 1) - y, x, z) for (y, x, z) in tiles) # Hello, Paul Ramsey.
     tiles = [Coordinate(row, column, zoom) for (row, column, zoom) in tiles]
     
     return tiles
 
-def get_tile(filename, coord):
-    """ Retrieve the mime-type and raw content of a tile by coordinate.
+def _connection(filename):
+    """ Return an open connection to a tileset file for the current thread.
     
-        If the tile does not exist, None is returned for the content.
+        Connections are kept for the life of the thread, and thrown out
+        after a fork so that child processes don't share them.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    if getattr(_local, 'pid', None) != getpid():
+        _local.pid, _local.connections = getpid(), {}
     
-    formats = {'png': 'image/png', 'jpg': 'image/jpeg', 'json': 'application/json', None: None}
-    format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
-    format = format and format[0] or None
-    mime_type = formats[format]
+    if filename not in _local.connections:
+        db = _connect(filename)
+        db.text_factory = bytes
+        _local.connections[filename] = db
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    return _local.connections[filename]
+
+def _tileset_format(db, filename):
+    """ Return the format metadata value for a tileset, looked up just once.
+    """
+    if filename not in _formats:
+        format = db.execute("SELECT value FROM metadata WHERE name='format'").fetchone()
+        _formats[filename] = format and format[0] or None
+    
+    return _formats[filename]
+
+def _tileset_dedupe(db, filename):
+    """ Return true if a tileset has the deduplicated layout, looked up just once.
+    
+        In that layout "tiles" is a view, and its rows are written to the
+        "map" and "images" tables instead.
+    """
+    if filename not in _dedupes:
+        q = "SELECT type FROM sqlite_master WHERE name='tiles'"
+        type = db.execute(q).fetchone()
+        _dedupes[filename] = bool(type and type[0] == 'view')
+    
+    return _dedupes[filename]
+
+def _select_tiles(db, coords):
+    """ Return raw content for a list of tile coordinates, None where missing.
+    """
     q = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
-    content = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
-    content = content and content[0] or None
+    contents = []
+    
+    for coord in coords:
+        tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+        content = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
+        contents.append(content and content[0] or None)
+    
+    return contents
 
-    return mime_type, content
+def _select_info(db, coord):
+    """ Return the content hash of a tile in a deduplicated tileset, or None.
+    """
+    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+    q = 'SELECT tile_id FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+    tile_id = db.execute(q, (coord.zoom, coord.column, tile_row)).fetchone()
+    
+    return tile_id and tile_id[0] or None
 
-def delete_tile(filename, coord):
-    """ Delete a tile by coordinate.
+def _replace_tiles(db, coords, contents, dedupe=False):
+    """ Write raw content for a list of tile coordinates, without committing.
+    
+        With dedupe, each content is stored under its MD5 hash in the images
+        table unless it's there already, and the map table points to it.
+        Images that the replaced tiles pointed to are deleted if nothing
+        else does.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    if dedupe:
+        tile_ids = [md5(content).hexdigest() for content in contents]
+        old_ids = set(filter(None, [_select_info(db, coord) for coord in coords]))
+        
+        images = [(tile_id, buffer(content)) for (tile_id, content) in zip(tile_ids, contents)]
+        db.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)', images)
+
+        rows = [(coord.zoom, coord.column, (2**coord.zoom - 1) - coord.row, tile_id)
+                for (coord, tile_id) in zip(coords, tile_ids)]
+        
+        q = 'REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)'
+        db.executemany(q, rows)
+        
+        _delete_images(db, old_ids - set(tile_ids))
+        return
     
+    rows = [(coord.zoom, coord.column, (2**coord.zoom - 1) - coord.row, buffer(content))
+            for (coord, content) in zip(coords, contents)]
+    
+    q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+    db.executemany(q, rows)
+
+def _delete_tile(db, coord, dedupe=False):
+    """ Delete a tile by coordinate, without committing.
+    
+        With dedupe, the map row is deleted, and its image too if no other
+        tile shares it.
+    """
     tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+    table = dedupe and 'map' or 'tiles'
+    tile_id = dedupe and _select_info(db, coord)
+    
+    q = 'DELETE FROM %s WHERE zoom_level=? AND tile_column=? AND tile_row=?' % table
     db.execute(q, (coord.zoom, coord.column, tile_row))
+    
+    if tile_id:
+        _delete_images(db, [tile_id])
 
-def put_tile(filename, coord, content):
+def _delete_images(db, tile_ids):
+    """ Delete images no longer pointed to by the map table, without committing.
+    """
+    q = 'DELETE FROM images WHERE tile_id=? AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id=?)'
+    db.executemany(q, [(tile_id, tile_id) for tile_id in tile_ids])
+
+def get_tile(filename, coord):
+    """ Retrieve the mime-type and raw content of a tile by coordinate.
+    
+        If the tile does not exist, None is returned for the content.
     """
+    db = _connection(filename)
+    mime_type = _mime_types[_tileset_format(db, filename)]
+    content = _select_tiles(db, [coord])[0]
+
+    return mime_type, content
+
+def delete_tile(filename, coord):
+    """ Delete a tile by coordinate.
     """
-    db = _connect(filename)
-    db.text_factory = bytes
+    db = _connection(filename)
+    _delete_tile(db, coord, _tileset_dedupe(db, filename))
+    db.commit()
+
+def put_tile(filename, coord, content):
+    """ Write the raw content of a tile by coordinate.
     
-    tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
-    q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
-    db.execute(q, (coord.zoom, coord.column, tile_row, buffer(content)))
+        Identical content is stored just once in a deduplicated tileset.
+    """
+    db = _connection(filename)
+    _replace_tiles(db, [coord], [content], _tileset_dedupe(db, filename))
+    db.commit()
 
+def get_tiles(filename, coords):
+    """ Retrieve the raw content of a list of tiles by coordinate.
+    
+        Returns a list in the same order as coords, with None for each missing tile.
+    """
+    return _select_tiles(_connection(filename), coords)
+
+def put_tiles(filename, coords, contents):
+    """ Write a list of tiles in a single transaction.
+    """
+    db = _connection(filename)
+    _replace_tiles(db, coords, contents, _tileset_dedupe(db, filename))
     db.commit()
-    db.close()
 
 class Provider:
     """ MBTiles provider.
@@ -263,14 +427,87 @@ class Cache:
         Instead, this cache provider is provided for use with the script
         tilestache-seed.py, which can be called with --to-mbtiles option
         to write cached tiles to a new tileset.
+        
+        The tileset is switched to write-ahead logging and written through a
+        single connection per process. Saved tiles are committed together,
+        every batch_tiles tiles or within batch_seconds seconds, whichever
+        comes first, and once more when the process exits.
+        
+        A new tileset is created with the deduplicated layout if dedupe is
+        true. An existing tileset is written in whichever layout it has.
     """
-    def __init__(self, filename, format, name):
+    def __init__(self, filename, format, name, batch_tiles=256, batch_seconds=1.0, dedupe=False):
         """
         """
         self.filename = filename
+        self.batch_tiles = int(batch_tiles)
+        self.batch_seconds = float(batch_seconds)
         
         if not tileset_exists(filename):
-            create_tileset(filename, name, 'baselayer', '0', '', format.lower())
+            create_tileset(filename, name, 'baselayer', '0', '', format.lower(), dedupe=dedupe)
+        
+        db = _connect(filename, timeout=30)
+        
+        if db.execute('PRAGMA journal_mode').fetchone()[0].lower() != 'wal':
+            # persistent, so this happens once and not in every process.
+            db.execute('PRAGMA journal_mode=WAL')
+        
+        self.dedupe = _tileset_dedupe(db, filename)
+        db.close()
+        
+        self._db, self._pid = None, None
+        self._db_lock = Lock()
+        self._pending, self._timer = 0, None
+        
+        atexit.register(self.flush)
+    
+    def _connection(self):
+        """ Return this process's connection, call only with self._db_lock held.
+        """
+        if self._pid != getpid():
+            # first use, or we're in a freshly-forked child process.
+            self._db = _connect(self.filename, timeout=30, check_same_thread=False)
+            self._db.text_factory = bytes
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._pid, self._pending, self._timer = getpid(), 0, None
+            
+            # multiprocessing workers skip atexit, but not their finalizers.
+            Finalize(self, self.flush, exitpriority=10)
+        
+        return self._db
+    
+    def _written(self, count):
+        """ Note count new uncommitted tiles, committing if the batch is full.
+        
+            A timer makes sure the batch is committed within batch_seconds,
+            so the write lock isn't held indefinitely by an idle process.
+            Call only with self._db_lock held.
+        """
+        self._pending += count
+        
+        if self._pending >= self.batch_tiles:
+            self._commit()
+        
+        elif self._timer is None:
+            self._timer = Timer(self.batch_seconds, self.flush)
+            self._timer.start()
+    
+    def _commit(self):
+        """ Commit pending tiles, call only with self._db_lock held.
+        """
+        self._db.commit()
+        self._pending = 0
+        
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+    
+    def flush(self):
+        """ Commit any saved tiles that haven't been committed yet.
+        """
+        with self._db_lock:
+            if self._pid == getpid() and self._pending:
+                self._commit()
     
     def lock(self, layer, coord, format):
         return
@@ -281,14 +518,55 @@ class Cache:
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        delete_tile(self.filename, coord)
+        with self._db_lock:
+            _delete_tile(self._connection(), coord, self.dedupe)
+            self._written(1)
         
     def read(self, layer, coord, format):
         """ Return raw tile content from tileset.
         """
-        return get_tile(self.filename, coord)[1]
+        with self._db_lock:
+            return _select_tiles(self._connection(), [coord])[0]
+    
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a tile in a deduplicated tileset.
+        
+            The etag is the content hash from the map table, so the tile
+            itself is never read. Tiles don't have their own modification
+            times, so the tileset file's is used. Returns None for tilesets
+            without hashes.
+        """
+        if not self.dedupe:
+            return None
+        
+        with self._db_lock:
+            tile_id = _select_info(self._connection(), coord)
+        
+        if tile_id is None:
+            return None
+        
+        # uncommitted tiles are in the write-ahead log, not the file itself.
+        mtimes = [stat(filename).st_mtime for filename in (self.filename, self.filename + '-wal')
+                  if exists(filename)]
+        
+        return '"%s"' % tile_id, max(mtimes)
     
     def save(self, body, layer, coord, format):
         """ Write raw tile content to tileset.
         """
-        put_tile(self.filename, coord, body)
+        with self._db_lock:
+            _replace_tiles(self._connection(), [coord], [body], self.dedupe)
+            self._written(1)
+        
+    def read_many(self, layer, coords, format):
+        """ Return raw content for a list of tiles from tileset.
+        """
+        with self._db_lock:
+            return _select_tiles(self._connection(), coords)
+    
+    def save_many(self, bodies, layer, coords, format):
+        """ Write raw content for a list of tiles to tileset.
+        """
+        with self._db_lock:
+            _replace_tiles(self._connection(), coords, bodies, self.dedupe)
+            self._written(len(coords))
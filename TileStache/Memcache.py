@@ -9,7 +9,8 @@ Example configuration:
     "name": "Memcache",
     "servers": ["127.0.0.1:11211"],
     "revision": 0,
-    "key prefix": "unique-id"
+    "key prefix": "unique-id",
+    "socket timeout": 3
   }
 
 Memcache cache parameters:
@@ -28,17 +29,31 @@ Memcache cache parameters:
     that share the same Memcache instance to avoid key
     collisions. The key prefix will be prepended to the
     key name. Defaults to "".
-    
 
+  socket timeout
+    Optional number of seconds to wait on a Memcache server
+    before giving up on a request. Defaults to 3.
+
+  dead retry
+    Optional number of seconds to wait before retrying a Memcache
+    server that has been marked dead. Defaults to 30.
+
+One memcache.Client is kept for the life of each process and re-created
+after a fork, so prefork servers never share sockets with their parent.
+python-memcached keeps a persistent connection to each server per thread,
+so there are no new TCP connections made for each tile.
 """
 from __future__ import absolute_import
-from time import time as _time, sleep as _sleep
+from threading import Lock as _Lock
+from os import getpid as _getpid
 
 # We enabled absolute_import because case insensitive filesystems
 # cause this file to be loaded twice (the name of this file
 # conflicts with the name of the module we want to import).
 # Forcing absolute imports fixes the issue.
 
+from . import Locks
+
 try:
     from memcache import Client
 except ImportError:
@@ -55,67 +70,90 @@ def tile_key(layer, coord, format, rev, key_prefix):
 class Cache:
     """
     """
-    def __init__(self, servers=['127.0.0.1:11211'], revision=0, key_prefix=''):
+    def __init__(self, servers=['127.0.0.1:11211'], revision=0, key_prefix='', socket_timeout=3, dead_retry=30):
         self.servers = servers
         self.revision = revision
         self.key_prefix = key_prefix
+        self.socket_timeout = socket_timeout
+        self.dead_retry = dead_retry
+        
+        self._mem, self._pid = None, None
+        self._mem_lock = _Lock()
+
+    def _client(self):
+        """ Return a long-lived memcache.Client for the current process.
+        
+            Client is a threading.local, so every thread gets its own
+            persistent connections from the one object.
+        """
+        with self._mem_lock:
+            if self._pid != _getpid():
+                # first use, or we're in a freshly-forked child process.
+                self._mem = Client(self.servers, socket_timeout=self.socket_timeout,
+                                   dead_retry=self.dead_retry)
+                self._pid = _getpid()
+            
+            return self._mem
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
         
             Returns nothing, but blocks until the lock has been acquired.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
-        due = _time() + layer.stale_lock_timeout
-        
-        try:
-            while _time() < due:
-                if mem.add(key+'-lock', 'locked.', layer.stale_lock_timeout):
-                    return
-                
-                _sleep(.2)
-            
+        
+        def attempt():
+            return mem.add(key+'-lock', 'locked.', layer.stale_lock_timeout)
+        
+        if not Locks.wait_for(attempt, layer.stale_lock_timeout):
             mem.set(key+'-lock', 'locked.', layer.stale_lock_timeout)
-            return
-
-        finally:
-            mem.disconnect_all()
         
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
         mem.delete(key+'-lock')
-        mem.disconnect_all()
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
         mem.delete(key)
-        mem.disconnect_all()
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
-        value = mem.get(key)
-        mem.disconnect_all()
-        
-        return value
+        return mem.get(key)
         
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
-        mem = Client(self.servers)
+        mem = self._client()
         key = tile_key(layer, coord, format, self.revision, self.key_prefix)
         
         mem.set(key, body, layer.cache_lifespan or 0)
-        mem.disconnect_all()
+
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles with a single get_multi().
+        """
+        mem = self._client()
+        keys = [tile_key(layer, coord, format, self.revision, self.key_prefix) for coord in coords]
+        values = mem.get_multi(keys)
+        
+        return [values.get(key) for key in keys]
+        
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles with a single set_multi().
+        """
+        mem = self._client()
+        keys = [tile_key(layer, coord, format, self.revision, self.key_prefix) for coord in coords]
+        
+        mem.set_multi(dict(zip(keys, bodies)), layer.cache_lifespan or 0)
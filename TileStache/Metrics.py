@@ -0,0 +1,305 @@
+""" Metrics for TileStache servers, in Prometheus text format.
+
+TileStache counts tiles, render times, cache reads, lock waits and bytes
+served as it works, and WSGITileServer can publish the totals at a path of
+your choice for Prometheus (http://prometheus.io) to scrape. Add a "metrics"
+section to the configuration:
+
+    {
+      "cache": ...,
+      "layers": ...,
+      "metrics": {
+        "path": "/metrics",
+        "directory": "/var/run/tilestache-metrics"
+      }
+    }
+
+Metrics parameters:
+
+  path
+    Required URL path of the metrics page.
+
+  directory
+    Optional directory where each server process saves its metrics, so that
+    one process can report totals for all of them. Use it with any server
+    that runs more than one process, such as gunicorn or uWSGI, and empty it
+    when the server starts. Without it, each process reports only its own.
+
+  interval
+    Optional number of seconds between saves to the directory, one second
+    by default.
+
+Metrics reported:
+
+- tilestache_tile_seconds: histogram of time to respond with a tile, by
+  layer, zoom and source, where source is where the tile came from, as in
+  the log message from Layer.getTileResponse().
+- tilestache_render_seconds: histogram of time to render a tile or
+  metatile, by layer and zoom.
+- tilestache_renders_in_progress: gauge of renders happening now, by layer.
+- tilestache_cache_reads_total: counter of reads from each tier of a Multi
+  cache, by tier, cache and result, "hit" or "miss".
+- tilestache_lock_wait_seconds: histogram of time waiting for cache locks.
+- tilestache_locks_forced_total: counter of stale locks that were forced.
+- tilestache_bytes_served_total: counter of bytes sent by WSGITileServer,
+  by layer.
+
+Layers combined in a request path, such as "a,b", are all labeled with the
+layer name "combined", so that label values stay few.
+
+Gauges of recent tiles and write-behind queues come from collector functions
+that are called whenever metrics are saved or published.
+
+Other code can keep its own metrics with inc(), add() and observe(), after
+describing them with declare().
+"""
+import os
+import json
+import atexit
+
+from tempfile import mkstemp
+from threading import Lock
+from errno import ESRCH
+from glob import glob
+from time import time
+from os.path import join as pathjoin
+
+from multiprocessing.util import Finalize
+
+# upper bounds of histogram buckets, in seconds.
+buckets = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+_declared = dict(
+    tilestache_tile_seconds = ('histogram', 'Time to respond with a tile.'),
+    tilestache_render_seconds = ('histogram', 'Time to render a tile or metatile.'),
+    tilestache_renders_in_progress = ('gauge', 'Renders happening now.'),
+    tilestache_cache_reads_total = ('counter', 'Reads from each tier of a Multi cache.'),
+    tilestache_lock_wait_seconds = ('histogram', 'Time waiting for cache locks.'),
+    tilestache_locks_forced_total = ('counter', 'Stale cache locks forced.'),
+    tilestache_bytes_served_total = ('counter', 'Bytes of tiles sent.'),
+    )
+
+_collectors = []
+
+_settings = dict(directory=None, interval=1.)
+
+_state = dict(pid=None, counters={}, gauges={}, histograms={}, saved=0)
+_lock = Lock()
+
+def declare(name, type, help):
+    """ Describe a metric: type is one of "counter", "gauge" or "histogram".
+    """
+    _declared[name] = type, help
+
+def layer_label(name):
+    """ Return the layer label for a layer name, see "combined" above.
+    """
+    return ',' in name and 'combined' or name
+
+def collector(func):
+    """ Register a function that returns a list of (name, labels, value) gauges.
+
+        Labels are a dictionary. Each gauge should be declared with declare().
+    """
+    _collectors.append(func)
+    return func
+
+def configure(directory=None, interval=1.):
+    """ Save metrics for this process to a directory every interval seconds.
+    """
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    _settings.update(directory=directory, interval=interval)
+
+def _current():
+    """ Return metrics state for this process, starting fresh after a fork.
+
+        Call with _lock held.
+    """
+    if _state['pid'] != os.getpid():
+        _state.update(pid=os.getpid(), counters={}, gauges={}, histograms={}, saved=time())
+
+        # multiprocessing workers exit without running atexit functions.
+        Finalize(None, save, exitpriority=10)
+
+    return _state
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """ Add to a counter.
+    """
+    key = _key(name, labels)
+
+    with _lock:
+        counters = _current()['counters']
+        counters[key] = counters.get(key, 0) + value
+
+    _maybeSave()
+
+def add(name, value, **labels):
+    """ Add to a gauge, or subtract with a negative value.
+    """
+    key = _key(name, labels)
+
+    with _lock:
+        gauges = _current()['gauges']
+        gauges[key] = gauges.get(key, 0) + value
+
+    _maybeSave()
+
+def observe(name, value, **labels):
+    """ Count a value in a histogram.
+    """
+    key = _key(name, labels)
+
+    with _lock:
+        histograms = _current()['histograms']
+
+        if key not in histograms:
+            histograms[key] = [0] * (len(buckets) + 1), 0.
+
+        counts, total = histograms[key]
+        counts[len([b for b in buckets if b < value])] += 1
+        histograms[key] = counts, total + value
+
+    _maybeSave()
+
+def _maybeSave():
+    if _settings['directory'] and time() - _state['saved'] > _settings['interval']:
+        save()
+
+def _snapshot():
+    """ Return a JSON-friendly dictionary of metrics for this process.
+    """
+    gauges = {}
+
+    for func in _collectors:
+        for (name, labels, value) in func():
+            key = _key(name, labels)
+            gauges[key] = gauges.get(key, 0) + value
+
+    with _lock:
+        state = _current()
+        state['saved'] = time()
+
+        for (key, value) in state['gauges'].items():
+            gauges[key] = gauges.get(key, 0) + value
+
+        return dict(pid=state['pid'],
+                    counters=[(n, l, v) for ((n, l), v) in state['counters'].items()],
+                    gauges=[(n, l, v) for ((n, l), v) in gauges.items()],
+                    histograms=[(n, l, c, s) for ((n, l), (c, s)) in state['histograms'].items()])
+
+def save():
+    """ Save metrics for this process to the configured directory, if any.
+    """
+    directory = _settings['directory']
+
+    if not directory:
+        return
+
+    snapshot = _snapshot()
+
+    handle, filename = mkstemp(dir=directory, prefix='.', suffix='.json')
+
+    with os.fdopen(handle, 'w') as file:
+        json.dump(snapshot, file)
+
+    os.rename(filename, pathjoin(directory, '%d.json' % snapshot['pid']))
+
+atexit.register(save)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != ESRCH
+    else:
+        return True
+
+def _snapshots():
+    """ Return metrics snapshots for this process and any others that saved.
+
+        Gauges from processes that have exited are left out.
+    """
+    directory = _settings['directory']
+
+    if not directory:
+        return [_snapshot()]
+
+    save()
+    snapshots = []
+
+    for filename in glob(pathjoin(directory, '*.json')):
+        try:
+            with open(filename) as file:
+                snapshot = json.load(file)
+        except (IOError, ValueError):
+            # the process might be gone, or the file might be a leftover.
+            continue
+
+        if snapshot['pid'] != os.getpid() and not _alive(snapshot['pid']):
+            snapshot['gauges'] = []
+
+        snapshots.append(snapshot)
+
+    return snapshots
+
+def _labels(labels, extra=()):
+    """ Format a list of label pairs, e.g. {layer="osm",zoom="12"}.
+    """
+    pairs = list(labels) + list(extra)
+
+    if not pairs:
+        return ''
+
+    escape = lambda v: unicode(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{%s}' % ','.join(['%s="%s"' % (k, escape(v)) for (k, v) in pairs])
+
+def _number(value):
+    if value == int(value):
+        return '%d' % value
+    return repr(float(value))
+
+def exposition():
+    """ Return all metrics as a string in Prometheus text exposition format.
+    """
+    values, histograms = {}, {}
+
+    for snapshot in _snapshots():
+        for (name, labels, value) in snapshot['counters'] + snapshot['gauges']:
+            key = name, tuple(map(tuple, labels))
+            values[key] = values.get(key, 0) + value
+
+        for (name, labels, counts, total) in snapshot['histograms']:
+            key = name, tuple(map(tuple, labels))
+            old_counts, old_total = histograms.get(key, ([0] * len(counts), 0.))
+            histograms[key] = map(sum, zip(old_counts, counts)), old_total + total
+
+    lines = []
+
+    for name in sorted(set([n for (n, l) in values.keys() + histograms.keys()])):
+        type, help = _declared.get(name, ('untyped', name))
+        lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, type)]
+
+        for ((n, labels), value) in sorted(values.items()):
+            if n == name:
+                lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+
+        for ((n, labels), (counts, total)) in sorted(histograms.items()):
+            if n != name:
+                continue
+
+            count = 0
+
+            for (bucket, bucket_count) in zip(list(buckets) + ['+Inf'], counts):
+                count += bucket_count
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', bucket)]), count))
+
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(total)))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+
+    return '\n'.join(lines + [''])
@@ -20,11 +20,18 @@ fixed-size 772-byte table with 256 3-byte RGB triplets, followed by a two-byte
 unsigned int with the number of defined colors (may be less than 256) and a
 finaly two-byte unsigned int with the optional index of a transparent color
 in the lookup table. If the final byte is 0xFFFF, there is no transparency.
+
+When NumPy is available, palettes are applied to a whole image at once, using
+a per-palette table of the colors seen so far and their palette indexes. Only
+a few palettes and a limited number of colors are remembered. Otherwise,
+pixels are matched one at a time in pure Python.
 """
 from struct import unpack, pack
 from math import sqrt, ceil, log
 from urllib import urlopen
 from operator import add
+from collections import OrderedDict
+from threading import Lock
 
 try:
     from PIL import Image
@@ -32,6 +39,19 @@ except ImportError:
     # On some systems, PIL.Image is known as Image.
     import Image
 
+try:
+    import numpy
+except ImportError:
+    # At least we tried.
+    numpy = None
+
+# Color lookup tables keyed on palette contents and transparency index,
+# least recently used first.
+_color_tables = OrderedDict()
+_color_tables_lock = Lock()
+_max_color_tables = 8
+_max_table_colors = 1 << 16
+
 def load_palette(file_href):
     """ Load colors from a Photoshop .act file, return palette info.
     
@@ -71,11 +91,9 @@ def palette_color(r, g, b, palette, t_index):
     
     return distances.index(min(distances))
 
-def apply_palette(image, palette, t_index):
-    """ Apply a palette array to an image, return a new image.
+def palette_indexes(pixels, palette, t_index):
+    """ Return a string of palette indexes for a string of RGBA pixels.
     """
-    image = image.convert('RGBA')
-    pixels = image.tobytes()
     t_value = (t_index in range(256)) and pack('!B', t_index) or None
     mapping = {}
     indexes = []
@@ -99,11 +117,107 @@ def apply_palette(image, palette, t_index):
             continue
         
         indexes.append(mapping[(r, g, b)])
+    
+    return ''.join(indexes)
+
+def color_table(palette, t_index):
+    """ Return a lookup table from 24-bit colors to palette indexes.
+    
+        Table is a tuple of two NumPy arrays: colors seen so far in sorted
+        order, and their best palette matches. Tables are cached on the
+        palette contents, with at most _max_color_tables kept around.
+    """
+    key = tuple(palette), t_index
+    
+    with _color_tables_lock:
+        if key in _color_tables:
+            table = _color_tables.pop(key)
+        else:
+            table = numpy.empty(0, numpy.int32), numpy.empty(0, numpy.uint8)
+    
+        _color_tables[key] = table
+        
+        while len(_color_tables) > _max_color_tables:
+            _color_tables.popitem(last=False)
+    
+    return table
+
+def save_color_table(palette, t_index, table):
+    """ Replace the lookup table for a palette, if it's still cached.
+    """
+    key = tuple(palette), t_index
+    
+    with _color_tables_lock:
+        if key in _color_tables:
+            _color_tables[key] = table
+
+def palette_indexes_numpy(pixels, palette, t_index):
+    """ Return a string of palette indexes for a string of RGBA pixels.
+    
+        Same output as palette_indexes(), computed with NumPy.
+    """
+    rgba = numpy.frombuffer(pixels, numpy.uint8).reshape(-1, 4).astype(numpy.int32)
+    colors = (rgba[:,0] << 16) | (rgba[:,1] << 8) | rgba[:,2]
+    colors, inverse = numpy.unique(colors, return_inverse=True)
+    
+    known_colors, known_indexes = color_table(palette, t_index)
+    matches = numpy.empty(len(colors), numpy.uint8)
+    
+    if len(known_colors):
+        positions = numpy.searchsorted(known_colors, colors).clip(0, len(known_colors) - 1)
+        found = known_colors[positions] == colors
+        matches[found] = known_indexes[positions[found]]
+    else:
+        found = numpy.zeros(len(colors), bool)
+    
+    unseen = numpy.flatnonzero(~found)
+    
+    if len(unseen):
+        # Match the distances compared by palette_color(), skipping t_index.
+        choices = numpy.array(palette, numpy.int32).reshape(-1, 3)
+        
+        if t_index is not None and t_index < len(choices):
+            choices = numpy.delete(choices, t_index, 0)
+        
+        for offset in range(0, len(unseen), 0x1000):
+            chunk = colors[unseen[offset:offset + 0x1000]]
+            rgb = numpy.column_stack((chunk >> 16, (chunk >> 8) & 0xff, chunk & 0xff))
+            distances = ((rgb[:,numpy.newaxis,:] - choices[numpy.newaxis,:,:]) ** 2).sum(2)
+            matches[unseen[offset:offset + 0x1000]] = distances.argmin(1)
+        
+        if len(known_colors) + len(unseen) <= _max_table_colors:
+            new_colors = numpy.concatenate((known_colors, colors[unseen]))
+            new_indexes = numpy.concatenate((known_indexes, matches[unseen]))
+            order = new_colors.argsort()
+            save_color_table(palette, t_index, (new_colors[order], new_indexes[order]))
+        
+        elif len(colors) <= _max_table_colors:
+            # Table is full, start over with the colors in this image.
+            save_color_table(palette, t_index, (colors, matches))
+    
+    indexes = matches[inverse]
+    
+    if t_index in range(256):
+        # Sufficiently transparent
+        indexes[rgba[:,3] < 0x80] = t_index
+    
+    return indexes.tobytes()
+
+def apply_palette(image, palette, t_index):
+    """ Apply a palette array to an image, return a new image.
+    """
+    image = image.convert('RGBA')
+    pixels = image.tobytes()
+    
+    if numpy is not None:
+        indexes = palette_indexes_numpy(pixels, palette, t_index)
+    else:
+        indexes = palette_indexes(pixels, palette, t_index)
 
-    output = Image.frombytes('P', image.size, ''.join(indexes))
+    output = Image.frombytes('P', image.size, indexes)
     bits = int(ceil(log(len(palette)) / log(2)))
     
-    palette += [(0, 0, 0)] * (256 - len(palette))
+    palette = palette + [(0, 0, 0)] * (256 - len(palette))
     palette = reduce(add, palette)
     output.putpalette(palette)
     
@@ -15,7 +15,8 @@ Example configuration:
     "host": "localhost",
     "port": 6379,
     "db": 0,
-    "key prefix": "unique-id"
+    "key prefix": "unique-id",
+    "max connections": 50
   }
 
 Redis cache parameters:
@@ -36,17 +37,38 @@ Redis cache parameters:
     collisions (though the prefered solution is to use a different
     db number). The key prefix will be prepended to the
     key name. Defaults to "".
-    
 
+  max connections
+    Optional size of the per-process connection pool. Threads wait for
+    a free connection when all of them are busy. Defaults to 50.
+
+  socket timeout
+    Optional number of seconds to wait on a Redis request before
+    giving up. Defaults to no timeout.
+
+  connect timeout
+    Optional number of seconds to wait while connecting to Redis.
+    Defaults to the socket timeout.
+
+  pool timeout
+    Optional number of seconds a thread will wait for a free connection
+    from a full pool before raising an error. Defaults to 20.
+
+Connections are pooled per process and the pool is re-created after a fork,
+so prefork servers never share sockets with their parent.
 """
 from __future__ import absolute_import
-from time import time as _time, sleep as _sleep
+from time import time as _time
+from threading import Lock as _Lock
+from os import getpid as _getpid
 
 # We enabled absolute_import because case insensitive filesystems
 # cause this file to be loaded twice (the name of this file
 # conflicts with the name of the module we want to import).
 # Forcing absolute imports fixes the issue.
 
+from . import Locks
+
 try:
     import redis
 except ImportError:
@@ -66,12 +88,36 @@ def tile_key(layer, coord, format, key_prefix):
 class Cache:
     """
     """
-    def __init__(self, host="localhost", port=6379, db=0, key_prefix=''):
+    def __init__(self, host="localhost", port=6379, db=0, key_prefix='', max_connections=50, socket_timeout=None, connect_timeout=None, pool_timeout=20):
         self.host = host
         self.port = port
         self.db = db
-        self.conn = redis.Redis(host=self.host, port=self.port, db=self.db)
         self.key_prefix = key_prefix
+        self.max_connections = int(max_connections)
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.pool_timeout = pool_timeout
+        
+        self._conn, self._pid = None, None
+        self._conn_lock = _Lock()
+
+    @property
+    def conn(self):
+        """ Return a Redis client on a connection pool for the current process.
+        """
+        with self._conn_lock:
+            if self._pid != _getpid():
+                # first use, or we're in a freshly-forked child process.
+                pool = redis.BlockingConnectionPool(host=self.host, port=self.port, db=self.db,
+                                                    max_connections=self.max_connections,
+                                                    timeout=self.pool_timeout,
+                                                    socket_timeout=self.socket_timeout,
+                                                    socket_connect_timeout=self.connect_timeout)
+                
+                self._conn = redis.Redis(connection_pool=pool)
+                self._pid = _getpid()
+            
+            return self._conn
 
 
     def lock(self, layer, coord, format):
@@ -79,22 +125,41 @@ class Cache:
             Returns nothing, but blocks until the lock has been acquired.
         """
         key = tile_key(layer, coord, format, self.key_prefix) + "-lock" 
-        due = _time() + layer.stale_lock_timeout
+        started = _time()
+        due = started + layer.stale_lock_timeout
+
+        if self.conn.setnx(key, 'locked.'):
+            return Locks.record(started)
+
+        # Subscribe before trying again, so no unlock() is missed.
+        pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
 
-        while _time() < due:
-            if self.conn.setnx(key, 'locked.'):
-                return
+        try:
+            pubsub.subscribe(key)
 
-            _sleep(.2)
+            while _time() < due:
+                if self.conn.setnx(key, 'locked.'):
+                    return Locks.record(started)
+
+                # Wait to be told about an unlock, checking at least once a second.
+                pubsub.get_message(timeout=max(0, min(1, due - _time())))
+
+        finally:
+            pubsub.close()
 
         self.conn.set(key, 'locked.')
-        return
+        Locks.record(started, True)
         
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
         """
         key = tile_key(layer, coord, format, self.key_prefix)
-        self.conn.delete(key+'-lock')
+        
+        # Wake up anyone waiting in lock().
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.delete(key+'-lock')
+        pipe.publish(key+'-lock', 'unlocked.')
+        pipe.execute()
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
@@ -114,3 +179,19 @@ class Cache:
         """
         key = tile_key(layer, coord, format, self.key_prefix)
         self.conn.set(key, body)
+        
+    def read_many(self, layer, coords, format):
+        """ Read a list of cached tiles with a single MGET.
+        """
+        keys = [tile_key(layer, coord, format, self.key_prefix) for coord in coords]
+        return self.conn.mget(keys)
+        
+    def save_many(self, bodies, layer, coords, format):
+        """ Save a list of cached tiles in one pipelined round-trip.
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        
+        for (body, coord) in zip(bodies, coords):
+            pipe.set(tile_key(layer, coord, format, self.key_prefix), body)
+        
+        pipe.execute()
@@ -43,11 +43,12 @@ When access or secret are not provided, the environment variables
 AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY will be used
     http://docs.pythonboto.org/en/latest/s3_tut.html#creating-a-connection
 """
-from time import time as _time, sleep as _sleep
 from mimetypes import guess_type
 from time import strptime, time
 from calendar import timegm
 
+from . import Locks
+
 try:
     from boto.s3.bucket import Bucket as S3Bucket
     from boto.s3.connection import S3Connection
@@ -84,13 +85,9 @@ class Cache:
             return
         
         key_name = tile_key(layer, coord, format, self.path)
-        due = _time() + layer.stale_lock_timeout
         
-        while _time() < due:
-            if not self.bucket.get_key(key_name+'-lock'):
-                break
-            
-            _sleep(.2)
+        # Forced or not, the lock gets taken when the wait is over.
+        Locks.wait_for(lambda: not self.bucket.get_key(key_name+'-lock'), layer.stale_lock_timeout, .05, 1)
         
         key = self.bucket.new_key(key_name+'-lock')
         key.set_contents_from_string('locked.', {'Content-Type': 'text/plain'}, reduced_redundancy=self.reduced_redundancy)
@@ -124,6 +121,40 @@ class Cache:
         
         return key.get_contents_as_string()
         
+    def read_stale(self, layer, coord, format):
+        """ Read a cached tile regardless of lifespan, return a (body, age) tuple.
+        
+            Age is in seconds. Returns None if the tile isn't cached.
+        """
+        key_name = tile_key(layer, coord, format, self.path)
+        key = self.bucket.get_key(key_name)
+        
+        if key is None:
+            return None
+        
+        t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
+        
+        return key.get_contents_as_string(), time() - t
+        
+    def read_info(self, layer, coord, format):
+        """ Return an (etag, last_modified) tuple for a cached tile.
+        
+            Asks for the key's metadata without downloading the tile. The
+            ETag of a tile saved in one piece is the MD5 hash of its contents.
+        """
+        key_name = tile_key(layer, coord, format, self.path)
+        key = self.bucket.get_key(key_name)
+        
+        if key is None:
+            return None
+        
+        t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
+        
+        if layer.cache_lifespan and (time() - t) > layer.cache_lifespan:
+            return None
+        
+        return key.etag, t
+        
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
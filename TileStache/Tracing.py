@@ -0,0 +1,209 @@
+""" Timing traces for slow tile requests.
+
+Layer.getTileResponse() and Layer.render() mark each phase of a request as a
+timed span: reading the cache, waiting for a lock, rendering with the
+provider, applying a palette, encoding the image and saving it to the cache.
+A request that takes longer than a threshold is written out with its full
+breakdown of spans, so you can see where the time went. Add a "tracing"
+section to the configuration:
+
+    {
+      "cache": ...,
+      "layers": ...,
+      "tracing": {
+        "slow": 0.5,
+        "path": "logs/slow-tiles.jsonl"
+      }
+    }
+
+Tracing parameters:
+
+  slow
+    Number of seconds a request may take before it's written out, one
+    second by default. Use zero to write out every request.
+
+  path
+    Optional file to append slow requests to, one JSON object per line.
+    Without it, slow requests are logged as warnings instead.
+
+  exporter
+    Optional exporter for slow requests, in place of path, given as a
+    "class" and "kwargs" like an external provider. An exporter has a single
+    method, export(), which accepts a dictionary like the ones written to
+    the JSON lines file.
+
+  profile
+    Optional fraction of requests to profile with cProfile, e.g. 0.01 for
+    one in a hundred. Profiling is expensive, so keep it small. The profile
+    of a sampled request is kept only if it turns out slow.
+
+  profile directory
+    Optional directory for profiles that can be read with the pstats
+    module. Without it, the twenty slowest functions by cumulative time are
+    included with the slow request.
+
+Each slow request looks like this, with spans nested by depth and times in
+seconds since the start of the request:
+
+    {
+      "name": "getTileResponse", "start": 1380000000.0, "seconds": 0.813,
+      "layer": "osm", "tile": "12/656/1582", "extension": "png",
+      "spans": [
+        {"name": "cache.read", "depth": 1, "start": 0.000, "seconds": 0.002},
+        {"name": "cache.lock", "depth": 1, "start": 0.002, "seconds": 0.001},
+        {"name": "render", "depth": 1, "start": 0.004, "seconds": 0.774},
+        {"name": "provider.renderArea", "depth": 2, "start": 0.004, "seconds": 0.731},
+        ...
+      ]
+    }
+"""
+import logging
+import pstats
+
+from threading import local, Lock
+from tempfile import mkstemp
+from os import close
+from StringIO import StringIO
+from random import random
+from time import time
+from json import dumps
+
+try:
+    from cProfile import Profile
+except ImportError:
+    from profile import Profile
+
+_settings = dict(slow=None, exporter=None, profile=0, profile_dir=None)
+
+# the trace in progress in each thread, if any.
+_local = local()
+
+def configure(slow=1., exporter=None, profile=0, profile_dir=None):
+    """ Turn on tracing for requests slower than slow seconds.
+
+        Use None for slow to turn tracing off again.
+    """
+    _settings.update(slow=slow, exporter=exporter or JSONLinesExporter(),
+                     profile=profile, profile_dir=profile_dir)
+
+class JSONLinesExporter:
+    """ Writes slow requests to a file as JSON, or logs them if there's no file.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = Lock()
+
+    def export(self, record):
+        line = dumps(record, sort_keys=True)
+
+        if self.path is None:
+            logging.warning('TileStache.Tracing slow request %s', line)
+            return
+
+        with self.lock:
+            with open(self.path, 'a') as file:
+                file.write(line + '\n')
+
+class _Span:
+    """ Context manager that times one span of the current trace.
+    """
+    def __init__(self, trace, name):
+        self.trace, self.name = trace, name
+
+    def __enter__(self):
+        self.trace.depth += 1
+        self.start = time()
+
+    def __exit__(self, type, value, traceback):
+        trace, end = self.trace, time()
+        trace.spans.append(dict(name=self.name, depth=trace.depth, start=self.start - trace.start, seconds=end - self.start))
+        trace.depth -= 1
+
+class _Trace:
+    """ Context manager that traces a request in this thread.
+    """
+    def __init__(self, name, attrs):
+        self.name, self.attrs = name, attrs
+        self.spans, self.depth = [], 0
+
+    def __enter__(self):
+        _local.trace = self
+        self.profile = None
+
+        if _settings['profile'] and random() < _settings['profile']:
+            self.profile = Profile()
+            self.profile.enable()
+
+        self.start = time()
+
+    def __exit__(self, type, value, traceback):
+        seconds = time() - self.start
+        _local.trace = None
+
+        if self.profile is not None:
+            self.profile.disable()
+
+        if seconds < _settings['slow']:
+            return
+
+        # spans finish in the wrong order for reading, sort them by start time.
+        self.spans.sort(key=lambda span: (span['start'], span['depth']))
+
+        record = dict(self.attrs, name=self.name, start=self.start, seconds=seconds, spans=self.spans)
+
+        if self.profile is not None:
+            record['profile'] = self._profile()
+
+        try:
+            _settings['exporter'].export(record)
+        except:
+            logging.exception('TileStache.Tracing failed to export a slow request')
+
+    def _profile(self):
+        """ Save the profile to a file and return its name, or return a summary.
+        """
+        if _settings['profile_dir']:
+            handle, filename = mkstemp(dir=_settings['profile_dir'], prefix='tile-', suffix='.prof')
+            close(handle)
+            self.profile.dump_stats(filename)
+            return filename
+
+        out = StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(20)
+        return out.getvalue()
+
+class _Nothing:
+    """ Context manager that does nothing, used when no trace is in progress.
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_nothing = _Nothing()
+
+def trace(name, **attrs):
+    """ Return a context manager that traces a request.
+
+        Inside another trace, this is just a span of the other trace.
+    """
+    current = getattr(_local, 'trace', None)
+
+    if current is not None:
+        return _Span(current, name)
+
+    if _settings['slow'] is None:
+        return _nothing
+
+    return _Trace(name, attrs)
+
+def span(name):
+    """ Return a context manager that times a span of the current trace.
+    """
+    current = getattr(_local, 'trace', None)
+
+    if current is None:
+        return _nothing
+
+    return _Span(current, name)
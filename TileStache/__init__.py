@@ -24,8 +24,10 @@ from os.path import dirname, join as pathjoin, realpath
 from datetime import datetime, timedelta
 from urlparse import urljoin, urlparse
 from wsgiref.headers import Headers
+from wsgiref.util import FileWrapper
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from urllib import urlopen
-from os import getcwd
+from os import getcwd, fstat
 from time import time
 
 import httplib
@@ -43,6 +45,7 @@ _previous_configs = {}
 
 import Core
 import Config
+import Metrics
 
 # regular expression for PATH_INFO
 _pathinfo_pat = re.compile(r'^/?(?P<l>\w.+)/(?P<z>\d+)/(?P<x>-?\d+)/(?P<y>-?\d+)\.(?P<e>\w+)$')
@@ -51,6 +54,9 @@ _preview_pat = re.compile(r'^/?(?P<l>\w.+)/(preview\.html)?$')
 # symbol used to separate layers when specifying more than one layer
 _delimiter = ','
 
+# regular expression for a single HTTP byte range
+_range_pat = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
 def getTile(layer, coord, extension, ignore_cached=False, suppress_cache_write=False):
     ''' Get a type string and tile binary for a given request layer tile.
     
@@ -233,12 +239,25 @@ def clone_layer(layer, provider_names):
         layer.preview_ext,
         layer.bounds,
         layer.dim,
+        layer.recent_tiles,
+        layer.stale_while_revalidate,
         )
     copy.provider = layer.provider
     copy.provider(copy, provider_names)
     return copy
 
 
+def setLayerHeaders(layer, headers):
+    """ Add a layer's cross-origin and cache expiration headers to a response.
+    """
+    if layer.allowed_origin:
+        headers.setdefault('Access-Control-Allow-Origin', layer.allowed_origin)
+
+    if layer.max_cache_age is not None:
+        expires = datetime.utcnow() + timedelta(seconds=layer.max_cache_age)
+        headers.setdefault('Expires', expires.strftime('%a %d %b %Y %H:%M:%S GMT'))
+        headers.setdefault('Cache-Control', 'public, max-age=%d' % layer.max_cache_age)
+
 def requestHandler(config_hint, path_info, query_string=None):
     """ Generate a mime-type and response body for a given request.
     
@@ -310,17 +329,11 @@ def requestHandler2(config_hint, path_info, query_string=None, script_name=''):
         else:
             status_code, headers, content = layer.getTileResponse(coord, extension)
 
-        if layer.allowed_origin:
-            headers.setdefault('Access-Control-Allow-Origin', layer.allowed_origin)
-
         if callback and 'json' in headers['Content-Type']:
             headers['Content-Type'] = 'application/javascript; charset=utf-8'
             content = '%s(%s)' % (callback, content)
         
-        if layer.max_cache_age is not None:
-            expires = datetime.utcnow() + timedelta(seconds=layer.max_cache_age)
-            headers.setdefault('Expires', expires.strftime('%a %d %b %Y %H:%M:%S GMT'))
-            headers.setdefault('Cache-Control', 'public, max-age=%d' % layer.max_cache_age)
+        setLayerHeaders(layer, headers)
 
     except (Core.KnownUnknown, Exception), e:
         logging.exception(e)
@@ -420,6 +433,10 @@ class WSGITileServer:
             except Exception, e:
                 raise Core.KnownUnknown("Error loading Tilestache config file:\n%s" % str(e))
 
+        if environ['PATH_INFO'] == getattr(self.config, 'metrics_path', None):
+            headers = Headers([('Content-Type', 'text/plain; version=0.0.4')])
+            return self._response(start_response, 200, Metrics.exposition(), headers)
+
         try:
             layer, coord, ext = splitPathInfo(environ['PATH_INFO'])
         except Core.KnownUnknown, e:
@@ -436,9 +453,142 @@ class WSGITileServer:
         query_string = environ.get('QUERY_STRING', None)
         script_name = environ.get('SCRIPT_NAME', None)
         
+        if coord is not None and layer in self.config.layers and not query_string:
+            #
+            # Conditional requests may be answered from cache metadata, and
+            # cached tiles in a file can be sent without reading them here.
+            #
+            response = self._infoResponse(environ, start_response, self.config.layers[layer], coord, ext) \
+                    or self._fileResponse(environ, start_response, self.config.layers[layer], coord, ext)
+            
+            if response is not None:
+                return response
+        
         status_code, headers, content = requestHandler2(self.config, path_info, query_string, script_name)
         
-        return self._response(start_response, status_code, str(content), headers)
+        if status_code == 200:
+            modified = parsedate_tz(headers.get('Last-Modified') or '')
+            
+            if _notModified(environ, headers.get('ETag'), modified and mktime_tz(modified)):
+                del headers['Content-Length']
+                return self._response(start_response, 304, '', headers)
+        
+        content = str(content)
+        
+        if coord is not None:
+            Metrics.inc('tilestache_bytes_served_total', len(content), layer=Metrics.layer_label(layer))
+        
+        return self._response(start_response, status_code, content, headers)
+
+    def _infoResponse(self, environ, start_response, layer, coord, extension):
+        """ Respond to a conditional request with 304 Not Modified, if possible.
+        
+            Uses the cache's optional read_info() method, see Caches module,
+            so the tile itself is never read.
+            
+            Returns None if the tile needs a closer look.
+        """
+        if 'HTTP_IF_NONE_MATCH' not in environ and 'HTTP_IF_MODIFIED_SINCE' not in environ:
+            return None
+        
+        if not hasattr(self.config.cache, 'read_info') or extension.lower() in layer.redirects:
+            return None
+        
+        try:
+            mimetype, format = layer.getTypeByExtension(extension)
+            info = self.config.cache.read_info(layer, coord, format)
+        except Exception:
+            # requestHandler2() knows how to report this.
+            return None
+        
+        if info is None or not _notModified(environ, *info):
+            return None
+        
+        etag, mtime = info
+        
+        headers = Headers([('Content-Type', mimetype)])
+        headers['Last-Modified'] = formatdate(mtime, usegmt=True)
+        
+        if etag:
+            headers['ETag'] = etag
+        
+        setLayerHeaders(layer, headers)
+        
+        logging.info('TileStache.WSGITileServer() %s/%d/%d/%d.%s not modified', layer.name(), coord.zoom, coord.column, coord.row, extension)
+        
+        return self._response(start_response, 304, '', headers)
+
+    def _fileResponse(self, environ, start_response, layer, coord, extension):
+        """ Respond with a tile read straight from a cache file, if there is one.
+        
+            Uses the cache's optional read_file() method, see Caches module.
+            Handles conditional and single byte range requests, and passes
+            whole files to wsgi.file_wrapper where available. The weak ETag
+            comes from the file's fstat(), like the one the cache's read_info()
+            gives requestHandler2(), so the file is never read for it.
+            
+            Returns None if the tile needs to go through requestHandler2().
+        """
+        if not hasattr(self.config.cache, 'read_file') or extension.lower() in layer.redirects:
+            return None
+        
+        try:
+            mimetype, format = layer.getTypeByExtension(extension)
+            file = self.config.cache.read_file(layer, coord, format)
+        except Exception:
+            # requestHandler2() knows how to report this.
+            return None
+        
+        if file is None:
+            return None
+        
+        stat = fstat(file.fileno())
+        size, mtime = stat.st_size, stat.st_mtime
+        last_modified = formatdate(mtime, usegmt=True)
+        
+        headers = Headers([('Content-Type', mimetype)])
+        headers['Last-Modified'] = last_modified
+        headers['ETag'] = Core._fileETag(stat)
+        headers['Accept-Ranges'] = 'bytes'
+        setLayerHeaders(layer, headers)
+        
+        logging.info('TileStache.WSGITileServer() %s/%d/%d/%d.%s via cache file', layer.name(), coord.zoom, coord.column, coord.row, extension)
+        
+        if _notModified(environ, headers.get('ETag'), mtime):
+            file.close()
+            return self._response(start_response, 304, '', headers)
+        
+        byte_range = _range_pat.match(environ.get('HTTP_RANGE', ''))
+        
+        if byte_range and environ.get('HTTP_IF_RANGE', last_modified) != last_modified:
+            # The client has an older version of the tile, or only a weak ETag
+            # that can't vouch for single bytes of it, send all of it.
+            byte_range = None
+        
+        if byte_range and (byte_range.group('start') or byte_range.group('end')):
+            start, end = byte_range.group('start'), byte_range.group('end')
+            
+            if not start:
+                # suffix range for the final bytes of the file
+                start, end = max(0, size - int(end)), size - 1
+            else:
+                start, end = int(start), min(int(end or size - 1), size - 1)
+            
+            if start > end:
+                file.close()
+                headers['Content-Range'] = 'bytes */%d' % size
+                return self._response(start_response, 416, '', headers)
+            
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            headers['Content-Length'] = str(end - start + 1)
+            Metrics.inc('tilestache_bytes_served_total', end - start + 1, layer=Metrics.layer_label(layer.name()))
+            start_response('%d %s' % (206, httplib.responses[206]), headers.items())
+            return _readRange(file, start, end - start + 1)
+        
+        headers['Content-Length'] = str(size)
+        Metrics.inc('tilestache_bytes_served_total', size, layer=Metrics.layer_label(layer.name()))
+        start_response('%d %s' % (200, httplib.responses[200]), headers.items())
+        return environ.get('wsgi.file_wrapper', FileWrapper)(file, 0x10000)
 
     def _response(self, start_response, code, content='', headers=None):
         """
@@ -451,6 +601,45 @@ class WSGITileServer:
         start_response('%d %s' % (code, httplib.responses[code]), headers.items())
         return [content]
 
+def _notModified(environ, etag, last_modified):
+    """ Return true if a conditional request's copy of a tile is still good.
+    
+        If-None-Match is checked against etag when the request has one, and
+        If-Modified-Since against a last_modified timestamp otherwise. Returns
+        None if there's not enough known about the tile to answer.
+    """
+    if 'HTTP_IF_NONE_MATCH' in environ:
+        if etag is None:
+            return None
+        
+        tags = [tag.strip() for tag in environ['HTTP_IF_NONE_MATCH'].split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    
+    since = parsedate_tz(environ.get('HTTP_IF_MODIFIED_SINCE', ''))
+    
+    if since and last_modified is not None:
+        return int(last_modified) <= mktime_tz(since)
+    
+    return None
+
+def _readRange(file, offset, length, blocksize=0x10000):
+    """ Generate length bytes from a file starting at offset, then close it.
+    """
+    try:
+        file.seek(offset)
+        
+        while length > 0:
+            chunk = file.read(min(blocksize, length))
+            
+            if not chunk:
+                break
+            
+            length -= len(chunk)
+            yield chunk
+    
+    finally:
+        file.close()
+
 def modpythonHandler(request):
     """ Handle a mod_python request.
     
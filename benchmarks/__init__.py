@@ -0,0 +1,12 @@
+""" Microbenchmarks for TileStache's tile serving paths.
+
+Run the whole suite from the top of the TileStache source tree and save the
+results as JSON, e.g. to compare one release with the next:
+
+    python benchmarks/run.py --output benchmark.json
+
+See `python benchmarks/run.py --help` for more options. Benchmarks use the
+synthetic providers in benchmarks.providers, so they need no network or
+map data, and local caches in a temporary directory. Redis and Memcache
+benchmarks run only when a server is listening on the default port.
+"""
@@ -0,0 +1,81 @@
+""" Synthetic providers for benchmarks.
+
+These render quickly and the same way every time, with enough detail in each
+tile that image encoding and caching costs look like real map tiles.
+"""
+from random import Random
+from StringIO import StringIO
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    import Image, ImageDraw
+
+class DrawingProvider:
+    ''' Draws random lines and circles, seeded by the area being drawn.
+    '''
+    def __init__(self, layer, color='#996633', shapes=64):
+        self.layer = layer
+        self.color = color
+        self.shapes = shapes
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        rand = Random(hash((xmin, ymin, zoom)))
+        image = Image.new('RGBA', (width, height), (0xf0, 0xf0, 0xe8, 0xff))
+        draw = ImageDraw.Draw(image)
+
+        for i in range(self.shapes * (width * height) / 0x10000):
+            x1, y1 = rand.randrange(width), rand.randrange(height)
+            x2, y2 = x1 + rand.randrange(-64, 64), y1 + rand.randrange(-64, 64)
+
+            if i % 4:
+                draw.line((x1, y1, x2, y2), fill=self.color, width=rand.randrange(1, 4))
+            else:
+                draw.ellipse((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), outline=self.color)
+
+        return image
+
+class GeoJSONProvider:
+    ''' Makes random lines in a tile for VecTiles' GeoJSON encoder.
+    '''
+    def __init__(self, layer, features=200):
+        self.layer = layer
+        self.features = features
+
+    def renderTile(self, width, height, srs, coord):
+        from shapely.geometry import LineString
+
+        rand = Random(hash((coord.zoom, coord.column, coord.row)))
+        location = self.layer.projection.coordinateLocation(coord)
+        span = 360. / 2**coord.zoom
+
+        features = []
+
+        for i in range(self.features):
+            points = [(location.lon + rand.random() * span, location.lat - rand.random() * span / 2)
+                      for j in range(rand.randrange(2, 12))]
+
+            properties = dict(kind='road', name='Road %d' % i, lanes=rand.randrange(1, 5))
+            features.append((LineString(points).wkb, properties, i))
+
+        return GeoJSONResponse(features, coord.zoom)
+
+    def getTypeByExtension(self, extension):
+        ''' Get mime-type and format by file extension, "json" only.
+        '''
+        if extension.lower() != 'json':
+            raise ValueError(extension + ' is not a valid extension')
+
+        return 'application/json', 'JSON'
+
+class GeoJSONResponse:
+    ''' Wrapper class for features that makes them behave like a PIL.Image object.
+    '''
+    def __init__(self, features, zoom):
+        self.features = features
+        self.zoom = zoom
+
+    def save(self, out, format):
+        from TileStache.Goodies.VecTiles import geojson
+
+        geojson.encode(out, self.features, self.zoom)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""Run TileStache microbenchmarks and write the results as JSON.
+
+Each benchmark calls one tile serving path over and over for a few seconds,
+and reports calls per second and latency percentiles in milliseconds:
+
+- hit-<cache>: getTile() for tiles already in the cache, except Test.
+- miss-<cache>: getTile() for new tiles, rendered, encoded and saved.
+- metatile-<cache>: getTile() for new 4x4 metatiles.
+- palette-numpy, palette-python: matching a 256px tile to palette colors,
+  as Pixels.apply_palette() does with and without NumPy.
+- geojson: getTile() for GeoJSON from VecTiles' encoder.
+- composite: getTile() for two layers blended by the Composite provider.
+
+Caches are Test, Disk and MBTiles in a temporary directory, on tmpfs where
+/dev/shm is available, and Redis and Memcache where a server is listening.
+Benchmarks that can't run here, e.g. for lack of NumPy, are listed with the
+reason they were skipped.
+
+Example:
+
+    python benchmarks/run.py --duration 5 --output benchmark.json
+
+Results look like this:
+
+    {
+      "tilestache": "1.51.5", "python": "2.7.18", "platform": "...",
+      "started": "2014-01-01T00:00:00Z", "duration": 5.0,
+      "benchmarks": [
+        {"name": "hit-Disk", "iterations": 51020, "seconds": 5.0,
+         "per_second": 10204.0, "mean_ms": 0.098, "min_ms": 0.081,
+         "p50_ms": 0.091, "p95_ms": 0.132, "p99_ms": 0.208},
+        {"name": "composite", "skipped": "ImportError: No module named sympy"},
+        ...
+      ]
+    }
+"""
+import os
+import sys
+import json
+import socket
+import platform
+
+from time import time, gmtime, strftime
+from tempfile import mkdtemp
+from shutil import rmtree
+from optparse import OptionParser
+from os.path import dirname, abspath, isdir, join
+
+# run from a source tree without installing TileStache first.
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import TileStache
+
+from TileStache.Config import buildConfiguration
+from TileStache import Pixels, getTile
+
+from ModestMaps.Core import Coordinate
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+parser = OptionParser(usage="""%prog [options]
+
+Runs TileStache microbenchmarks with synthetic providers and local caches,
+and writes the results as JSON. See `%prog --help` for info.""")
+
+defaults = dict(duration=2.0, output=None, tmpdir=None, names=[],
+                redis='localhost:6379', memcache='127.0.0.1:11211')
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-d', '--duration', dest='duration', type='float',
+                  help='Seconds to run each benchmark, default %(duration).1f.' % defaults)
+
+parser.add_option('-o', '--output', dest='output',
+                  help='Optional file for JSON results, otherwise they go to stdout.')
+
+parser.add_option('-t', '--tmpdir', dest='tmpdir',
+                  help='Optional directory for Disk and MBTiles caches, default /dev/shm where there is one.')
+
+parser.add_option('-b', '--benchmark', dest='names', action='append',
+                  help='Optional name of a benchmark to run, or the start of several names. Can be repeated.')
+
+parser.add_option('--redis', dest='redis',
+                  help='Host and port of a Redis server, default "%(redis)s".' % defaults)
+
+parser.add_option('--memcache', dest='memcache',
+                  help='Host and port of a Memcache server, default "%(memcache)s".' % defaults)
+
+def listening(address):
+    """ Return true if a server is listening at a "host:port" address.
+    """
+    host, port = address.split(':')
+
+    try:
+        socket.create_connection((host, int(port)), .5).close()
+    except socket.error:
+        return False
+    else:
+        return True
+
+def caches(options, tmpdir):
+    """ Return a list of (name, cache configuration) pairs for benchmarks.
+    """
+    caches = [('Test', {'name': 'Test'}),
+              ('Disk', {'name': 'Disk', 'path': join(tmpdir, 'disk')}),
+              ('MBTiles', {'class': 'TileStache.MBTiles:Cache',
+                           'kwargs': {'filename': join(tmpdir, 'tiles.mbtiles'),
+                                      'format': 'png', 'name': 'drawing'}})]
+
+    if listening(options.redis):
+        host, port = options.redis.split(':')
+        caches.append(('Redis', {'name': 'Redis', 'host': host, 'port': int(port),
+                                 'key prefix': 'tilestache-benchmark-%d' % time()}))
+
+    if listening(options.memcache):
+        caches.append(('Memcache', {'name': 'Memcache', 'servers': [options.memcache],
+                                    'key prefix': 'tilestache-benchmark-%d' % time()}))
+
+    return caches
+
+def layer(cache_dict, tmpdir, **layer_dict):
+    """ Return a layer of drawings for a cache configuration.
+    """
+    layer_dict.setdefault('provider', {'class': 'benchmarks.providers:DrawingProvider'})
+    config = buildConfiguration({'cache': cache_dict, 'layers': {'drawing': layer_dict}}, tmpdir)
+
+    return config.layers['drawing']
+
+def coordinates(zoom, step=1):
+    """ Generate coordinates across a row of tiles, step columns apart.
+    """
+    column = 0
+
+    while True:
+        yield Coordinate(2**(zoom - 1), column, zoom)
+        column += step
+
+def hit_benchmark(cache_dict, tmpdir):
+    drawing = layer(cache_dict, tmpdir)
+    coords = [Coordinate(row, column, 10) for row in range(16) for column in range(16)]
+
+    for coord in coords:
+        getTile(drawing, coord, 'png')
+
+    if hasattr(drawing.config.cache, 'flush'):
+        drawing.config.cache.flush()
+
+    return lambda i: getTile(drawing, coords[i % len(coords)], 'png')
+
+def miss_benchmark(cache_dict, tmpdir):
+    drawing, coords = layer(cache_dict, tmpdir), coordinates(18)
+    return lambda i: getTile(drawing, coords.next(), 'png')
+
+def metatile_benchmark(cache_dict, tmpdir):
+    drawing = layer(cache_dict, tmpdir, metatile={'rows': 4, 'columns': 4})
+    coords = coordinates(17, 4)
+    return lambda i: getTile(drawing, coords.next(), 'png')
+
+def palette_benchmark(palette_indexes):
+    def benchmark(cache_dict, tmpdir):
+        drawing = layer({'name': 'Test'}, tmpdir)
+        image = drawing.render(Coordinate(0, 0, 1), 'png').convert('RGBA')
+        palette = [((i * 53) % 256, (i * 97) % 256, (i * 193) % 256) for i in range(256)]
+
+        pixels = image.tobytes()
+        palette_indexes(pixels, palette, None)
+
+        return lambda i: palette_indexes(pixels, palette, None)
+
+    return benchmark
+
+def geojson_benchmark(cache_dict, tmpdir):
+    import shapely
+
+    drawing = layer({'name': 'Test'}, tmpdir, provider={'class': 'benchmarks.providers:GeoJSONProvider'})
+    coords = coordinates(14)
+    return lambda i: getTile(drawing, coords.next(), 'json')
+
+def composite_benchmark(cache_dict, tmpdir):
+    import numpy, sympy
+
+    config = buildConfiguration({
+        'cache': {'name': 'Test'},
+        'layers': {
+            'base': {'provider': {'class': 'benchmarks.providers:DrawingProvider'}},
+            'overlay': {'provider': {'class': 'benchmarks.providers:DrawingProvider',
+                                     'kwargs': {'color': '#336699'}}},
+            'composite': {'provider': {'class': 'TileStache.Goodies.Providers.Composite:Provider',
+                                       'kwargs': {'stack': [{'src': 'base'},
+                                                            {'src': 'overlay', 'mode': 'screen', 'opacity': 0.5}]}}}
+        }
+    }, tmpdir)
+
+    coords = coordinates(14)
+    return lambda i: getTile(config.layers['composite'], coords.next(), 'png')
+
+def benchmarks(options, tmpdir):
+    """ Return a list of (name, cache configuration, setup function) tuples.
+
+        Setup functions return a function to call repeatedly with a counter.
+    """
+    benchmarks, cache_dicts = [], caches(options, tmpdir)
+
+    for (prefix, setup) in (('hit-', hit_benchmark), ('miss-', miss_benchmark), ('metatile-', metatile_benchmark)):
+        for (name, cache_dict) in cache_dicts:
+            if (prefix, name) != ('hit-', 'Test'):
+                benchmarks.append((prefix + name, cache_dict, setup))
+
+    if Pixels.numpy is not None:
+        benchmarks.append(('palette-numpy', None, palette_benchmark(Pixels.palette_indexes_numpy)))
+
+    benchmarks.append(('palette-python', None, palette_benchmark(Pixels.palette_indexes)))
+    benchmarks.append(('geojson', None, geojson_benchmark))
+    benchmarks.append(('composite', None, composite_benchmark))
+
+    if options.names:
+        benchmarks = [b for b in benchmarks if [n for n in options.names if b[0].startswith(n)]]
+
+    return benchmarks
+
+def run(func, duration):
+    """ Call func until duration seconds have passed, return a result dictionary.
+    """
+    times, started = [], time()
+
+    while time() - started < duration or not times:
+        start = time()
+        func(len(times))
+        times.append(time() - start)
+
+    seconds = time() - started
+    times.sort()
+
+    percentile = lambda p: round(times[min(len(times) - 1, int(len(times) * p))] * 1000, 3)
+
+    return dict(iterations=len(times), seconds=round(seconds, 3),
+                per_second=round(len(times) / seconds, 1),
+                mean_ms=round(sum(times) / len(times) * 1000, 3), min_ms=round(times[0] * 1000, 3),
+                p50_ms=percentile(.5), p95_ms=percentile(.95), p99_ms=percentile(.99))
+
+if __name__ == '__main__':
+    options, args = parser.parse_args()
+
+    if options.tmpdir is None and isdir('/dev/shm'):
+        options.tmpdir = '/dev/shm'
+
+    tmpdir = mkdtemp(prefix='tilestache-benchmark-', dir=options.tmpdir)
+
+    results = dict(tilestache=TileStache.__version__, python=platform.python_version(),
+                   platform=platform.platform(), started=strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()),
+                   duration=options.duration, benchmarks=[])
+
+    try:
+        for (name, cache_dict, setup) in benchmarks(options, tmpdir):
+            try:
+                func = setup(cache_dict, tmpdir)
+                func(0) # warm up
+                result = dict(run(func, options.duration), name=name)
+
+            except Exception, e:
+                result = dict(name=name, skipped='%s: %s' % (e.__class__.__name__, e))
+                print >> sys.stderr, '%-20s skipped, %s' % (name, result['skipped'])
+
+            else:
+                print >> sys.stderr, '%(name)-20s %(per_second)10.1f/sec %(p50_ms)9.3fms p50 %(p99_ms)9.3fms p99' % result
+
+            results['benchmarks'].append(result)
+
+    finally:
+        rmtree(tmpdir)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    print >> output, ''
@@ -63,6 +63,21 @@ parser.add_option('-i', '--include-path', dest='include',
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
+def dedupedCaches(cache):
+    """ Generate Disk caches with dedupe turned on, looking inside Multi caches.
+    """
+    if isinstance(cache, Disk) and cache.dedupe:
+        yield cache
+    
+    elif isinstance(cache, Multi):
+        for tier in cache.tiers:
+            for cache in dedupedCaches(tier):
+                yield cache
+    
+    elif isinstance(cache, WriteBehind):
+        for cache in dedupedCaches(cache.cache):
+            yield cache
+
 def generateCoordinates(ul, lr, zooms, padding):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
@@ -119,7 +134,7 @@ if __name__ == '__main__':
 
     from TileStache import parseConfigfile, getTile
     from TileStache.Core import KnownUnknown
-    from TileStache.Caches import Disk, Multi
+    from TileStache.Caches import Disk, Multi, WriteBehind
     
     from ModestMaps.Core import Coordinate
     from ModestMaps.Geo import Location
@@ -209,3 +224,12 @@ if __name__ == '__main__':
                 fp = open(progressfile, 'w')
                 json_dump(progress, fp)
                 fp.close()
+
+    # tiles in a deduped Disk cache are links, so remove what they pointed to.
+    # bodies used in the past hour are kept, in case a server is saving them.
+
+    for cache in dedupedCaches(config.cache):
+        count = cache.remove_unreferenced()
+    
+        if options.verbose:
+            print >> stderr, 'Removed %d unreferenced tile bodies from %s' % (count, cache.cachepath)
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+"""tilestache-loadtest.py will find out how fast your tiles are served.
+
+This script is intended to be run directly. This example replays the tile
+requests in an access log against a configuration, eight at a time, in this
+process:
+
+    tilestache-loadtest.py -c ./config.json --log access.log --concurrency 8
+
+This example makes 5000 requests to a server for tiles around West Oakland,
+picking popular tiles more often than others like real visitors do:
+
+    tilestache-loadtest.py --url http://localhost:8080 -l osm -b 37.79 -122.35 37.83 -122.25 -n 5000 12 13 14 15
+
+Output is a report of throughput and latency percentiles, with requests for
+tiles found in a cache counted apart from those rendered on the spot. Requests
+that fail or get an HTTP status of 400 or more are counted as errors.
+
+See `tilestache-loadtest.py --help` for more information.
+"""
+
+from sys import stdout, path
+from os.path import realpath
+from optparse import OptionParser
+from threading import Thread, local
+from Queue import Queue
+from random import Random
+from bisect import bisect
+from time import time
+from urlparse import urlparse
+import httplib
+import logging
+import re
+
+try:
+    from json import dump as json_dump
+except ImportError:
+    from simplejson import dump as json_dump
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [zoom...]
+
+Replays tile requests against a TileStache configuration in this process, or
+against a tile server over HTTP, and reports throughput and latency. Requests
+come from the tile paths found in an access log, e.g. "/osm/12/656/1582.png",
+or from a bounding box given as a pair of lat/lon coordinates along with a
+list of zoom levels, e.g. "37.788 -122.349 37.833 -122.246" and "12 13 14".
+
+Tiles in a bounding box are requested following a Zipf distribution: low zoom
+tiles are the most popular, and a few tiles at each zoom are requested much
+more often than the rest.
+
+In this process, requests served from a cache are told apart from renders by
+watching TileStache's log messages. Over HTTP, a response header such as
+"X-Cache" can be used to tell them apart with --source-header.
+
+Example:
+
+    tilestache-loadtest.py -c tilestache.cfg -l osm -b 52.55 13.28 52.46 13.51 -n 2000 11 12 13
+
+Configuration or URL, and log or layer options are required; see `%prog --help` for info.""")
+
+defaults = dict(concurrency=4, requests=None, zipf=1.1, extension='png', seed=0, bbox=(37.777, -122.352, 37.839, -122.226))
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file, to make requests to WSGITileServer in this process.')
+
+parser.add_option('-u', '--url', dest='url',
+                  help='Base URL of a tile server, to make requests over HTTP instead, e.g. "http://localhost:8080".')
+
+parser.add_option('--log', dest='log',
+                  help='Access log with tile paths to replay in order, one request per line.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name, required with --bbox. With --log, only requests for this layer are replayed.')
+
+parser.add_option('-b', '--bbox', dest='bbox',
+                  help='Bounding box in floating point geographic coordinates: south west north east. Default value is %.3f, %.3f, %.3f, %.3f.' % defaults['bbox'],
+                  type='float', nargs=4)
+
+parser.add_option('-e', '--extension', dest='extension',
+                  help='File type of tiles requested in the bounding box. Default value is "%(extension)s".' % defaults)
+
+parser.add_option('-n', '--requests', dest='requests',
+                  help='Number of requests to make. Default value is 1000, or every line in --log.',
+                  type='int')
+
+parser.add_option('-z', '--zipf', dest='zipf',
+                  help='Exponent of the Zipf distribution of tile popularity, higher for fewer popular tiles. Default value is %(zipf).1f.' % defaults,
+                  type='float')
+
+parser.add_option('--seed', dest='seed',
+                  help='Random seed, so that runs can be compared. Default value is %(seed)d.' % defaults,
+                  type='int')
+
+parser.add_option('-t', '--concurrency', dest='concurrency',
+                  help='Number of requests made at once, each from its own thread. Default value is %(concurrency)d.' % defaults,
+                  type='int')
+
+parser.add_option('--source-header', dest='source_header',
+                  help='Response header that tells cache hits from renders over HTTP, e.g. "X-Cache". Responses with "hit" in this header count as hits.')
+
+parser.add_option('--json', dest='json',
+                  help='Optional file for a JSON copy of the report.')
+
+parser.add_option('-i', '--include-path', dest='include_paths',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+# tile paths in an access log, e.g. "GET /osm/12/656/1582.png HTTP/1.1".
+tile_path_pat = re.compile(r'/(?P<l>[\w.,-]+)/(?P<z>\d+)/(?P<x>-?\d+)/(?P<y>-?\d+)\.(?P<e>\w+)\b')
+
+def logPaths(filename, layername, count):
+    """ Return a list of tile paths found in an access log.
+    """
+    paths = []
+
+    for line in open(filename, 'r'):
+        match = tile_path_pat.search(line)
+
+        if match is None or (layername and match.group('l') != layername):
+            continue
+
+        paths.append(match.group(0))
+
+        if count and len(paths) == count:
+            break
+
+    return paths
+
+def zipfPaths(layername, bbox, zooms, extension, count, exponent, seed):
+    """ Return a list of tile paths in a bounding box, popular ones more often.
+
+        Tiles are ranked by zoom level, then at random within each zoom, and
+        the tile at rank k is picked with a weight of 1 / k^exponent.
+    """
+    projection = getProjectionByName('spherical mercator')
+    south, west, north, east = bbox
+    rand = Random(seed)
+    tiles = []
+
+    for zoom in sorted(zooms):
+        ul = projection.locationCoordinate(Location(north, west)).zoomTo(zoom).container()
+        lr = projection.locationCoordinate(Location(south, east)).zoomTo(zoom).container()
+
+        level = [(zoom, column, row) for row in xrange(int(ul.row), int(lr.row + 1))
+                                     for column in xrange(int(ul.column), int(lr.column + 1))]
+
+        rand.shuffle(level)
+        tiles += level
+
+        if len(tiles) > 1000000:
+            raise KnownUnknown('More than a million tiles at zoom %d, try a smaller bounding box.' % zoom)
+
+    weights, total = [], 0.
+
+    for rank in range(1, len(tiles) + 1):
+        total += 1. / rank ** exponent
+        weights.append(total)
+
+    paths = []
+
+    for i in range(count):
+        zoom, column, row = tiles[bisect(weights, rand.random() * total)]
+        paths.append('/%s/%d/%d/%d.%s' % (layername, zoom, column, row, extension))
+
+    return paths
+
+class SourceHandler(logging.Handler):
+    """ Notes where each thread's last tile came from, using TileStache's log messages.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self, logging.INFO)
+        self.sources = local()
+
+    def emit(self, record):
+        if not isinstance(record.msg, str):
+            return
+
+        if record.msg.startswith('TileStache.Core.Layer.getTileResponse()'):
+            # the args end with where the tile came from and the time it took.
+            self.sources.last = record.args[-2]
+
+        elif record.msg.startswith('TileStache.WSGITileServer()'):
+            # e.g. "via cache file" or "not modified"
+            self.sources.last = record.msg.split(' %s/%d/%d/%d.%s ')[-1].replace('via ', '')
+
+    def pop(self):
+        source, self.sources.last = getattr(self.sources, 'last', None), None
+        return source
+
+def wsgiRequester(app, sources):
+    """ Return a function that requests a tile path from a WSGI application.
+    """
+    def request(path):
+        environ = dict(PATH_INFO=path, QUERY_STRING='', SCRIPT_NAME='', REQUEST_METHOD='GET')
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = int(status.split()[0])
+
+        sources.pop()
+        body = app(environ, start_response)
+        size = sum(map(len, body))
+
+        if hasattr(body, 'close'):
+            body.close()
+
+        return response['status'], size, sources.pop()
+
+    return request
+
+def httpRequester(url, source_header):
+    """ Return a function that requests a tile path over HTTP.
+
+        Each thread keeps its own connection open between requests.
+    """
+    base = urlparse(url)
+    connections = local()
+
+    def request(path):
+        if not hasattr(connections, 'conn'):
+            connections.conn = httplib.HTTPConnection(base.netloc, timeout=60)
+
+        try:
+            connections.conn.request('GET', base.path.rstrip('/') + path)
+            resp = connections.conn.getresponse()
+            body = resp.read()
+        except (httplib.HTTPException, IOError):
+            # start over with a new connection next time.
+            del connections.conn
+            raise
+
+        source = resp.getheader(source_header, '') if source_header else None
+
+        if source_header:
+            source = 'hit' in source.lower() and 'hit' or 'render'
+
+        return resp.status, len(body), source
+
+    return request
+
+def category(source):
+    """ Sort the source of a tile into "hit", "render" or "unknown".
+    """
+    if source is None:
+        return 'unknown'
+
+    if source in ('layer.render()', 'another thread', 'render'):
+        # waiting on another thread's render is no faster than rendering.
+        return 'render'
+
+    return 'hit'
+
+def work(request, paths, results):
+    """ Make requests for paths from a queue until a None comes along.
+    """
+    while True:
+        path = paths.get()
+
+        if path is None:
+            break
+
+        start = time()
+
+        try:
+            status, size, source = request(path)
+        except Exception, e:
+            status, size, source = None, 0, '%s: %s' % (e.__class__.__name__, e)
+
+        results.append((path, status, size, source, time() - start))
+
+def summarize(times):
+    """ Return count and percentiles in milliseconds for a list of times.
+    """
+    times = sorted(times)
+
+    if not times:
+        return dict(count=0)
+
+    percentile = lambda p: round(times[min(len(times) - 1, int(len(times) * p))] * 1000, 3)
+
+    return dict(count=len(times), mean_ms=round(sum(times) / len(times) * 1000, 3),
+                p50_ms=percentile(.5), p95_ms=percentile(.95), p99_ms=percentile(.99), max_ms=percentile(1))
+
+def report(results, seconds, concurrency):
+    """ Return a dictionary of throughput and latencies from a list of results.
+    
+        Requests that failed or got a status of 400 or more count as errors,
+        and are left out of the latencies.
+    """
+    ok = [r for r in results if r[1] is not None and r[1] < 400]
+    errors = [(path, status, source) for (path, status, size, source, s) in results if status is None or status >= 400]
+
+    categories = {}
+    sources = {}
+
+    for (path, status, size, source, seconds_) in ok:
+        categories.setdefault(category(source), []).append(seconds_)
+        sources.setdefault(source or 'unknown', []).append(seconds_)
+
+
+    return dict(requests=len(results), seconds=round(seconds, 3), concurrency=concurrency,
+                per_second=round(len(results) / seconds, 1), bytes=sum([r[2] for r in ok]),
+                errors=len(errors), first_errors=errors[:10],
+                all=summarize([r[4] for r in ok]),
+                categories=dict([(c, summarize(t)) for (c, t) in categories.items()]),
+                sources=dict([(s, summarize(t)) for (s, t) in sources.items()]))
+
+def printReport(report, out):
+    """ Print a report as a table of latencies.
+    """
+    print >> out, '%(requests)d requests in %(seconds).1fs, %(per_second).1f/sec with %(concurrency)d at once, %(errors)d errors (failed or status 400+)' % report
+    print >> out, ''
+    print >> out, '%-24s %8s %10s %10s %10s %10s' % ('', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')
+
+    rows = [('all', report['all'])] + sorted(report['categories'].items())
+
+    if len(report['sources']) > 1:
+        rows += [('  via ' + s, summary) for (s, summary) in sorted(report['sources'].items())]
+
+    for (name, summary) in rows:
+        if summary['count']:
+            print >> out, '%(name)-24s %(count)8d %(p50_ms)10.1f %(p95_ms)10.1f %(p99_ms)10.1f %(max_ms)10.1f' % dict(summary, name=name)
+
+    for (path, status, source) in report['first_errors']:
+        print >> out, 'error: %s %s %s' % (path, status or '', source or '')
+
+if __name__ == '__main__':
+    options, zooms = parser.parse_args()
+
+    if options.include_paths:
+        for p in options.include_paths.split(':'):
+            path.insert(0, p)
+
+    from TileStache import parseConfigfile, WSGITileServer
+    from TileStache.Core import KnownUnknown
+    from TileStache.Geography import getProjectionByName
+
+    from ModestMaps.Geo import Location
+
+    try:
+        if bool(options.config) == bool(options.url):
+            raise KnownUnknown('Exactly one of configuration (--config) or URL (--url) parameters is required.')
+
+        if options.log:
+            paths = logPaths(options.log, options.layer, options.requests)
+
+        elif options.layer:
+            zooms = map(int, zooms)
+
+            if not zooms:
+                raise KnownUnknown('At least one zoom level is required with a bounding box.')
+
+            paths = zipfPaths(options.layer, options.bbox, zooms, options.extension,
+                              options.requests or 1000, options.zipf, options.seed)
+
+        else:
+            raise KnownUnknown('Missing required log (--log) or layer (--layer) parameter.')
+
+        if not paths:
+            raise KnownUnknown('No tile requests to make.')
+
+        if options.config:
+            # TileStache says where each tile came from at INFO level.
+            sources = SourceHandler()
+            logging.getLogger().addHandler(sources)
+            logging.getLogger().setLevel(logging.INFO)
+
+            request = wsgiRequester(WSGITileServer(realpath(options.config)), sources)
+
+        else:
+            request = httpRequester(options.url, options.source_header)
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    queue, results = Queue(), []
+
+    for path_ in paths:
+        queue.put(path_)
+
+    threads = [Thread(target=work, args=(request, queue, results)) for i in range(options.concurrency)]
+
+    for thread in threads:
+        queue.put(None)
+        thread.daemon = True
+
+    started = time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        while thread.is_alive():
+            # join() with a timeout so Ctrl-C still works.
+            thread.join(1)
+
+    loadtest = report(results, time() - started, options.concurrency)
+    printReport(loadtest, stdout)
+
+    if options.json:
+        json_dump(loadtest, open(options.json, 'w'), indent=2, sort_keys=True)
@@ -12,6 +12,8 @@ See `tilestache-seed.py --help` for more information.
 from sys import stderr, path
 from os.path import realpath, dirname
 from optparse import OptionParser
+from collections import OrderedDict
+from multiprocessing import Pool
 from urlparse import urlparse
 from urllib import urlopen
 
@@ -43,7 +45,7 @@ Protip: extract tiles from an MBTiles tileset to a directory like this:
 
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(padding=0, verbose=True, enable_retries=False, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(padding=0, verbose=True, enable_retries=False, workers=1, bbox=(37.777, -122.352, 37.839, -122.226))
 
 parser.set_defaults(**defaults)
 
@@ -79,6 +81,12 @@ parser.add_option('-d', '--output-directory', dest='outputdirectory',
 parser.add_option('--to-mbtiles', dest='mbtiles_output',
                   help='Optional output file for tiles, will be created as an MBTiles 1.1 tileset. See http://mbtiles.org for more information.')
 
+parser.add_option('--dedupe-mbtiles', dest='mbtiles_dedupe', action='store_true',
+                  help='Create the --to-mbtiles tileset with the deduplicated layout, storing identical tiles only once.')
+
+parser.add_option('--to-archive', dest='archive_output',
+                  help='Optional output file for tiles, will be written as a single-file TileStache archive when seeding is done. Tiles already in the archive are kept. More information in TileStache.Archive.')
+
 parser.add_option('--to-s3', dest='s3_output',
                   help='Optional output bucket for tiles, will be populated with tiles in a standard Z/X/Y layout. Three required arguments: AWS access-key, secret, and bucket name.',
                   nargs=3)
@@ -96,6 +104,10 @@ parser.add_option('--enable-retries', dest='enable_retries',
                   help='If true this will cause tilestache-seed to retry failed tile renderings up to (3) times. Default value is %s.' % repr(defaults['enable_retries']),
                   action='store_true')
 
+parser.add_option('-w', '--workers', dest='workers',
+                  help='Number of worker processes rendering tiles in parallel, each with its own copy of the configuration. Work is divided by whole metatiles so no two workers render the same one. Default value is %s.' % repr(defaults['workers']),
+                  type='int')
+
 parser.add_option('-x', '--ignore-cached', action='store_true', dest='ignore_cached',
                   help='Re-render every tile, whether it is in the cache already or not.')
 
@@ -160,6 +172,130 @@ def tilesetCoordinates(filename):
     for (offset, coord) in enumerate(coords):
         yield (offset, count, coord)
 
+def metatileGroups(coordinates, metatile):
+    """ Generate a stream of lists of (offset, count, coordinate) tuples.
+    
+        Each list holds the coordinates belonging to a single metatile, as
+        identified by Metatile.firstCoord(). Coordinates are expected in the
+        zoom, row, column order of generateCoordinates(): pending groups are
+        flushed whenever a complete band of metatile rows has gone by.
+    """
+    groups, band = OrderedDict(), None
+    
+    for (offset, count, coord) in coordinates:
+        first = metatile.firstCoord(coord)
+        
+        if (first.zoom, first.row) != band:
+            for group in groups.values():
+                yield group
+            
+            groups, band = OrderedDict(), (first.zoom, first.row)
+        
+        groups.setdefault(first.column, []).append((offset, count, coord))
+    
+    for group in groups.values():
+        yield group
+
+def groupRequests(group, one_per_metatile, layer, extension, ignore_cached):
+    """ Return a list of (coordinate, covered, ignore_cached) tuples for one metatile group.
+    
+        Covered is the list of (offset, count, coordinate) tuples that are
+        finished once the tile at coordinate has been fetched. With a single
+        request per metatile, the first coordinate stands in for the whole
+        group: Layer.render() writes every subtile to the cache at once, so
+        there is no need to request the others one at a time.
+        
+        The first subtile may be cached while others are not, after an
+        interrupted seed or an expired or evicted tile, so the group is looked
+        up in the cache all at once. If any subtile is missing, the metatile
+        is rendered again whether its first subtile is cached or not.
+    """
+    if one_per_metatile:
+        if not ignore_cached and len(group) > 1:
+            mimetype, format = layer.getTypeByExtension(extension)
+            bodies = _readMany(layer.config.cache, layer, [coord for (o, c, coord) in group], format)
+            ignore_cached = None in bodies
+        
+        return [(group[0][2], group, ignore_cached)]
+    
+    return [(coord, [(offset, count, coord)], ignore_cached) for (offset, count, coord) in group]
+
+def renderTile(layer, coord, extension, ignore_cached, callback):
+    """ Fetch a single tile, return its content and a note for chatty output.
+    
+        JSON tiles are additionally written to the cache wrapped in a JSONP
+        callback function, if one is given.
+    """
+    mimetype, content = getTile(layer, coord, extension, ignore_cached)
+    note = ''
+    
+    if mimetype and 'json' in mimetype and callback:
+        js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
+        js_body = '%s(%s);' % (callback, content)
+        js_size = len(js_body) / 1024
+        
+        layer.config.cache.save(js_body, layer, coord, 'JS')
+        note = '%s (%dKB)' % (js_path, js_size)
+
+    elif callback:
+        note = '(callback ignored)'
+    
+    return content, note
+
+#
+# State for --workers processes, set up once per process by initWorker().
+#
+
+_worker = {}
+
+def initWorker(config_dict, config_dirpath, layername, extension, ignore_cached, callback, attempts, error_list, one_per_metatile):
+    """ Build a fresh configuration and layer for a single worker process.
+    """
+    config = buildConfiguration(config_dict, config_dirpath)
+
+    _worker.update(layer=config.layers[layername], extension=extension,
+                   ignore_cached=ignore_cached, callback=callback,
+                   attempts=attempts, error_list=error_list,
+                   one_per_metatile=one_per_metatile)
+
+def seedGroup(group):
+    """ Render one metatile's worth of coordinates in a worker process.
+    
+        Returns a list of (covered, content size, note, failures) tuples, one
+        per request made, with a size of None for requests that failed every
+        attempt. Failures are re-raised unless an error list is being kept,
+        in which case the parent process writes them down.
+    """
+    results = []
+    
+    requests = groupRequests(group, _worker['one_per_metatile'], _worker['layer'],
+                             _worker['extension'], _worker['ignore_cached'])
+    
+    for (coord, covered, ignore_cached) in requests:
+        attempts, failures = _worker['attempts'], 0
+        
+        while True:
+            try:
+                content, note = renderTile(_worker['layer'], coord, _worker['extension'],
+                                           ignore_cached, _worker['callback'])
+            except:
+                failures += 1
+                
+                if failures < attempts:
+                    continue
+                
+                if not _worker['error_list']:
+                    raise
+                
+                results.append((covered, None, '', failures))
+            
+            else:
+                results.append((covered, len(content), note, failures))
+            
+            break
+    
+    return results
+
 def parseConfigfile(configpath):
     """ Parse a configuration file and return a raw dictionary and dirpath.
     
@@ -185,9 +321,9 @@ if __name__ == '__main__':
             path.insert(0, p)
 
     from TileStache import getTile, Config
-    from TileStache.Core import KnownUnknown
+    from TileStache.Core import KnownUnknown, _readMany
     from TileStache.Config import buildConfiguration
-    from TileStache import MBTiles
+    from TileStache import MBTiles, Archive
     import TileStache
     
     from ModestMaps.Core import Coordinate
@@ -196,7 +332,7 @@ if __name__ == '__main__':
     try:
         # determine if we have enough information to prep a config and layer
         
-        has_fake_destination = bool(options.outputdirectory or options.mbtiles_output)
+        has_fake_destination = bool(options.outputdirectory or options.mbtiles_output or options.archive_output)
         has_fake_source = bool(options.mbtiles_input)
         
         if has_fake_destination and has_fake_source:
@@ -250,7 +386,13 @@ if __name__ == '__main__':
             tiers.append({'class': 'TileStache.MBTiles:Cache',
                           'kwargs': dict(filename=options.mbtiles_output,
                                          format=extension,
-                                         name=options.layer)})
+                                         name=options.layer,
+                                         dedupe=bool(options.mbtiles_dedupe))})
+        
+        if options.archive_output:
+            tiers.append({'class': 'TileStache.Archive:Cache',
+                          'kwargs': dict(filename=options.archive_output,
+                                         format=extension)})
         
         if options.outputdirectory:
             tiers.append(dict(name='disk', path=options.outputdirectory,
@@ -294,6 +436,9 @@ if __name__ == '__main__':
         
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
+        
+        if options.workers < 1:
+            raise KnownUnknown('At least one worker is needed, not %d.' % options.workers)
 
         padding = options.padding
         tile_list = options.tile_list
@@ -309,67 +454,153 @@ if __name__ == '__main__':
     else:
         coordinates = generateCoordinates(ul, lr, zooms, padding)
     
-    for (offset, count, coord) in coordinates:
-        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-
-        progress = {"tile": path,
-                    "offset": offset + 1,
-                    "total": count}
-
+    #
+    # A metatiled layer needs only one request per metatile to fill in every
+    # subtile, except with a JSONP callback that must see each tile's content.
+    #
+    one_per_metatile = layer.doMetatile() and not options.callback
+    attempts = options.enable_retries and 3 or 1
+    
+    if (options.workers > 1 or one_per_metatile) and (tile_list or options.mbtiles_input):
+        # metatileGroups() needs coordinates in zoom, row, column order.
+        coordinates = sorted(coordinates, key=lambda (o, c, coord): (coord.zoom, coord.row, coord.column))
+    
+    if options.workers > 1 or one_per_metatile:
+        groups = metatileGroups(coordinates, layer.metatile)
+    else:
+        groups = ([coordinate] for coordinate in coordinates)
+    
+    if options.workers > 1:
         #
-        # Fetch a tile.
+        # Hand whole metatiles to a pool of worker processes, each with
+        # its own configuration built from the same config_dict.
         #
         
-        attempts = options.enable_retries and 3 or 1
-        rendered = False
+        initargs = (config_dict, config_dirpath, layer.name(), extension,
+                    options.ignore_cached, options.callback, attempts,
+                    error_list, one_per_metatile)
         
-        while not rendered:
-            if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
+        pool = Pool(options.workers, initWorker, initargs)
+        finished = 0
+        
+        try:
+            for results in pool.imap_unordered(seedGroup, groups):
+                for (covered, size, note, failures) in results:
+                    for (index, (offset, count, coord)) in enumerate(covered):
+                        finished += 1
+                        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+                        
+                        progress = {"tile": path,
+                                    "offset": finished,
+                                    "total": count}
+                        
+                        if options.verbose and failures:
+                            print >> stderr, 'Failed %s %d of %d times.' % (path, failures, attempts)
+                        
+                        if size is None:
+                            fp = open(error_list, 'a')
+                            fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
+                            fp.close()
+                        
+                        else:
+                            progress['size'] = index and 'metatile' or '%dKB' % (size / 1024)
+                            
+                            if options.verbose:
+                                print >> stderr, '%(offset)d of %(total)d...' % progress,
+                                print >> stderr, note + (note and ' ' or '') + '%(tile)s (%(size)s)' % progress
+                        
+                        if options.progressfile:
+                            fp = open(options.progressfile, 'w')
+                            json_dump(progress, fp)
+                            fp.close()
+            
+        except:
+            pool.terminate()
+            raise
+        
+        finally:
+            pool.close()
+            pool.join()
     
-            try:
-                mimetype, content = getTile(layer, coord, extension, options.ignore_cached)
-                
-                if mimetype and 'json' in mimetype and options.callback:
-                    js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
-                    js_body = '%s(%s);' % (options.callback, content)
-                    js_size = len(js_body) / 1024
-                    
-                    layer.config.cache.save(js_body, layer, coord, 'JS')
-                    print >> stderr, '%s (%dKB)' % (js_path, js_size),
+    else:
+        requests = (request for group in groups
+                    for request in groupRequests(group, one_per_metatile, layer, extension, options.ignore_cached))
+        
+        for (coord, covered, ignore_cached) in requests:
+            offset, count = covered[0][:2]
+            path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+    
+            progress = {"tile": path,
+                        "offset": offset + 1,
+                        "total": count}
+    
+            #
+            # Fetch a tile.
+            #
             
-                elif options.callback:
-                    print >> stderr, '(callback ignored)',
+            attempts = options.enable_retries and 3 or 1
+            rendered = False
             
-            except:
-                #
-                # Something went wrong: try again? Log the error?
-                #
-                attempts -= 1
-
+            while not rendered:
                 if options.verbose:
-                    print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
+                    print >> stderr, '%(offset)d of %(total)d...' % progress,
+        
+                try:
+                    content, note = renderTile(layer, coord, extension, ignore_cached, options.callback)
+                    
+                    if note:
+                        print >> stderr, note,
                 
-                if attempts == 0:
-                    if not error_list:
-                        raise
+                except:
+                    #
+                    # Something went wrong: try again? Log the error?
+                    #
+                    attempts -= 1
+    
+                    if options.verbose:
+                        print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
                     
-                    fp = open(error_list, 'a')
-                    fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
-                    fp.close()
-                    break
-            
-            else:
-                #
-                # Successfully got the tile.
-                #
-                rendered = True
-                progress['size'] = '%dKB' % (len(content) / 1024)
-        
-                if options.verbose:
-                    print >> stderr, '%(tile)s (%(size)s)' % progress
+                    if attempts == 0:
+                        if not error_list:
+                            raise
+                        
+                        fp = open(error_list, 'a')
+                        
+                        for (offset, count, other) in covered:
+                            fp.write('%(zoom)d/%(column)d/%(row)d\n' % other.__dict__)
+                        
+                        fp.close()
+                        break
                 
-        if options.progressfile:
-            fp = open(options.progressfile, 'w')
-            json_dump(progress, fp)
-            fp.close()
+                else:
+                    #
+                    # Successfully got the tile.
+                    #
+                    rendered = True
+                    progress['size'] = '%dKB' % (len(content) / 1024)
+            
+                    if options.verbose:
+                        print >> stderr, '%(tile)s (%(size)s)' % progress
+                    
+                    #
+                    # Other subtiles of the same metatile came along for free.
+                    #
+                    for (offset, count, other) in covered[1:]:
+                        progress = {"tile": '%s/%d/%d/%d.%s' % (layer.name(), other.zoom, other.column, other.row, extension),
+                                    "offset": offset + 1,
+                                    "total": count,
+                                    "size": 'metatile'}
+                        
+                        if options.verbose:
+                            print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
+                    
+            if options.progressfile:
+                fp = open(options.progressfile, 'w')
+                json_dump(progress, fp)
+                fp.close()
+    
+    if options.archive_output:
+        #
+        # Workers have all finished staging tiles, so write the archive.
+        #
+        Archive.finish(options.archive_output, extension)
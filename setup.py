@@ -37,7 +37,7 @@ setup(name='TileStache',
                 'TileStache.Goodies.VecTiles/OSciMap4/StaticVals',
                 'TileStache.Goodies.VecTiles/OSciMap4/TagRewrite',
                 'TileStache.Goodies.VecTiles/OSciMap4'],
-      scripts=['scripts/tilestache-compose.py', 'scripts/tilestache-seed.py', 'scripts/tilestache-clean.py', 'scripts/tilestache-server.py', 'scripts/tilestache-render.py', 'scripts/tilestache-list.py'],
+      scripts=['scripts/tilestache-compose.py', 'scripts/tilestache-seed.py', 'scripts/tilestache-clean.py', 'scripts/tilestache-server.py', 'scripts/tilestache-render.py', 'scripts/tilestache-list.py', 'scripts/tilestache-loadtest.py'],
       data_files=[('share/tilestache', ['TileStache/Goodies/Providers/DejaVuSansMono-alphanumeric.ttf'])],
       package_data={'TileStache': ['VERSION', '../doc/*.html']},
       license='BSD')
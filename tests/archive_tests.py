@@ -0,0 +1,84 @@
+# This Python file uses the following encoding: utf-8
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join, exists
+
+from ModestMaps.Core import Coordinate
+from TileStache import Archive, getTile
+from TileStache.Config import buildConfiguration
+
+class ArchiveTests(TestCase):
+    '''Tests single-file tile archives'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.filename = join(self.tmpdir, 'tiles.archive')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_leaf_directories(self):
+        '''Find tiles in an archive big enough for leaf directories'''
+
+        coords = [Coordinate(row, column, 7) for row in range(0, 128, 2) for column in range(128)]
+        tiles = [(Archive.tile_id(coord), 'tile %d' % (i % 100)) for (i, coord) in enumerate(coords)]
+
+        Archive.write_archive(self.filename, 'png', tiles)
+        reader = Archive.Reader(self.filename)
+
+        self.assertTrue(reader.leaf_size > 0)
+        self.assertEqual((reader.count, reader.format), (len(coords), 'png'))
+        self.assertEqual(str(reader.get(coords[0])), 'tile 0')
+        self.assertEqual(str(reader.get(coords[-1])), 'tile %d' % ((len(coords) - 1) % 100))
+        self.assertEqual(reader.get(Coordinate(1, 0, 7)), None)
+        self.assertEqual(reader.get(Coordinate(0, 0, 6)), None)
+        self.assertEqual(reader.get(Coordinate(0, 0, 8)), None)
+
+        self.assertEqual([id for (id, o, l) in reader.entries()], [id for (id, c) in tiles])
+        self.assertEqual(len(set([o for (i, o, l) in reader.entries()])), 100, 'Identical tiles should be stored once')
+
+    def test_outside_grid(self):
+        '''Find nothing for coordinates outside their zoom level's grid'''
+
+        coords = [Coordinate(row, column, zoom) for zoom in range(3) for row in range(2**zoom) for column in range(2**zoom)]
+        Archive.write_archive(self.filename, 'png', [(Archive.tile_id(coord), str(coord)) for coord in coords])
+        reader = Archive.Reader(self.filename)
+
+        self.assertEqual(str(reader.get(Coordinate(1, 0, 1))), str(Coordinate(1, 0, 1)))
+
+        for coord in (Coordinate(0, 2, 1), Coordinate(2, 0, 1), Coordinate(0, -1, 2), Coordinate(-1, 0, 2), Coordinate(0, 0, -1)):
+            self.assertEqual(reader.get(coord), None, '%s is outside the grid' % coord)
+
+    def test_cache_and_provider(self):
+        '''Stage tiles with the cache, finish the archive and serve it'''
+
+        config = buildConfiguration({
+            "cache": {"class": "TileStache.Archive:Cache",
+                      "kwargs": {"filename": self.filename, "format": "png"}},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"},
+                                 "metatile": {"rows": 2, "columns": 2}}}
+        })
+
+        layer, cache = config.layers['solid'], config.cache
+        mime_type, body = getTile(layer, Coordinate(0, 0, 2), 'png')
+
+        cache.save('extra', layer, Coordinate(3, 3, 2), 'PNG')
+        cache.finish()
+
+        self.assertFalse(exists(self.filename + '.staging'))
+        self.assertEqual(str(cache.read(layer, Coordinate(1, 1, 2), 'PNG')), body)
+
+        cache.remove(layer, Coordinate(3, 3, 2), 'PNG')
+        cache.finish()
+
+        self.assertEqual(cache.read(layer, Coordinate(3, 3, 2), 'PNG'), None)
+        self.assertEqual(len(list(Archive.Reader(self.filename).entries())), 4)
+
+        config = buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {"archived": {"provider": {"name": "archive", "archive": self.filename}}}
+        }, self.tmpdir)
+
+        self.assertEqual(getTile(config.layers['archived'], Coordinate(0, 1, 2), 'png'), ('image/png', body))
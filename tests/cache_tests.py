@@ -1,7 +1,22 @@
 from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join, dirname
+from os import utime, stat, walk, close, remove, makedirs, strerror
+import os
+from threading import Thread, active_count
+from time import time, sleep
+from sqlite3 import connect
+from errno import EMLINK
 from . import utils
 import memcache
 
+from ModestMaps.Core import Coordinate
+from TileStache import getTile
+from TileStache.Config import buildConfiguration
+from TileStache.Core import RecentTiles, KnownUnknown, _tileETag
+from TileStache import Locks, MBTiles
+
 class CacheTests(TestCase):
     '''Tests various Cache configurations that reads from cfg file'''
 
@@ -68,6 +83,648 @@ class CacheTests(TestCase):
             'Memcache returned a value even though it should have been empty')
 
 
+class DiskCacheTests(TestCase):
+    '''Tests local Disk and MBTiles caches behind a Multi cache'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.config = buildConfiguration({
+            "cache": {
+                "name": "Multi",
+                "tiers": [
+                    {"name": "Disk", "path": join(self.tmpdir, 'disk')},
+                    {"class": "TileStache.MBTiles:Cache", "kwargs": {
+                        "filename": join(self.tmpdir, 'tiles.mbtiles'),
+                        "format": "png", "name": "solid"}}
+                ]
+            },
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidProvider"},
+                    "metatile": {"rows": 2, "columns": 2}
+                }
+            }
+        })
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_metatile_save_many(self):
+        '''Render a metatile and find all of its subtiles in every tier'''
+
+        layer = self.config.layers['solid']
+        mime_type, body = getTile(layer, Coordinate(1, 1, 3), 'png')
+        self.assertEqual(mime_type, 'image/png')
+
+        coords = layer.metatile.allCoords(Coordinate(1, 1, 3)) + [Coordinate(7, 7, 3)]
+
+        for cache in [self.config.cache] + self.config.cache.tiers:
+            bodies = [b and str(b) for b in cache.read_many(layer, coords, 'PNG')]
+            self.assertEqual(bodies[-1], None, 'Tile outside the metatile should not be cached')
+            self.assertEqual(bodies[:-1], [body] * 4, 'Every subtile should be cached after one render')
+
+    def test_multi_read_many_backfill(self):
+        '''Read tiles found only in a later tier back into the first one'''
+
+        layer = self.config.layers['solid']
+        disk, mbtiles = self.config.cache.tiers
+        coords = [Coordinate(0, 0, 1), Coordinate(0, 1, 1)]
+
+        mbtiles.save_many(['one', 'two'], layer, coords, 'PNG')
+        self.assertEqual(disk.read_many(layer, coords, 'PNG'), [None, None])
+
+        self.assertEqual(map(str, self.config.cache.read_many(layer, coords, 'PNG')), ['one', 'two'])
+        self.assertEqual(map(str, disk.read_many(layer, coords, 'PNG')), ['one', 'two'])
+
+    def test_disk_lock_wait(self):
+        '''Wake up a thread waiting on a Disk lock as soon as it's unlocked'''
+
+        layer = self.config.layers['solid']
+        disk = self.config.cache.tiers[0]
+        coord, waits = Coordinate(0, 0, 1), []
+
+        def wait():
+            start = time()
+            disk.lock(layer, coord, 'png')
+            waits.append(time() - start)
+            disk.unlock(layer, coord, 'png')
+
+        disk.lock(layer, coord, 'png')
+        thread = Thread(target=wait)
+        thread.start()
+        sleep(.25)
+        disk.unlock(layer, coord, 'png')
+        thread.join()
+
+        self.assertTrue(.25 <= waits[0] < .3, 'Waiting thread should get the lock right away, not %.3fs later' % waits[0])
+        self.assertTrue(Locks.stats()['contended'] >= 1)
+
+    def test_disk_lock_stale(self):
+        '''Force a Disk lock held past its timeout, leaving nothing behind'''
+
+        layer = self.config.layers['solid']
+        disk = self.config.cache.tiers[0]
+        coord, forced = Coordinate(0, 0, 1), Locks.stats()['forced']
+        layer.stale_lock_timeout = .1
+
+        disk.lock(layer, coord, 'png')
+        lockfiles, disk._lockfiles = disk._lockfiles, {}
+
+        start, threads = time(), active_count()
+        disk.lock(layer, coord, 'png')
+        disk.unlock(layer, coord, 'png')
+
+        self.assertTrue(.05 <= time() - start < .2)
+        self.assertEqual(active_count(), threads)
+        self.assertEqual(Locks.stats()['forced'], forced + 1)
+
+        for fd in lockfiles.values():
+            close(fd)
+
+    def test_stale_while_revalidate(self):
+        '''Return an expired tile right away and render it again in the background'''
+
+        config = buildConfiguration({
+            "cache": {"name": "Disk", "path": join(self.tmpdir, 'stale')},
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidProvider"},
+                    "cache lifespan": 60,
+                    "stale while revalidate": 600
+                }
+            }
+        })
+
+        layer, coord = config.layers['solid'], Coordinate(0, 0, 1)
+        layer.getTileResponse(coord, 'png')
+        fullpath = config.cache._fullpath(layer, coord, 'png')
+
+        # pretend the tile expired two minutes ago.
+        past = time() - 180
+        utime(fullpath, (past, past))
+        renders = utils.SolidProvider.renders
+
+        status, headers, body = layer.getTileResponse(coord, 'png')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Warning'], '110 - "Response is Stale"')
+        self.assertTrue(180 <= int(headers['Age']) < 190)
+
+        for i in range(50):
+            if stat(fullpath).st_mtime > past:
+                break
+            sleep(.1)
+
+        self.assertEqual(utils.SolidProvider.renders - renders, 1, 'Tile should be rendered again once')
+        self.assertTrue(stat(fullpath).st_mtime > time() - 10, 'Tile should be fresh in the cache')
+
+        status, headers, body = layer.getTileResponse(coord, 'png')
+        self.assertFalse('Warning' in headers)
+
+    def test_write_behind(self):
+        '''Save tiles to a slow tier in the background'''
+
+        config = buildConfiguration({
+            "cache": {
+                "name": "Multi",
+                "tiers": [
+                    {"name": "Disk", "path": join(self.tmpdir, 'fast')},
+                    {"name": "Disk", "path": join(self.tmpdir, 'slow'),
+                     "write behind": {"max bytes": 16, "workers": 1}}
+                ]
+            },
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"}}}
+        })
+
+        layer, (fast, slow) = config.layers['solid'], config.cache.tiers
+        coords = [Coordinate(0, 0, 1), Coordinate(0, 1, 1), Coordinate(1, 0, 1)]
+
+        config.cache.save_many(['one', 'two', 'a body too large'], layer, coords, 'PNG')
+        self.assertEqual(map(str, fast.read_many(layer, coords, 'PNG')), ['one', 'two', 'a body too large'])
+        self.assertEqual(map(str, slow.read_many(layer, coords[:2], 'PNG')), ['one', 'two'])
+
+        self.assertTrue(slow.flush(5))
+        self.assertEqual(map(str, slow.cache.read_many(layer, coords[:2], 'PNG')), ['one', 'two'])
+        self.assertEqual(slow.cache.read(layer, coords[2], 'PNG'), None)
+
+        stats = slow.stats()
+        self.assertEqual((stats['depth'], stats['written'], stats['dropped']), (0, 2, 1))
+
+class LMDBCacheTests(TestCase):
+    '''Tests the LMDB cache'''
+
+    def setUp(self):
+        try:
+            from TileStache.Goodies.Caches.LMDB import Cache, lmdb
+        except ImportError:
+            from nose.plugins.skip import SkipTest
+            raise SkipTest('lmdb is not available')
+
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.layer = buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"}}}
+        }).layers['solid']
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_eviction(self):
+        '''Remove least recently used tiles from an LMDB cache over its limit'''
+
+        from TileStache.Goodies.Caches.LMDB import Cache
+
+        cache, layer = Cache(join(self.tmpdir, 'lmdb'), limit=100), self.layer
+        coords = [Coordinate(0, column, 4) for column in range(3)]
+
+        cache.save_many(['a' * 30, 'b' * 30], layer, coords[:2], 'PNG')
+        self.assertEqual(cache.read(layer, coords[0], 'PNG'), 'a' * 30)
+
+        cache.save('c' * 30, layer, coords[2], 'PNG')
+        self.assertEqual(cache.read_many(layer, coords, 'PNG'), ['a' * 30, None, 'c' * 30])
+
+        cache.remove(layer, coords[0], 'PNG')
+        self.assertEqual(cache.read(layer, coords[0], 'PNG'), None)
+        self.assertEqual(cache.read_stale(layer, coords[2], 'PNG')[0], 'c' * 30)
+
+    def test_full_map(self):
+        '''Keep saving to an LMDB cache with no limit after its map fills up'''
+
+        from TileStache.Goodies.Caches.LMDB import Cache
+
+        cache, layer = Cache(join(self.tmpdir, 'lmdb'), map_size=0x80000), self.layer
+        coords = [Coordinate(row, 0, 12) for row in range(400)]
+
+        for coord in coords:
+            cache.save('x' * 1000, layer, coord, 'PNG')
+
+        self.assertEqual(cache.read_many(layer, coords[-10:], 'PNG'), ['x' * 1000] * 10)
+        self.assertEqual(cache.read(layer, coords[0], 'PNG'), None, 'Oldest tiles should be removed')
+
+        self.assertRaises(KnownUnknown, Cache, join(self.tmpdir, 'lmdb2'), limit=0x80000, map_size=0x80000)
+
+    def test_read_times(self):
+        '''Record when LMDB tiles were read without waiting for a save'''
+
+        from TileStache.Goodies.Caches import LMDB
+
+        cache, layer = LMDB.Cache(join(self.tmpdir, 'lmdb')), self.layer
+        coords = [Coordinate(row, 0, 12) for row in range(30)]
+        cache.save_many(['x'] * 30, layer, coords, 'PNG')
+
+        max_touched, LMDB._max_touched = LMDB._max_touched, 10
+
+        try:
+            for coord in coords:
+                cache.read(layer, coord, 'PNG')
+                self.assertTrue(len(cache._touched) < 10, 'Read times should not pile up')
+        finally:
+            LMDB._max_touched = max_touched
+
+        cache.remove(layer, coords[-1], 'PNG')
+        cache.read(layer, coords[-1], 'PNG')
+        cache._recorded = 0
+        cache.read(layer, coords[0], 'PNG')
+
+        env, (tiles, used, meta, locks) = cache._environment()
+
+        with env.begin(db=used) as txn:
+            times = [txn.get(LMDB.tile_key(layer, coord, 'PNG')) for coord in coords]
+
+        self.assertEqual(times[-1], None, 'Removed tiles should have no read time')
+        self.assertTrue(LMDB._time.unpack(times[0])[0] > LMDB._time.unpack(times[1])[0], 'Read time should be recorded after a while')
+
+class DedupeCacheTests(TestCase):
+    '''Tests the dedupe mode of Disk and LimitedDisk caches'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.config = buildConfiguration({
+            "cache": {"name": "Disk", "path": join(self.tmpdir, 'disk'), "dedupe": True},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"}}}
+        })
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_disk(self):
+        '''Store identical tiles once in a Disk cache, linked into place'''
+
+        layer, cache = self.config.layers['solid'], self.config.cache
+        coords = [Coordinate(0, 0, 1), Coordinate(0, 1, 1), Coordinate(1, 0, 1)]
+
+        cache.save_many(['same', 'same', 'other'], layer, coords, 'PNG')
+
+        for i in range(3):
+            cache.save('same', layer, coords[2], 'PNG')
+
+        self.assertEqual(map(str, cache.read_many(layer, coords, 'PNG')), ['same'] * 3)
+        self.assertEqual(stat(cache._fullpath(layer, coords[0], 'PNG')).st_nlink, 4)
+
+        filenames = [f for f in walk(cache.cachepath) for f in f[2]]
+        self.assertEqual([f for f in filenames if f.endswith('.link')], [], 'Temporary links should be gone')
+
+        for coord in coords:
+            cache.remove(layer, coord, 'PNG')
+
+        self.assertEqual(cache.remove_unreferenced(), 0, 'Recently used bodies should be kept')
+        self.assertEqual(cache.remove_unreferenced(min_age=-1), 2)
+        self.assertEqual(cache.remove_unreferenced(min_age=-1), 0)
+
+    def test_disk_age(self):
+        '''Keep the age of tiles sharing a body when another one is saved'''
+
+        layer, cache = self.config.layers['solid'], self.config.cache
+        coords = [Coordinate(0, 0, 1), Coordinate(0, 1, 1), Coordinate(1, 0, 1)]
+        paths = [cache._fullpath(layer, coord, 'PNG') for coord in coords]
+
+        cache.save('same', layer, coords[0], 'PNG')
+        utime(paths[0], (time() - 30, time() - 30))
+
+        cache.save('same', layer, coords[1], 'PNG')
+        self.assertTrue(29 < time() - stat(paths[0]).st_mtime < 31, 'Saving a tile should not freshen others')
+
+        utime(paths[0], (time() - 300, time() - 300))
+
+        cache.save('same', layer, coords[2], 'PNG')
+        self.assertTrue(time() - stat(paths[0]).st_mtime > 299, 'Saving a tile should not freshen others')
+        self.assertTrue(time() - stat(paths[2]).st_mtime < 1, 'Tile should be linked to a fresh body')
+        self.assertEqual(map(str, cache.read_many(layer, coords, 'PNG')), ['same'] * 3)
+
+    def test_disk_link_limit(self):
+        '''Store another copy of a body with as many links as allowed'''
+
+        layer, cache = self.config.layers['solid'], self.config.cache
+        coords = [Coordinate(0, column, 3) for column in range(5)]
+
+        with LinkLimit(3):
+            for coord in coords:
+                cache.save('same', layer, coord, 'PNG')
+
+        self.assertEqual(map(str, cache.read_many(layer, coords, 'PNG')), ['same'] * 5)
+        self.assertEqual(len(set([stat(cache._fullpath(layer, coord, 'PNG')).st_ino for coord in coords])), 3)
+
+        for coord in coords:
+            cache.remove(layer, coord, 'PNG')
+
+        self.assertEqual(cache.remove_unreferenced(min_age=-1), 1)
+        self.assertEqual([f for f in walk(cache.cachepath) for f in f[2]], [])
+
+    def test_limited_disk(self):
+        '''Count each stored body once toward a LimitedDisk limit'''
+
+        from TileStache.Goodies.Caches.LimitedDisk import Cache
+
+        path = join(self.tmpdir, 'limited')
+        makedirs(path)
+
+        cache = Cache(path, limit=1000000, dedupe=True)
+        layer = self.config.layers['solid']
+        coords = [Coordinate(0, column, 4) for column in range(4)]
+        db = connect(cache.dbpath)
+        total = lambda: db.execute('SELECT (SELECT SUM(size) FROM tiles) + (SELECT SUM(size) FROM bodies)').fetchone()[0]
+
+        for i in range(3):
+            for coord in coords[:3]:
+                cache.save('a' * 5000, layer, coord, 'PNG')
+
+        body_size = total()
+        self.assertTrue(body_size >= 5000)
+        self.assertEqual(db.execute('SELECT refs FROM bodies').fetchall(), [(3, )])
+
+        cache.save('b' * 5000, layer, coords[2], 'PNG')
+        self.assertEqual(total(), body_size * 2)
+        self.assertEqual(sorted(db.execute('SELECT refs FROM bodies').fetchall()), [(1, ), (2, )])
+
+        cache.limit = body_size * 2
+        cache.save('c' * 5000, layer, coords[3], 'PNG')
+        self.assertEqual(total(), body_size * 2, 'Evicted bodies should be freed')
+        self.assertEqual(cache.read(layer, coords[0], 'PNG'), None)
+        self.assertEqual(cache.read(layer, coords[1], 'PNG'), None)
+        self.assertEqual(cache.read(layer, coords[3], 'PNG'), 'c' * 5000)
+        self.assertEqual(len([f for f in walk(join(path, '.dedupe')) for f in f[2]]), 2)
+
+    def test_limited_disk_link_limit(self):
+        '''Count each stored copy of a body with as many links as allowed'''
+
+        from TileStache.Goodies.Caches.LimitedDisk import Cache
+
+        path = join(self.tmpdir, 'limited')
+        makedirs(path)
+
+        cache = Cache(path, limit=1000000, dedupe=True)
+        layer = self.config.layers['solid']
+        coords = [Coordinate(0, column, 3) for column in range(5)]
+        db = connect(cache.dbpath)
+
+        with LinkLimit(3):
+            for coord in coords:
+                cache.save('a' * 5000, layer, coord, 'PNG')
+
+        self.assertEqual(sorted(db.execute('SELECT refs FROM bodies').fetchall()), [(1, ), (2, ), (2, )])
+        self.assertEqual([cache.read(layer, coord, 'PNG') for coord in coords], ['a' * 5000] * 5)
+
+        body_size = db.execute('SELECT size FROM bodies').fetchone()[0]
+        self.assertEqual(db.execute('SELECT SUM(size) FROM bodies').fetchone()[0], body_size * 3)
+
+        cache.limit = body_size * 2
+        cache.save('b' * 5000, layer, Coordinate(1, 0, 3), 'PNG')
+        self.assertEqual(db.execute('SELECT refs FROM bodies').fetchall(), [(1, ), (1, )])
+        self.assertEqual(len([f for f in walk(join(path, '.dedupe')) for f in f[2]]), 2, 'Evicted copies should be freed')
+
+class LinkLimit:
+    '''Make os.link() fail like a filesystem allowing at most limit links'''
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __enter__(self):
+        self.link = os.link
+
+        def link(source, destination):
+            if stat(source).st_nlink >= self.limit:
+                raise OSError(EMLINK, strerror(EMLINK))
+            self.link(source, destination)
+
+        os.link = link
+
+    def __exit__(self, *args):
+        os.link = self.link
+
+class BundleCacheTests(TestCase):
+    '''Tests the Bundle cache'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_bundle(self):
+        '''Pack tiles into bundle files, replacing and removing some'''
+
+        config = buildConfiguration({
+            "cache": {"class": "TileStache.Goodies.Caches.Bundle:Cache",
+                      "kwargs": {"path": join(self.tmpdir, 'bundles'), "size": 4}},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"},
+                                 "metatile": {"rows": 2, "columns": 2}}}
+        })
+
+        layer, cache = config.layers['solid'], config.cache
+        coords = [Coordinate(row, column, 3) for row in range(8) for column in range(8)]
+
+        cache.save_many(['tile %d' % i for i in range(64)], layer, coords, 'PNG')
+        self.assertEqual(cache.read_many(layer, coords, 'PNG'), ['tile %d' % i for i in range(64)])
+        self.assertEqual(len([f for f in walk(cache.cachepath) for f in f[2]]), 4, 'Should be four bundles')
+
+        for i in range(3):
+            cache.save('new %d' % i, layer, coords[0], 'PNG')
+
+        cache.remove(layer, coords[1], 'PNG')
+        self.assertEqual(cache.read_many(layer, coords[:3], 'PNG'), ['new 2', None, 'tile 2'])
+        self.assertEqual(cache.read_info(layer, coords[1], 'PNG'), None)
+
+        mime_type, body = getTile(layer, Coordinate(4, 4, 4), 'png')
+        self.assertEqual(cache.read(layer, Coordinate(5, 5, 4), 'PNG'), body)
+
+    def test_empty_bundle(self):
+        '''Find no tiles in an empty bundle, and fill it in on the next save'''
+
+        config = buildConfiguration({
+            "cache": {"class": "TileStache.Goodies.Caches.Bundle:Cache",
+                      "kwargs": {"path": join(self.tmpdir, 'bundles'), "size": 2}},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"}}}
+        })
+
+        layer, cache = config.layers['solid'], config.cache
+        coord = Coordinate(0, 0, 1)
+        bundlepath = cache._bundlepath(layer, coord, 'PNG')
+
+        makedirs(dirname(bundlepath))
+        open(bundlepath, 'w').close()
+
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+        self.assertEqual(cache.read_info(layer, coord, 'PNG'), None)
+
+        cache.save('tile', layer, coord, 'PNG')
+        self.assertEqual(cache.read_many(layer, [coord, Coordinate(1, 1, 1)], 'PNG'), ['tile', None])
+
+        cache.save('tile', layer, Coordinate(2, 2, 2), 'PNG')
+        self.assertEqual(cache.read(layer, Coordinate(2, 2, 2), 'PNG'), 'tile')
+        self.assertEqual([f for f in walk(cache.cachepath) for f in f[2] if not f.endswith('.bundle')], [],
+                         'New bundles should leave no temporary files behind')
+
+    def test_compaction(self):
+        '''Compact a bundle while other threads save to it and read from it'''
+
+        config = buildConfiguration({
+            "cache": {"class": "TileStache.Goodies.Caches.Bundle:Cache",
+                      "kwargs": {"path": join(self.tmpdir, 'bundles'), "size": 2}},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"}}}
+        })
+
+        layer, cache = config.layers['solid'], config.cache
+        coords = [Coordinate(row, column, 1) for row in range(2) for column in range(2)]
+        bundlepath = cache._bundlepath(layer, coords[0], 'PNG')
+        errors, inodes = [], set()
+
+        def save(index):
+            for i in range(50):
+                cache.save('%d-%03d' % (index, i) * 10, layer, coords[index], 'PNG')
+
+        def read():
+            for i in range(200):
+                for body in cache.read_many(layer, coords, 'PNG'):
+                    if body is not None and body != body[:5] * 10:
+                        errors.append(body)
+                try:
+                    inodes.add(stat(bundlepath).st_ino)
+                except OSError:
+                    pass
+
+        threads = [Thread(target=save, args=(index, )) for index in range(4)] + [Thread(target=read)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        self.assertEqual(errors, [], 'Readers should only see whole tiles')
+        self.assertTrue(len(inodes) > 1, 'Bundle should have been compacted')
+        self.assertEqual(cache.read_many(layer, coords, 'PNG'), ['%d-049' % index * 10 for index in range(4)])
+        self.assertTrue(stat(bundlepath).st_size <= cache.index_length + 4 * 50 * 3, 'Compacted bundle should stay small')
+
+class MBTilesCacheTests(TestCase):
+    '''Tests the deduplicated MBTiles layout'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.filename = join(self.tmpdir, 'dedupe.mbtiles')
+        self.config = buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"}}}
+        })
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def test_dedupe(self):
+        '''Store identical tiles once, and delete images nothing points to'''
+
+        cache = MBTiles.Cache(self.filename, 'png', 'solid', dedupe=True)
+        layer = self.config.layers['solid']
+        coords = [Coordinate(0, 0, 1), Coordinate(0, 1, 1), Coordinate(1, 0, 1)]
+        db = connect(self.filename)
+
+        cache.save_many(['same', 'same', 'other'], layer, coords, 'PNG')
+        cache.flush()
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone()[0], 2)
+
+        cache.save('same', layer, coords[2], 'PNG')
+        cache.save('same', layer, coords[2], 'PNG')
+        cache.flush()
+
+        self.assertEqual(map(str, MBTiles.get_tiles(self.filename, coords)), ['same'] * 3)
+        self.assertEqual(len(MBTiles.list_tiles(self.filename)), 3)
+        self.assertEqual(cache.read_info(layer, coords[0], 'PNG')[0], _tileETag('same'))
+        self.assertEqual(cache.read_info(layer, Coordinate(1, 1, 1), 'PNG'), None)
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone()[0], 1, 'Replaced image should be deleted')
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM tiles').fetchone()[0], 3)
+
+        for coord in coords[:2]:
+            cache.remove(layer, coord, 'PNG')
+
+        cache.flush()
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone()[0], 1, 'Shared image should be kept')
+
+        cache.remove(layer, coords[2], 'PNG')
+        cache.flush()
+        self.assertEqual(db.execute('SELECT COUNT(*) FROM images').fetchone()[0], 0)
+
+    def test_recreate(self):
+        '''Use the new layout of a tileset made again under the same name'''
+
+        MBTiles.create_tileset(self.filename, 'solid', 'baselayer', '0', '', 'png', dedupe=True)
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 1), 'dedupe')
+        remove(self.filename)
+
+        MBTiles.create_tileset(self.filename, 'solid', 'baselayer', '0', '', 'png')
+        MBTiles.put_tile(self.filename, Coordinate(0, 0, 1), 'plain')
+        self.assertEqual(str(MBTiles.get_tile(self.filename, Coordinate(0, 0, 1))[1]), 'plain')
+
+class RecentTilesTests(TestCase):
+    '''Tests the in-memory store of recent tiles'''
+
+    def test_size_limit(self):
+        '''Evict least-recently used tiles to stay under the size limit'''
+
+        recent = RecentTiles(size=10)
+        recent.put('a', 'aaaa')
+        recent.put('b', 'bbbb')
+        self.assertEqual(recent.get('a'), 'aaaa')
+
+        recent.put('c', 'cccc')
+        self.assertEqual(recent.get('b'), None, 'Least-recently used tile should be evicted')
+        self.assertEqual(recent.get('a'), 'aaaa')
+        self.assertEqual(recent.get('c'), 'cccc')
+
+        recent.put('d', 'd' * 11)
+        self.assertEqual(recent.get('d'), None, 'Oversized tile should not be kept')
+
+        stats = recent.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (3, 2, 1))
+        self.assertEqual(stats['bytes'], 8)
+
+    def test_lifespan(self):
+        '''Forget tiles after their lifespan'''
+
+        recent = RecentTiles(size=10, lifespan=0)
+        recent.put('a', 'aaaa')
+        self.assertEqual(recent.get('a'), None)
+        self.assertEqual(recent.stats()['bytes'], 0)
+
+    def test_layer_config(self):
+        '''Give a layer its own recent tiles from configuration'''
+
+        config = buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidProvider"},
+                    "recent tiles": {"size": 1024, "lifespan": 60}
+                }
+            }
+        })
+
+        layer = config.layers['solid']
+        self.assertEqual((layer.recent_tiles.size, layer.recent_tiles.lifespan), (1024, 60))
+
+class SingleFlightTests(TestCase):
+    '''Tests coalescing of concurrent renders of one metatile'''
+
+    def test_concurrent_requests(self):
+        '''Render a metatile once for many threads asking for its tiles'''
+
+        config = buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidProvider", "kwargs": {"delay": 0.5}},
+                    "metatile": {"rows": 2, "columns": 2},
+                    "recent tiles": {"size": 0}
+                }
+            }
+        })
+
+        layer = config.layers['solid']
+        coords = layer.metatile.allCoords(Coordinate(4, 4, 4)) * 3
+        results = []
 
+        def request(coord):
+            results.append(getTile(layer, coord, 'png'))
 
+        renders = utils.SolidProvider.renders
+        threads = [Thread(target=request, args=(coord, )) for coord in coords]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
 
+        self.assertEqual(utils.SolidProvider.renders - renders, 1, 'Metatile should be rendered once')
+        self.assertEqual(len(results), len(coords))
+        self.assertEqual(set([mime for (mime, body) in results]), set(['image/png']))
+        self.assertTrue(all([body for (mime, body) in results]), 'Every thread should get a tile')
@@ -0,0 +1,86 @@
+# This Python file uses the following encoding: utf-8
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from multiprocessing import Process
+from os.path import join
+
+from TileStache import WSGITileServer, Metrics
+from TileStache.Config import buildConfiguration
+
+def count_tiles(count):
+    for i in range(count):
+        Metrics.inc('tilestache_test_tiles_total', layer='child')
+        Metrics.add('tilestache_test_gauge', 1)
+
+class MetricsTests(TestCase):
+    '''Tests publishing metrics in Prometheus text format'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        Metrics.declare('tilestache_test_tiles_total', 'counter', 'Test tiles.')
+
+    def tearDown(self):
+        Metrics.configure(None)
+        rmtree(self.tmpdir)
+
+    def test_metrics_page(self):
+        '''Publish tile and render metrics from WSGITileServer'''
+
+        app = WSGITileServer(buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {"metered": {"provider": {"class": "tests.utils:SolidProvider"}}},
+            "metrics": {"path": "/metrics"}
+        }))
+
+        response = {}
+
+        def start_response(status, headers):
+            response['status'], response['headers'] = status, dict(headers)
+
+        for path_info in ('/metered/1/0/0.png', '/metered/1/0/0.png', '/metrics'):
+            body = ''.join(app(dict(PATH_INFO=path_info, QUERY_STRING=''), start_response))
+
+        self.assertEqual(response['status'], '200 OK')
+        self.assertTrue(response['headers']['Content-Type'].startswith('text/plain'))
+
+        lines = body.splitlines()
+        self.assertTrue('# TYPE tilestache_tile_seconds histogram' in lines)
+        self.assertTrue('tilestache_tile_seconds_count{layer="metered",source="layer.render()",zoom="1"} 2' in lines)
+        self.assertTrue('tilestache_render_seconds_count{layer="metered",zoom="1"} 2' in lines)
+        self.assertTrue([l for l in lines if l.startswith('tilestache_bytes_served_total{layer="metered"} ')])
+        self.assertTrue('tilestache_renders_in_progress{layer="metered"} 0' in lines)
+
+    def test_combined_layers(self):
+        '''Label every combined layer the same way'''
+
+        app = WSGITileServer(buildConfiguration({
+            "cache": {"name": "Test"},
+            "layers": {"metered": {"provider": {"class": "tests.utils:SolidProvider"}}},
+            "metrics": {"path": "/metrics"}
+        }))
+
+        for path_info in ('/metered,metered/1/0/0.mvt', '/metered,metered,metered/1/0/0.mvt', '/metrics'):
+            body = ''.join(app(dict(PATH_INFO=path_info, QUERY_STRING=''), lambda status, headers: None))
+
+        lines = [line for line in body.splitlines() if line.startswith('tilestache_')]
+        self.assertFalse([line for line in lines if 'metered,' in line])
+        self.assertTrue([line for line in lines if line.startswith('tilestache_bytes_served_total{layer="combined"} ')])
+
+    def test_multiprocess(self):
+        '''Add up metrics saved by other processes'''
+
+        Metrics.configure(join(self.tmpdir, 'metrics'))
+
+        for count in (3, 4):
+            process = Process(target=count_tiles, args=(count, ))
+            process.start()
+            process.join()
+
+        Metrics.inc('tilestache_test_tiles_total', layer='child')
+
+        lines = Metrics.exposition().splitlines()
+        self.assertTrue('# HELP tilestache_test_tiles_total Test tiles.' in lines)
+        self.assertTrue('tilestache_test_tiles_total{layer="child"} 8' in lines)
+        self.assertFalse([l for l in lines if l.startswith('tilestache_test_gauge')], 'Gauges from finished processes should be left out')
@@ -0,0 +1,70 @@
+# This Python file uses the following encoding: utf-8
+
+from unittest import TestCase
+from random import Random
+
+from TileStache import Pixels
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+class PaletteTests(TestCase):
+    '''Tests that NumPy palette mapping matches the pure Python version'''
+
+    def setUp(self):
+        if Pixels.numpy is None:
+            from nose.plugins.skip import SkipTest
+            raise SkipTest('NumPy is not available')
+
+        rand = Random(1)
+        self.pixels = ''.join([chr(rand.randrange(256)) for i in range(64 * 64 * 4)])
+        self.palette = [tuple([rand.randrange(256) for i in range(3)]) for j in range(32)]
+        self.palette += self.palette[:4] # duplicate colors to exercise ties
+
+    def test_palette_indexes(self):
+        '''Match pixels to palette colors with and without transparency'''
+
+        for t_index in (None, 0, 7, 35, 200):
+            expected = Pixels.palette_indexes(self.pixels, self.palette, t_index)
+            actual = Pixels.palette_indexes_numpy(self.pixels, self.palette, t_index)
+            self.assertEqual(expected, actual)
+
+            # second pass reads from the cached color table
+            actual = Pixels.palette_indexes_numpy(self.pixels, self.palette, t_index)
+            self.assertEqual(expected, actual)
+
+    def test_apply_palette(self):
+        '''Apply the same palette twice, as a layer does'''
+
+        image = Image.frombytes('RGBA', (64, 64), self.pixels)
+        palette = list(self.palette)
+
+        for i in range(2):
+            expected = Image.frombytes('P', (64, 64), Pixels.palette_indexes(self.pixels, palette, 3))
+            output = Pixels.apply_palette(image, palette, 3)
+            self.assertEqual(expected.tobytes(), output.tobytes())
+
+        self.assertEqual(palette, self.palette)
+
+    def test_color_tables(self):
+        '''Keep one small color table per palette, up to a limit'''
+
+        Pixels._color_tables.clear()
+        image = Image.frombytes('RGBA', (64, 64), self.pixels)
+
+        for i in range(3):
+            Pixels.apply_palette(image, self.palette, 3)
+
+        colors, indexes = Pixels._color_tables[(tuple(self.palette), 3)]
+        self.assertEqual(len(Pixels._color_tables), 1)
+        self.assertEqual(len(colors), len(set(colors)))
+        self.assertTrue(len(colors) <= 64 * 64)
+
+        for j in range(Pixels._max_color_tables + 2):
+            palette = self.palette[j:]
+            expected = Pixels.palette_indexes(self.pixels, palette, None)
+            self.assertEqual(expected, Pixels.palette_indexes_numpy(self.pixels, palette, None))
+
+        self.assertEqual(len(Pixels._color_tables), Pixels._max_color_tables)
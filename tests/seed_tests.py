@@ -0,0 +1,51 @@
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join, dirname, abspath
+from subprocess import check_call
+from json import dump
+import sys
+
+from ModestMaps.Core import Coordinate
+from TileStache.Config import buildConfiguration
+
+class SeedTests(TestCase):
+    '''Tests seeding metatiled layers with tilestache-seed.py'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.config_dict = {
+            "cache": {"name": "Disk", "path": join(self.tmpdir, 'cache')},
+            "layers": {"solid": {"provider": {"class": "tests.utils:SolidProvider"},
+                                 "metatile": {"rows": 2, "columns": 2}}}
+        }
+
+        self.filename = join(self.tmpdir, 'tilestache.cfg')
+        dump(self.config_dict, open(self.filename, 'w'))
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def seed(self, *zooms):
+        root = dirname(dirname(abspath(__file__)))
+        script = join(root, 'scripts', 'tilestache-seed.py')
+        check_call([sys.executable, script, '-q', '-c', self.filename, '-l', 'solid',
+                    '-i', root, '-b', '-80', '-170', '80', '170'] + list(zooms))
+
+    def test_partly_cached_metatile(self):
+        '''Render a metatile again when only its first subtile is cached'''
+
+        config = buildConfiguration(self.config_dict, self.tmpdir + '/')
+        layer, cache = config.layers['solid'], config.cache
+        coords = [Coordinate(row, column, 1) for row in range(2) for column in range(2)]
+
+        cache.save('cached', layer, coords[0], 'PNG')
+        self.seed('1')
+
+        bodies = [cache.read(layer, coord, 'PNG') for coord in coords]
+        self.assertTrue(None not in bodies, 'Every subtile should be cached')
+        self.assertEqual(len(set(bodies)), 1, 'First subtile should be rendered with the others')
+
+        cache.save('cached', layer, coords[0], 'PNG')
+        self.seed('1')
+        self.assertEqual(cache.read(layer, coords[0], 'PNG'), 'cached', 'Complete metatile should not be rendered again')
@@ -0,0 +1,62 @@
+# This Python file uses the following encoding: utf-8
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join
+from json import loads
+
+from ModestMaps.Core import Coordinate
+from TileStache import Tracing
+from TileStache.Config import buildConfiguration
+
+class TracingTests(TestCase):
+    '''Tests timing traces of slow tile requests'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+
+    def tearDown(self):
+        Tracing.configure(None)
+        rmtree(self.tmpdir)
+
+    def config(self, **tracing):
+        return buildConfiguration({
+            "cache": {"name": "Disk", "path": join(self.tmpdir, 'disk')},
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidProvider"},
+                    "metatile": {"rows": 2, "columns": 2}
+                }
+            },
+            "tracing": tracing
+        })
+
+    def test_slow_request(self):
+        '''Write out every phase of a request slower than the threshold'''
+
+        path = join(self.tmpdir, 'slow.jsonl')
+        layer = self.config(slow=0, path=path, profile=1).layers['solid']
+        layer.getTileResponse(Coordinate(0, 0, 1), 'png')
+
+        record = loads(open(path).read())
+        names = [span['name'] for span in record['spans']]
+
+        self.assertEqual((record['layer'], record['tile'], record['extension']), ('solid', '1/0/0', 'png'))
+        self.assertEqual(names[:4], ['cache.read', 'cache.lock', 'cache.read', 'render'])
+        self.assertTrue('provider.renderArea' in names and 'cache.save_many' in names)
+        self.assertTrue('cache.unlock' in names)
+        self.assertTrue('cumulative' in record['profile'])
+
+        render = record['spans'][3]
+        self.assertEqual(render['depth'], 1)
+        self.assertTrue(render['seconds'] <= record['seconds'])
+
+    def test_fast_request(self):
+        '''Leave out requests faster than the threshold'''
+
+        path = join(self.tmpdir, 'slow.jsonl')
+        layer = self.config(slow=60, path=path).layers['solid']
+        layer.getTileResponse(Coordinate(0, 0, 1), 'png')
+
+        self.assertRaises(IOError, open, path)
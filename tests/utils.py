@@ -17,6 +17,28 @@ from ModestMaps.Core import Coordinate
 from TileStache import getTile, parseConfigfile
 from TileStache.Core import KnownUnknown
 
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+class SolidProvider:
+    '''
+    Local provider that renders solid-colored areas and counts its renders,
+    so tests can exercise caches and metatiles without a network connection.
+    '''
+    renders = 0
+
+    def __init__(self, layer, color='#996633', delay=0):
+        self.layer = layer
+        self.color = color
+        self.delay = delay
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        SolidProvider.renders += 1
+        sleep(self.delay)
+        return Image.new('RGB', (width, height), self.color)
+
 def request(config_file_content, layer_name, format, row, column, zoom):
     '''
     Helper method to write config_file_content to disk and do
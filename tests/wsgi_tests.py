@@ -0,0 +1,138 @@
+# This Python file uses the following encoding: utf-8
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from os import utime
+from os.path import join
+from shutil import rmtree
+from time import time
+from email.utils import formatdate
+
+from ModestMaps.Core import Coordinate
+from TileStache import WSGITileServer
+from TileStache.Config import buildConfiguration
+
+class WSGIFileTests(TestCase):
+    '''Tests sending Disk-cached tiles straight from their files'''
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='tilestache-tests-')
+        self.app = WSGITileServer(buildConfiguration({
+            "cache": {"name": "Disk", "path": join(self.tmpdir, 'disk')},
+            "layers": {
+                "solid": {
+                    "provider": {"class": "tests.utils:SolidProvider"},
+                    "allowed origin": "*"
+                }
+            }
+        }))
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def request(self, path_info, **headers):
+        environ = dict(PATH_INFO=path_info, QUERY_STRING='', SCRIPT_NAME='')
+        environ.update(headers)
+        response = {}
+
+        def start_response(status, headers):
+            response['status'], response['headers'] = status, dict(headers)
+
+        body = ''.join(self.app(environ, start_response))
+        return response['status'], response['headers'], body
+
+    def test_file_response(self):
+        '''Serve a cached tile from its file after the first request'''
+
+        status, headers, body = self.request('/solid/0/0/0.png')
+        self.assertEqual(status, '200 OK')
+        self.assertFalse('Accept-Ranges' in headers, 'First response should be rendered')
+
+        status, headers2, body2 = self.request('/solid/0/0/0.png')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body2, body)
+        self.assertEqual(headers2['Content-Type'], 'image/png')
+        self.assertEqual(headers2['Content-Length'], str(len(body)))
+        self.assertEqual(headers2['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(headers2['ETag'], headers['ETag'], 'Cached tile should keep its ETag')
+
+        status, headers3, body3 = self.request('/solid/0/0/0.png', HTTP_IF_MODIFIED_SINCE=headers2['Last-Modified'])
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body3, '')
+
+    def test_range_response(self):
+        '''Serve byte ranges of a cached tile'''
+
+        status, headers, body = self.request('/solid/0/0/0.png')
+
+        status, headers, part = self.request('/solid/0/0/0.png', HTTP_RANGE='bytes=1-3')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(part, body[1:4])
+        self.assertEqual(headers['Content-Range'], 'bytes 1-3/%d' % len(body))
+
+        status, headers, part = self.request('/solid/0/0/0.png', HTTP_RANGE='bytes=-4')
+        self.assertEqual(part, body[-4:])
+
+        status, headers, part = self.request('/solid/0/0/0.png', HTTP_RANGE='bytes=%d-' % len(body))
+        self.assertEqual(status, '416 Requested Range Not Satisfiable')
+
+        status, headers, part = self.request('/solid/0/0/0.png', HTTP_RANGE='bytes=1-3', HTTP_IF_RANGE=headers['ETag'])
+        self.assertEqual(status, '200 OK', 'Weak ETag should not match If-Range')
+        self.assertEqual(part, body)
+
+        status, headers, part = self.request('/solid/0/0/0.png', HTTP_RANGE='bytes=1-3', HTTP_IF_RANGE=headers['Last-Modified'])
+        self.assertEqual(status, '206 Partial Content')
+
+    def test_file_etag(self):
+        '''Make ETags for cached tiles without reading their files'''
+
+        status, headers, body = self.request('/solid/0/0/0.png')
+        cache, layer = self.app.config.cache, self.app.config.layers['solid']
+        fullpath = cache._fullpath(layer, Coordinate(0, 0, 0), 'png')
+
+        mtime = int(time()) - 10
+        utime(fullpath, (mtime, mtime))
+        status, headers, body = self.request('/solid/0/0/0.png')
+
+        # a file with the same inode, size and time keeps its ETag, whatever it holds.
+        open(fullpath, 'r+b').write('X')
+        utime(fullpath, (mtime, mtime))
+
+        status, headers2, body2 = self.request('/solid/0/0/0.png')
+        self.assertEqual(headers2['ETag'], headers['ETag'])
+        self.assertEqual(body2, 'X' + body[1:])
+
+        status, headers3, body3 = self.request('/solid/0/0/0.png', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '304 Not Modified')
+
+        utime(fullpath, (mtime + 1, mtime + 1))
+        status, headers4, body4 = self.request('/solid/0/0/0.png', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(headers4['ETag'], headers['ETag'])
+
+    def test_conditional_response(self):
+        '''Answer conditional requests with 304 Not Modified'''
+
+        status, headers, body = self.request('/solid/0/0/0.png')
+        etag, last_modified = headers['ETag'], headers['Last-Modified']
+        self.assertTrue(etag.startswith('W/"'), 'Cached tile should have a weak ETag from its file')
+
+        status, headers, body2 = self.request('/solid/0/0/0.png', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers['ETag'], etag)
+        self.assertEqual(body2, '')
+
+        status, headers, body2 = self.request('/solid/0/0/0.png', HTTP_IF_NONE_MATCH='"other", ' + etag)
+        self.assertEqual(status, '304 Not Modified')
+
+        status, headers, body2 = self.request('/solid/0/0/0.png', HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['ETag'], etag)
+        self.assertEqual(body2, body)
+
+        status, headers, body2 = self.request('/solid/0/0/0.png', HTTP_IF_MODIFIED_SINCE=formatdate(time() + 5, usegmt=True))
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(headers['Access-Control-Allow-Origin'], '*')
+
+        status, headers, body2 = self.request('/solid/0/0/0.png', HTTP_IF_MODIFIED_SINCE=formatdate(time() - 600, usegmt=True))
+        self.assertEqual(status, '200 OK')